@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# Benchmarks of batch-heudiconv stages on synthetic studies
+# Each subcommand builds a study of minimal DICOM files in a temporary
+# directory and prints timings for increasing study sizes.
+
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import builtins
+import tempfile
+import contextlib
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from bh_study import Session  # noqa: E402
+
+
+def write_dicom(path, study_uid, series_uid, series_number, description, instance, size=8, private_bytes=0):
+    """Write a minimal MR image (size x size, one slice) that heudiconv can group
+
+    private_bytes adds a Siemens CSA image header of that length.
+    """
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MR'
+    ds.PatientID = os.path.basename(os.path.dirname(os.path.dirname(path)))
+    ds.StudyInstanceUID = study_uid
+    ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = '20250101'
+    ds.AcquisitionTime = '101112'
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = ds.ProtocolName = description
+    ds.InstanceNumber = instance
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M']
+    ds.EchoTime = 5.0
+    ds.RepetitionTime = 2000
+    ds.ImagePositionPatient = [0, 0, instance]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.Rows = ds.Columns = size
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    if private_bytes:
+        ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA HEADER')
+        ds.add_new((0x0029, 0x1010), 'OB', bytes(private_bytes))
+    ds.PixelData = bytes(size * size * 2)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+def make_sorted_study(study_name, n_sessions, n_series=2, n_files=5, start=0):
+    """Add sessions sub0001_01, ... to DICOM/sorted of a synthetic study (in the current directory)
+
+    Returns:
+        list: Session of each directory written
+    """
+    from pydicom.uid import generate_uid
+
+    sessions = []
+    for i in range(start, start + n_sessions):
+        session = Session(f'sub{i + 1:04d}_01', f'sub{i + 1:04d}', '01')
+        study_uid = generate_uid()
+        for series in range(1, n_series + 1):
+            series_uid = generate_uid()
+            for instance in range(1, n_files + 1):
+                write_dicom(os.path.join(study_name, 'DICOM', 'sorted', session.directory,
+                                         f'{series:02d}_series{series}', f'{instance}.dcm'),
+                            study_uid, series_uid, series, f'series{series}', instance)
+        sessions.append(session)
+    return sessions
+
+
+HEURISTIC = '''
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    return template, outtype, annotation_classes
+
+
+def infotodict(seqinfo):
+    t1w = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_T1w')
+    info = {t1w: []}
+    for s in seqinfo:
+        info[t1w].append(s.series_id)
+    return info
+'''
+
+
+def _timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heudiconv_inputs(args):
+    """Per-session heudiconv input selection: template (-d) versus --files, by study size"""
+    import bh_pipeline
+
+    sizes = sorted(int(n) for n in args.sizes.split(','))
+    run_heudiconv = args.heudiconv and shutil.which('heudiconv')
+    if args.heudiconv and not run_heudiconv:
+        print("Warning: heudiconv not found; timing the input selection only")
+    template = os.path.join('DICOM', 'sorted', '{subject}_{session}', '*', '*')
+
+    workdir = tempfile.mkdtemp(prefix='bh_benchmark_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        study = bh_pipeline.Study('bench')
+        os.makedirs(study.path('code'))
+        with open(study.heuristic_file, 'w') as f:
+            f.write(HEURISTIC)
+        print(f"{'sessions':>8} {'files':>8}  {'-d glob (ms)':>12} {'--files (ms)':>12}"
+              + (f"  {'heudiconv -d (s)':>16} {'heudiconv --files (s)':>21}" if run_heudiconv else ''))
+        sessions = []
+        for n in sizes:
+            sessions += make_sorted_study(study.name, n - len(sessions), args.series, args.files,
+                                          start=len(sessions))
+            session = sessions[len(sessions) // 2]
+            pattern = template.format(subject=session.subject, session=session.session)
+            glob_ms = 1000 * _timed(lambda: sorted(glob.glob(os.path.abspath(study.path(pattern)))),
+                                    args.repeat)
+            files_ms = 1000 * _timed(lambda: bh_pipeline.heudiconv_inputs(study, session), args.repeat)
+            line = f"{n:>8} {n * args.series * args.files:>8}  {glob_ms:>12.2f} {files_ms:>12.2f}"
+            if run_heudiconv:
+                common = ['-o', 'bench_out', '-f', os.path.relpath(study.heuristic_file, study.name),
+                          '-s', session.subject, '-ss', session.session, '-c', 'none', '--overwrite']
+                commands = (['heudiconv', '-d', template] + common,
+                            ['heudiconv'] + bh_pipeline.heudiconv_inputs(study, session) + common)
+                seconds = [_timed(lambda cmd=cmd: subprocess.run(cmd, cwd=study.name, check=True,
+                                                                  env=bh_pipeline.heudiconv_env(),
+                                                                  stdout=subprocess.DEVNULL,
+                                                                  stderr=subprocess.DEVNULL),
+                                  max(1, args.repeat // 10))
+                           for cmd in commands]
+                line += f"  {seconds[0]:>16.2f} {seconds[1]:>21.2f}"
+            print(line, flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+@contextlib.contextmanager
+def delayed_io(root, latency):
+    """Stand-in for network storage: each open/stat/listing/metadata call on a path under root
+    first waits latency seconds (as a round trip would, without holding the GIL)"""
+    root = os.path.abspath(root) + os.sep
+
+    def slow(func):
+        def wrapper(*args, **kwargs):
+            path = args[0] if args else kwargs.get('path', kwargs.get('file', '.'))
+            if isinstance(path, (str, bytes, os.PathLike)) \
+                    and os.path.abspath(os.fsdecode(path)).startswith(root):
+                time.sleep(latency)
+            return func(*args, **kwargs)
+        return wrapper
+
+    patched = [(builtins, 'open'), (os, 'stat'), (os, 'lstat'), (os, 'scandir'), (os, 'chmod'), (os, 'utime')]
+    saved = [(module, name, getattr(module, name)) for module, name in patched]
+    for module, name, func in saved:
+        setattr(module, name, slow(func))
+    try:
+        yield
+    finally:
+        for module, name, func in saved:
+            setattr(module, name, func)
+
+
+def _tree(root):
+    """{relative path: contents} of the files under root"""
+    tree = {}
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                tree[os.path.relpath(os.path.join(dirpath, name), root)] = f.read()
+    return tree
+
+
+def sort_io(args):
+    """Sorting one directory on delayed storage with increasing numbers of overlapped I/O requests"""
+    from pydicom.uid import generate_uid
+    from bh_dcm_sort_uid import copy_dicom_files
+
+    workdir = tempfile.mkdtemp(prefix='bh_benchmark_')
+    try:
+        src = os.path.join(workdir, 'original', 'sub0001')
+        study_uid = generate_uid()
+        per_series = max(1, args.files // args.series)
+        for series in range(1, args.series + 1):
+            series_uid = generate_uid()
+            for instance in range(1, per_series + 1):
+                write_dicom(os.path.join(src, f'series{series}', f'{instance}.dcm'),
+                            study_uid, series_uid, series, f'series{series}', instance)
+        n_files = per_series * args.series
+
+        print(f"{n_files} files, {args.latency:g} ms per open/stat/listing call")
+        print(f"{'io-jobs':>8} {'seconds':>8} {'files/s':>8} {'speedup':>8}")
+        reference = baseline = None
+        for io_jobs in sorted(int(n) for n in args.io_jobs.split(',')):
+            sorted_dir = os.path.join(workdir, f'sorted_{io_jobs}')
+            with delayed_io(workdir, args.latency / 1000), open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                copy_dicom_files(src, sorted_dir, io_jobs=io_jobs)
+                seconds = time.perf_counter() - start
+            baseline = baseline or seconds
+            print(f"{io_jobs:>8} {seconds:>8.2f} {n_files / seconds:>8.0f} {baseline / seconds:>7.1f}x", flush=True)
+            tree = _tree(sorted_dir)
+            if reference is None:
+                reference = tree
+            elif tree != reference:
+                print(f"Error: the tree sorted with --io-jobs {io_jobs} differs")
+                return 1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+def _read_counters():
+    """(bytes returned by read system calls, bytes of page faults) of this process so far"""
+    import resource
+
+    with open('/proc/self/io') as f:
+        rchar = next(int(line.split()[1]) for line in f if line.startswith('rchar'))
+    return rchar, resource.getrusage(resource.RUSAGE_SELF).ru_minflt * resource.getpagesize()
+
+
+def _buffered_header(path):
+    """Header read through a buffered file (as the sorter did before reading from a memory mapping)"""
+    import pydicom
+    from bh_file_types import PREFIX_SIZE, classify
+
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        kind = classify(f.read(PREFIX_SIZE), st.st_size)
+        f.seek(0)
+        return pydicom.dcmread(f, defer_size='1 KB', force=kind == 'raw'), None, st
+
+
+def sort_read(args):
+    """Header parsing and copying of local files: buffered reads and shutil.copy2 against
+    memory-mapped parsing and in-kernel copies"""
+    from pydicom.uid import generate_uid
+    from bh_sort_io import read_header, write_copy
+
+    if not os.path.exists('/proc/self/io'):
+        print("Error: this benchmark needs /proc/self/io (Linux)")
+        return 1
+    workdir = tempfile.mkdtemp(prefix='bh_benchmark_')
+    try:
+        src = os.path.join(workdir, 'original')
+        paths = [os.path.join(src, f'{i}.dcm') for i in range(args.files)]
+        study_uid, series_uid = generate_uid(), generate_uid()
+        for i, path in enumerate(paths):
+            write_dicom(path, study_uid, series_uid, 1, 'series1', i + 1, args.size, args.private_kb * 1024)
+        file_size = os.path.getsize(paths[0])
+        print(f"{args.files} files of {file_size / 1024:.0f} KB "
+              f"({args.size}x{args.size} pixels, {args.private_kb} KB private header), page cache warm")
+
+        print(f"{'header':>10} {'us/file':>8} {'read/file':>10} {'faulted/file':>13}")
+        for name, read in (('buffered', _buffered_header), ('mmap', read_header)):
+            for path in paths:
+                read(path)
+            rchar, faulted = _read_counters()
+            start = time.perf_counter()
+            for path in paths:
+                ds = read(path)[0]
+                if 'PixelData' not in ds:
+                    print(f"Error: {name} read no pixel data element from {path}")
+                    return 1
+            seconds = time.perf_counter() - start
+            after = _read_counters()
+            print(f"{name:>10} {seconds / args.files * 1e6:>8.0f} {(after[0] - rchar) / args.files:>10.0f} "
+                  f"{(after[1] - faulted) / args.files:>13.0f}", flush=True)
+
+        print(f"{'copy':>10} {'us/file':>8}")
+        for name, copy in (('copy2', shutil.copy2), ('in-kernel', write_copy)):
+            dest = os.path.join(workdir, name)
+            os.makedirs(dest)
+            start = time.perf_counter()
+            for path in paths:
+                copy(path, os.path.join(dest, os.path.basename(path)))
+            seconds = time.perf_counter() - start
+            print(f"{name:>10} {seconds / args.files * 1e6:>8.0f}", flush=True)
+        if _tree(os.path.join(workdir, 'copy2')) != _tree(os.path.join(workdir, 'in-kernel')):
+            print("Error: the copies differ")
+            return 1
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+# Command-line tools and arguments of runs that do no work (help, a missing directory), timed by `startup`
+STARTUP_RUNS = [
+    ('batch-heudiconv', ['--help']),
+    ('batch-heudiconv', ['sort', 'missing_study']),
+    ('bh_dcm_sort_uid.py', ['--help']),
+    ('bh_dcm_sort_uid.py', ['missing_dir']),
+    ('bh_dcm_sort_dir.py', ['--help']),
+    ('bh_dcm_sort_dir.py', ['missing_dir']),
+    ('bh_reorganize_fieldmaps.py', ['--help']),
+    ('bh_fix_intendedfor.py', ['--help']),
+    ('bh_convert_ge_fieldmaps.py', ['--help']),
+    ('bh_convert_double_echo.py', ['--help']),
+    ('bh_detect_double_echo.py', ['--help']),
+]
+
+# Dependencies that a run doing no work must not import
+HEAVY_MODULES = ('pydicom', 'pandas', 'numpy', 'nibabel', 'heudiconv')
+
+
+def _importtime(command, cwd):
+    """Run command under python -X importtime in cwd: returns (seconds, [(self us, cumulative us, module), ...])
+
+    Nested imports are indented by two spaces per level in the module name. cwd
+    is a scratch directory: some tools write files there even when doing no
+    work (bh_dcm_sort_dir.py opens dcm_sort.log when it is imported).
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - start
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), name[1:].rstrip()))
+    return seconds, imports
+
+
+def startup(args):
+    """Startup of the command-line tools for runs that do no work, with a budget on import time"""
+    scripts = os.path.dirname(os.path.realpath(__file__))
+    workdir = tempfile.mkdtemp(prefix='bh_benchmark_')
+    failed = []
+    try:
+        baseline = statistics.median(_importtime(['-c', 'pass'], workdir)[0] for _ in range(args.repeat))
+        interpreter = {name.strip() for _, _, name in _importtime(['-c', 'pass'], workdir)[1]}
+        print(f"Interpreter startup: {baseline * 1000:.0f} ms; import budget: {args.budget_ms:g} ms")
+        print(f"{'command':<40} {'wall ms':>8} {'import ms':>10} {'modules':>8}  slowest imports (ms)")
+        for script, script_args in STARTUP_RUNS:
+            runs = [_importtime([os.path.join(scripts, script)] + script_args, workdir) for _ in range(args.repeat)]
+            seconds = statistics.median(wall for wall, _ in runs)
+            imports = [(self_us, cumulative_us, name) for self_us, cumulative_us, name in runs[-1][1]
+                       if name.strip() not in interpreter]
+            import_ms = statistics.median(sum(self_us for self_us, _, name in run if name.strip() not in interpreter)
+                                          for _, run in runs) / 1000
+            top_level = sorted((item for item in imports if not item[2].startswith(' ')), reverse=True,
+                               key=lambda item: item[1])
+            slowest = ', '.join(f'{name} {cumulative_us / 1000:.0f}' for _, cumulative_us, name in top_level[:args.top])
+            command = ' '.join([script] + script_args)
+            print(f"{command:<40} {seconds * 1000:>8.0f} {import_ms:>10.1f} {len(imports):>8}  {slowest}", flush=True)
+            heavy = sorted({name.strip().split('.')[0] for _, _, name in imports} & set(HEAVY_MODULES))
+            if heavy:
+                failed.append(f"{command} imports {', '.join(heavy)}")
+            if import_ms > args.budget_ms:
+                failed.append(f"{command} spends {import_ms:.0f} ms importing (budget: {args.budget_ms:g} ms)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for problem in failed:
+        print(f"Error: {problem}")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of batch-heudiconv stages on synthetic studies',
+        epilog='''
+Examples:
+  %(prog)s heudiconv-inputs
+  %(prog)s heudiconv-inputs --sizes 10,100,1000 --heudiconv
+  %(prog)s sort-io --latency 5 --io-jobs 1,4,16
+  %(prog)s sort-read --files 500 --size 256 --private-kb 64
+  %(prog)s startup --budget-ms 60
+        ''',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', metavar='<benchmark>')
+
+    p = commands.add_parser('heudiconv-inputs',
+                            help='Time selecting the DICOM files of one session as study size grows')
+    p.add_argument('--sizes', default='10,100,1000', help='Numbers of sessions (default: 10,100,1000)')
+    p.add_argument('--series', type=int, default=2, help='Series per session (default: 2)')
+    p.add_argument('--files', type=int, default=5, help='Files per series (default: 5)')
+    p.add_argument('--repeat', type=int, default=20, help='Timed repetitions (default: 20)')
+    p.add_argument('--heudiconv', action='store_true',
+                   help='Also time heudiconv runs (-c none) with -d and with --files')
+
+    p = commands.add_parser('sort-io',
+                            help='Time sorting on a delayed file system stand-in with overlapped I/O')
+    p.add_argument('--files', type=int, default=400, help='DICOM files to sort (default: 400)')
+    p.add_argument('--series', type=int, default=4, help='Series the files are spread over (default: 4)')
+    p.add_argument('--latency', type=float, default=5, metavar='MS',
+                   help='Delay of each open/stat/listing call in milliseconds (default: 5)')
+    p.add_argument('--io-jobs', default='1,4,16', help='Values of --io-jobs to time (default: 1,4,16)')
+
+    p = commands.add_parser('sort-read',
+                            help='Bytes read per file by header parsing, buffered against memory-mapped')
+    p.add_argument('--files', type=int, default=500, help='DICOM files (default: 500)')
+    p.add_argument('--size', type=int, default=256, help='Rows and columns of each image (default: 256)')
+    p.add_argument('--private-kb', type=int, default=64,
+                   help='Size of a private (Siemens CSA) header element in KB (default: 64)')
+
+    p = commands.add_parser('startup',
+                            help='Time the startup of the command-line tools (python -X importtime) and fail '
+                                 'if one imports a heavy dependency or exceeds the import budget')
+    p.add_argument('--budget-ms', type=float, default=60,
+                   help='Import time allowed per command beyond the interpreter\'s own (default: 50)')
+    p.add_argument('--repeat', type=int, default=5, help='Runs of each command (default: 5)')
+    p.add_argument('--top', type=int, default=3, help='Slowest top-level imports listed (default: 3)')
+
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'heudiconv-inputs':
+        return heudiconv_inputs(args)
+    if args.command == 'sort-io':
+        return sort_io(args)
+    if args.command == 'sort-read':
+        return sort_read(args)
+    if args.command == 'startup':
+        return startup(args)
+    parser.print_help(sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
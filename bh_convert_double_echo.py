@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Convert studies with double-echo fieldmaps in a single heudiconv run per session
+# The two-pass workflow (heuristic_*_11_without_magnitude.py, then
+# heuristic_*_12_magnitude.py with merge.json) runs heudiconv twice and parses
+# every DICOM of the session twice. Here heudiconv runs once with the
+# without-magnitude heuristic, and the magnitude series selected by the
+# magnitude heuristic are converted directly with dcm2niix (merging echoes),
+# which only reads the files of those series. batch-heudiconv bids-double-echo
+# (bh05_make_bids_double_echo_fieldmap.sh) converts this way when the study
+# has a magnitude heuristic (see bh_pipeline.bids_double_echo).
+
+import os
+import sys
+import argparse
+from bh_study import sorted_dir
+from bh_simulate_heuristic import build_seqinfo, key_template
+from bh_dcm2niix import ConversionError, convert_series, update_scans_rows
+
+
+def convert_magnitude(study, session, magnitude_heuristic):
+    """Convert the series the magnitude heuristic selects, merging their echoes
+
+    The seqinfo the heuristic sees is built from the series index of the
+    session (see bh_simulate_heuristic.build_seqinfo), so no DICOM header is
+    read here; only series missing from the index are read from one file.
+
+    Args:
+        study: bh_pipeline.Study (its BIDS root and series indexes are used)
+
+    Returns:
+        bool: Whether every selected series was converted
+    """
+    dicom_dir = sorted_dir(study.name, session)
+    seqinfo = build_seqinfo(dicom_dir)
+    info = magnitude_heuristic.infotodict(seqinfo)
+    dir_of_series = {s.series_id: s.dcm_dir_name for s in seqinfo}
+    index = study.index(session.directory)
+
+    ok = True
+    # {session directory relative to the BIDS root: {filename: acq_time}}
+    scans_rows = {}
+    for key, series_ids in info.items():
+        for item, series_id in enumerate(series_ids, start=1):
+            dir_name = dir_of_series.get(series_id)
+            if dir_name is None:
+                print(f"  Error: series {series_id} not found in {dicom_dir}")
+                ok = False
+                continue
+            output = key_template(key).format(
+                subject=session.subject, session=f'ses-{session.session}',
+                item=item, seqitem=item, subindex=1)
+            out_dir = os.path.join(study.rawdata, os.path.dirname(output))
+            try:
+                convert_series(os.path.join(dicom_dir, dir_name), out_dir,
+                               os.path.basename(output), merge=True)
+            except ConversionError as e:
+                print(f"  Error: {e}")
+                ok = False
+                continue
+            print(f"  Converted {dir_name} -> {output}.nii.gz (merged echoes)")
+            # sub-*[/ses-*]/<datatype>/<name>: scans.tsv lives in sub-*[/ses-*]
+            parts = output.split('/')
+            session_rel = '/'.join(parts[:-2])
+            scans_rows.setdefault(session_rel, {})[f"{parts[-2]}/{parts[-1]}.nii.gz"] = \
+                index.get(dir_name, {}).get('acq_time', 'n/a')
+
+    for session_rel, rows in scans_rows.items():
+        scans_file = os.path.join(study.rawdata, session_rel, f"{session_rel.replace('/', '_')}_scans.tsv")
+        update_scans_rows(scans_file, rows)
+    if ok and not scans_rows:
+        print("  Warning: No magnitude fieldmap converted for this session")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a study with double-echo fieldmaps in one heudiconv run per session',
+        epilog='''
+Examples:
+  %(prog)s my_study_2024
+  %(prog)s my_study_2024 --magnitude-heuristic code/heuristic_fmap_magnitude.py
+
+Heuristics (based on the templates in code/):
+  code/heuristic_<study_name>.py            everything except the magnitude fieldmap
+                                            (heuristic_template_11_without_magnitude.py)
+  code/heuristic_<study_name>_magnitude.py  the magnitude fieldmap only
+                                            (heuristic_template_12_magnitude.py)
+
+Each session is parsed by heudiconv once, from its own series directories
+(as in batch-heudiconv bids); the magnitude series are then converted from
+their sorted directories with dcm2niix merging both echoes (what
+code/merge.json does in the two-pass workflow). The magnitude heuristic is
+run on the series indexes written by bh02_sort_dicom.sh, which must exist
+for every session, so the DICOM headers are not read a second time.
+As with batch-heudiconv bids, the DICOM files are backed up only when every
+session converted.
+
+batch-heudiconv bids-double-echo (bh05_make_bids_double_echo_fieldmap.sh)
+does the same when code/heuristic_<study_name>_magnitude.py exists.
+        ''',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('study_name', help='Name of your research study')
+    parser.add_argument('-f', '--heuristic',
+                        help='Heuristic without magnitude (default: code/heuristic_<study_name>.py)')
+    parser.add_argument('--magnitude-heuristic',
+                        help='Magnitude heuristic (default: code/heuristic_<study_name>_magnitude.py)')
+    args = parser.parse_args(argv)
+
+    # bh_pipeline is only needed (and imported) to convert
+    from bh_pipeline import Study, bids_double_echo
+
+    study_name = args.study_name.rstrip('/')
+    magnitude_file = args.magnitude_heuristic or \
+        os.path.join(study_name, 'code', f'heuristic_{study_name}_magnitude.py')
+    if not os.path.isfile(magnitude_file):
+        print(f"Error: Heuristic file not found: {magnitude_file}")
+        return 1
+    return bids_double_echo(Study(study_name, heuristic=args.heuristic), magnitude_heuristic=magnitude_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Convert GE fieldmaps that were split by image component at sort time
+# (bh02_sort_dicom.sh --split-fieldmaps) directly into correctly named BIDS files.
+# This replaces the post-conversion rename pass of bh_reorganize_fieldmaps.py.
+
+import os
+import re
+import sys
+import argparse
+from bh_series_index import read_index, strip_uid_suffix
+from bh_study import read_subjlist, uses_session, bids_session_dir, sorted_dir
+from bh_dcm2niix import ConversionError, convert_series, update_scans_rows
+
+# Number of the fieldmap in the series description (2D-field_map1, 2D-field_map2, ...)
+FIELDMAP_NUMBER_RE = re.compile(r'field_?map(\d+)', re.IGNORECASE)
+
+
+def split_fieldmap_series(index):
+    """Return [(series directory name, entry)] of component-split fieldmap series"""
+    return [(name, entry) for name, entry in sorted(index.items())
+            if entry.get('component') and strip_uid_suffix(name).endswith(f"_{entry['component']}")]
+
+
+def fieldmap_basenames(series, prefix):
+    """Return [(series directory name, entry, BIDS basename)] of split fieldmap series
+
+    Each fieldmap is numbered from its series description (2D-field_map1 ->
+    magnitude1/phase1, 2D-field_map2 -> magnitude2/phase2, as in the
+    heuristics), or else by its position in series order.
+
+    Raises:
+        ConversionError: two series would be written to the same file
+    """
+    # The fieldmap a component belongs to: its directory name without the component
+    def fieldmap(dir_name, entry):
+        return strip_uid_suffix(dir_name)[:-len(entry['component']) - 1]
+
+    fieldmaps = sorted({(entry.get('series_number', 0), fieldmap(dir_name, entry)) for dir_name, entry in series})
+    order = {name: i for i, (_, name) in enumerate(fieldmaps, start=1)}
+    named = []
+    owners = {}
+    for dir_name, entry in series:
+        name = fieldmap(dir_name, entry)
+        match = FIELDMAP_NUMBER_RE.search(name)
+        basename = f"{prefix}_{entry['component']}{match.group(1) if match else order[name]}"
+        if basename in owners:
+            raise ConversionError(f"{owners[basename]} and {dir_name} would both be converted to fmap/{basename}")
+        owners[basename] = dir_name
+        named.append((dir_name, entry, basename))
+    return named
+
+
+def convert_session(study_name, session, with_session=True, keep_extra=False, index=None, rawdata=None):
+    """Convert the split GE fieldmaps of one session
+
+    The series index of the session is read from disk unless given. Output
+    goes to bids/rawdata of the study unless another BIDS root is given.
+
+    Returns:
+        int: Number of fieldmap images written
+
+    Raises:
+        ConversionError: two series would be written to the same file (nothing is converted)
+    """
+    dicom_dir = sorted_dir(study_name, session)
+    series = split_fieldmap_series(read_index(dicom_dir) if index is None else index)
+    if not series:
+        return 0
+
+    # Follow the layout heudiconv produced for this subject if it already exists
+    if os.path.isdir(bids_session_dir(study_name, session, True, rawdata)[0]):
+        with_session = True
+    session_dir, prefix = bids_session_dir(study_name, session, with_session, rawdata)
+    fmap_dir = os.path.join(session_dir, 'fmap')
+    scans_rows = {}
+
+    for dir_name, entry, basename in fieldmap_basenames(series, prefix):
+        if entry['component'] in ('real', 'imaginary') and not keep_extra:
+            continue
+        try:
+            convert_series(os.path.join(dicom_dir, dir_name), fmap_dir, basename)
+        except ConversionError as e:
+            print(f"  Warning: {e}")
+            continue
+        print(f"  Converted {dir_name} -> fmap/{basename}.nii.gz")
+        scans_rows[f"fmap/{basename}.nii.gz"] = entry.get('acq_time', 'n/a')
+
+    if scans_rows:
+        update_scans_rows(os.path.join(session_dir, f"{prefix}_scans.tsv"), scans_rows)
+    return len(scans_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert GE fieldmaps split by image component at sort time into BIDS',
+        epilog='''
+Examples:
+  %(prog)s my_study_2024                         # All sessions in the subject list
+  %(prog)s my_study_2024 --subject 001 --session 01
+
+Prerequisites:
+  - DICOM sorted with: bh02_sort_dicom.sh <study_name> --split-fieldmaps
+  - Subject list: <study_name>/tmp/subjlist_<study_name>.tsv
+  - The heuristic must not map the split series (directories ending in
+    _magnitude, _phase, _real or _imaginary); they are converted here.
+
+The magnitude/phase decision is taken from the DICOM headers at sort time,
+so the files are written with their final names (e.g. sub-001_ses-01_phase1)
+and bh_reorganize_fieldmaps.py is not needed for these sessions.
+        ''',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('study_name', help='Name of your research study')
+    parser.add_argument('--subject', help='Only convert this subject')
+    parser.add_argument('--session', help='Only convert this session (with --subject)')
+    parser.add_argument('--keep-extra', action='store_true',
+                        help='Also convert real and imaginary images (default: skip them)')
+    args = parser.parse_args()
+
+    study_name = args.study_name.rstrip('/')
+    try:
+        pattern, sessions = read_subjlist(study_name)
+    except OSError as e:
+        print(f"Error: Could not read subject list: {e}")
+        print(f"Run: bh03_make_subjlist.sh {study_name} '<pattern>'")
+        return 1
+
+    converted = 0
+    failed = 0
+    for session in sessions:
+        if args.subject and session.subject != args.subject:
+            continue
+        if args.session and session.session != args.session:
+            continue
+        try:
+            n = convert_session(study_name, session, uses_session(pattern), args.keep_extra)
+        except ConversionError as e:
+            print(f"Error: {session.subject}/{session.session}: {e}")
+            failed += 1
+            continue
+        if n:
+            print(f"✓ {session.subject}/{session.session}: {n} fieldmap images")
+        converted += n
+
+    if converted == 0 and not failed:
+        print("No split GE fieldmap series found")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
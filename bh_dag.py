@@ -0,0 +1,160 @@
+# Dependency-graph task runner used by `batch-heudiconv pipeline`
+# A task is started in a process pool as soon as the tasks it depends on have
+# finished, within a concurrency limit per kind of task (e.g. sort, convert,
+# post), so that different sessions can be in different stages at the same
+# time. Tasks may also declare resources (e.g. memory, CPUs) that are admitted
+# against budgets, and a cost: among the tasks ready to start, the most costly
+# start first (longest processing time first). The output of each task is
+# captured and printed when it finishes.
+
+import io
+import collections
+import contextlib
+import concurrent.futures
+
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class Task:
+    """A unit of work in the graph
+
+    Args:
+        name: Unique name, used in dependencies and output headers
+        kind: Kind of task; concurrency is limited per kind
+        func: Module-level function run in a worker process (must be picklable)
+        args: Positional arguments of func, or a function returning them when the
+              task starts (for arguments produced by the tasks it depends on)
+        deps: Names of the tasks that must be done before this one starts
+        on_done: Called in the main process with the result of func
+        cost: Relative run time; ready tasks with a higher cost start first
+        resources: {resource: amount} held while the task runs, e.g. {'memory': 2000}
+
+    cost and resources may also be functions, evaluated when the task is ready.
+    """
+
+    def __init__(self, name, kind, func, args=(), deps=(), on_done=None, cost=0, resources=None):
+        self.name = name
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.deps = tuple(deps)
+        self.on_done = on_done
+        self.cost = cost
+        self.resources = resources or {}
+
+    def prepare(self):
+        """Evaluate deferred arguments, cost and resources (once the dependencies are done)"""
+        if callable(self.args):
+            self.args = self.args()
+        if callable(self.cost):
+            self.cost = self.cost()
+        if callable(self.resources):
+            self.resources = self.resources() or {}
+
+
+def _run_captured(func, args):
+    """Run func(*args) with stdout captured; returns (output, ok, result)"""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        try:
+            result = func(*args)
+        except Exception as e:
+            print(f"Error: {e}")
+            return buffer.getvalue(), False, None
+    return buffer.getvalue(), True, result
+
+
+def run_graph(tasks, limits, default_limit=1, budgets=None):
+    """Run tasks in dependency order, concurrently within the per-kind limits and budgets
+
+    A task fails if its function raises; tasks depending on a failed or
+    skipped task are skipped. Tasks must be listed after the tasks they
+    depend on. Ready tasks start in order of decreasing cost (list order
+    among equal costs); a task that does not fit in the remaining budget
+    waits while smaller ones may start, and a task larger than a whole
+    budget runs only when no other task holds that resource.
+
+    Args:
+        tasks: List of Task
+        limits: {kind: maximum number of tasks of that kind running at once}
+        default_limit: Limit for kinds not in limits
+        budgets: {resource: total amount available}; resources without a budget are not limited
+
+    Returns:
+        dict: {task name: 'done', 'failed' or 'skipped'}
+    """
+    names = set()
+    for task in tasks:
+        unknown = [d for d in task.deps if d not in names]
+        if unknown:
+            raise ValueError(f"task {task.name} depends on unknown or later task(s): {', '.join(unknown)}")
+        names.add(task.name)
+
+    def limit(kind):
+        return max(1, limits.get(kind, default_limit))
+
+    max_workers = sum(limit(kind) for kind in {task.kind for task in tasks}) or 1
+    budgets = {r: amount for r, amount in (budgets or {}).items() if amount is not None}
+    in_use = collections.Counter()
+
+    def admissible(task):
+        for resource, amount in task.resources.items():
+            if resource not in budgets or not in_use[resource]:
+                continue
+            if in_use[resource] + amount > budgets[resource]:
+                return False
+        return True
+
+    order = {task.name: i for i, task in enumerate(tasks)}
+    status = {}
+    waiting = list(tasks)
+    running = {}
+    running_kind = collections.Counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            ready = []
+            still_waiting = []
+            for task in waiting:
+                if any(status.get(d) in (FAILED, SKIPPED) for d in task.deps):
+                    status[task.name] = SKIPPED
+                    print(f"[{task.name}] skipped (a task it depends on did not finish)")
+                elif all(status.get(d) == DONE for d in task.deps):
+                    task.prepare()
+                    ready.append(task)
+                else:
+                    still_waiting.append(task)
+
+            # Longest processing time first; sorted() keeps list order among equal costs
+            for task in sorted(ready, key=lambda t: -t.cost):
+                if running_kind[task.kind] < limit(task.kind) and admissible(task):
+                    future = executor.submit(_run_captured, task.func, tuple(task.args))
+                    running[future] = task
+                    running_kind[task.kind] += 1
+                    in_use.update(task.resources)
+                else:
+                    still_waiting.append(task)
+            # Keep the list order of the tasks that are still waiting
+            waiting = sorted(still_waiting, key=lambda t: order[t.name])
+            if not running:
+                continue
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                running_kind[task.kind] -= 1
+                in_use.subtract(task.resources)
+                try:
+                    output, ok, result = future.result()
+                except Exception as e:
+                    output, ok, result = f"Error: {e}\n", False, None
+                print(f"[{task.name}]")
+                print(output, end='')
+                if ok and task.on_done is not None:
+                    task.on_done(result)
+                status[task.name] = DONE if ok else FAILED
+                if not ok:
+                    print(f"[{task.name}] failed")
+    return status
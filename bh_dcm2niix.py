@@ -0,0 +1,103 @@
+# Direct dcm2niix conversion of single sorted series directories
+# Used for series whose BIDS name is already known before conversion
+# (e.g. GE fieldmap components split at sort time), bypassing heudiconv.
+
+import os
+import csv
+import shutil
+import tempfile
+import subprocess
+
+
+class ConversionError(Exception):
+    pass
+
+
+def convert_series(series_dirs, out_dir, basename, merge=False):
+    """Convert series directories with dcm2niix into out_dir/basename.*
+
+    dcm2niix may add suffixes of its own (e.g. _ph for phase images), so the
+    conversion runs in a scratch directory and its single output is renamed.
+
+    Args:
+        series_dirs: Sorted series directory, or a list of them converted together
+        out_dir: Destination directory (created if needed)
+        basename: Output name without extension (e.g. sub-01_ses-01_phase1)
+        merge: Merge 2D slices of the same series regardless of echo (dcm2niix -m y)
+
+    Returns:
+        list: Paths of the files written to out_dir
+
+    Raises:
+        ConversionError: If dcm2niix fails or does not produce exactly one image
+    """
+    if isinstance(series_dirs, str):
+        series_dirs = [series_dirs]
+    os.makedirs(out_dir, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='.dcm2niix_', dir=out_dir)
+    try:
+        if len(series_dirs) == 1:
+            input_dir = series_dirs[0]
+        else:
+            # dcm2niix takes one input folder; link all series into one
+            input_dir = os.path.join(scratch, 'input')
+            os.makedirs(input_dir)
+            for i, series_dir in enumerate(series_dirs):
+                os.symlink(os.path.abspath(series_dir), os.path.join(input_dir, f'{i:03d}'))
+        output = os.path.join(scratch, 'output')
+        os.makedirs(output)
+        result = subprocess.run(
+            ['dcm2niix', '-b', 'y', '-z', 'y', '-m', 'y' if merge else 'n',
+             '-f', basename, '-o', output, input_dir],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            raise ConversionError(f"dcm2niix failed for {', '.join(series_dirs)}:\n{result.stdout}")
+
+        images = [f for f in os.listdir(output) if f.endswith('.nii.gz')]
+        if len(images) != 1:
+            raise ConversionError(
+                f"expected one image from {', '.join(series_dirs)}, got {len(images) or 'none'}: "
+                f"{', '.join(sorted(images))}")
+        produced = images[0][:-len('.nii.gz')]
+
+        written = []
+        for file in sorted(os.listdir(output)):
+            if not file.startswith(produced + '.'):
+                continue
+            dest = os.path.join(out_dir, basename + file[len(produced):])
+            os.replace(os.path.join(output, file), dest)
+            written.append(dest)
+        return written
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def update_scans_rows(scans_file, rows):
+    """Add or replace rows of a BIDS scans.tsv
+
+    Args:
+        scans_file: Path to sub-*[_ses-*]_scans.tsv (created if missing)
+        rows: {filename relative to the session directory: acq_time}
+    """
+    header = ['filename', 'acq_time']
+    existing = []
+    if os.path.exists(scans_file):
+        with open(scans_file, 'r', newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            header = next(reader, header)
+            existing = [row for row in reader if row and row[0] not in rows]
+
+    acq_col = header.index('acq_time') if 'acq_time' in header else None
+    for filename, acq_time in rows.items():
+        row = ['n/a'] * len(header)
+        row[0] = filename
+        if acq_col is not None:
+            row[acq_col] = acq_time
+        existing.append(row)
+
+    tmp_file = scans_file + '.tmp'
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(existing)
+    os.replace(tmp_file, scans_file)
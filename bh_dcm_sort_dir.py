@@ -12,7 +12,6 @@ import time
 import re
 import shutil
 import argparse
-import pydicom
 import sys
 import logging
 
@@ -32,7 +31,7 @@ examples:
 logging.basicConfig(filename='dcm_sort.log', level=logging.INFO,
                    format='%(asctime)s %(levelname)s: %(message)s')
 
-def generate_dest_dir_name(dicom_dataset: pydicom.dataset.FileDataset) -> str:
+def generate_dest_dir_name(dicom_dataset: 'pydicom.dataset.FileDataset') -> str:
     """
     Generate a destination directory name based on DICOM series information.
     
@@ -58,6 +57,9 @@ def sort_dicom_files(src_dir: str, sorted_dir: str = '../sorted/') -> None:
         src_dir: Source directory containing DICOM files
         sorted_dir: Base directory where sorted files will be saved (default: '../sorted/')
     """
+    # pydicom is only needed (and imported) once there is something to sort
+    import pydicom
+
     # Strip trailing slashes from the source directory
     src_dir = src_dir.rstrip('/')
     
@@ -11,10 +11,15 @@
 import os
 import time
 import re
-import shutil
+import collections
 import argparse
-import pydicom
 import sys
+from bh_series_index import (GE_IMAGE_COMPONENT_TAG, image_component, series_entry, add_instance,
+                             add_listed_instance, read_index, remove_instance, uid_dir_name, write_index)
+from bh_pixel_integrity import IntegrityChecker
+from bh_sort_io import Writer, prefetch, read_header, read_instance, walk_files, write_copy
+from bh_file_types import NotDicom
+from bh_dicomdir import find_dicomdirs, read_dicomdir
 
 
 __version__ = '20240515'
@@ -23,7 +28,21 @@ __desc__ = '''
 sort dicom files.
 Sorted DICOM files are named using SOPInstanceUID.
 Please note that PatientID is assumed from the directory name.
-Non-imaging DICOM will be skipped.
+Non-imaging DICOM will be skipped. Files are classified from their first
+bytes (see bh_file_types.py), so PDF reports, JPEG thumbnails, DICOMDIR, ...
+are skipped without running the DICOM parser.
+With --dicomdir, the instances listed in a DICOMDIR (CD/DVD/USB exports) are
+sorted from its records: one header per series is read and the other files
+are only copied (see bh_dicomdir.py).
+With --verify, the pixel data of each copied file is checked (see
+bh_pixel_integrity.py) while copying goes on; damaged series are reported
+and recorded in the series index.
+A series_index.json with per-series header information (ImageType, image
+component, number of files, instances ordered by InstanceNumber, ...) is
+written to each sorted directory.
+Series directories are named SeriesNumber_SeriesDescription, so series sharing
+both (repeated scans) are merged; with --series-key uid each SeriesInstanceUID
+gets its own directory and series_index.json maps the UIDs to directories.
 
 This script is useful when dealing with DICOM files from certain vendors (e.g., Philips)
 that store files with identical filenames in different directories.
@@ -34,50 +53,391 @@ __epilog__ = '''
 examples:
   dcm_sort_uid.py DICOM_DIR
   dcm_sort_uid.py DICOM_DIR1 DICOM_DIR2 DICOM_DIR3
+  dcm_sort_uid.py --split-fieldmaps DICOM_DIR
+  dcm_sort_uid.py --verify DICOM_DIR
+  dcm_sort_uid.py --verify-decode DICOM_DIR
+  dcm_sort_uid.py --dicomdir DICOM_DIR
+  dcm_sort_uid.py --series-key uid DICOM_DIR
 '''
 
-def generate_dest_dir_name(dicom_dataset: pydicom.dataset.FileDataset) -> str:
+def generate_dest_dir_name(dicom_dataset: 'pydicom.dataset.FileDataset') -> str:
     series_number = str(dicom_dataset.SeriesNumber).zfill(2)
     series_description = dicom_dataset.SeriesDescription.replace(' ', '_')
     rule_text = f'{series_number}_{series_description}'
     return re.sub(r'[\\/:?*"<>|]', '', rule_text)
 
-def copy_dicom_files(src_dir: str, sorted_dir: str = '../sorted/') -> None:
+def _split_series(ds, split_fieldmaps, fieldmap_re):
+    """Whether the instances of the series of ds go to one directory per image component"""
+    return split_fieldmaps and ds.get(GE_IMAGE_COMPONENT_TAG) is not None \
+        and fieldmap_re.search(str(ds.get('SeriesDescription', ''))) is not None
+
+
+def _series_dir_name(ds, split_fieldmaps, fieldmap_re, owners=None):
+    """Return (series directory name, image component) of an imaging instance
+
+    With owners ({series directory name: SeriesInstanceUID}), the name is keyed
+    on SeriesInstanceUID (see bh_series_index.uid_dir_name).
+    """
+    dest_dir_name = generate_dest_dir_name(ds)
+    # Give each image component of a GE fieldmap series its own
+    # directory so that it can be converted under its final name
+    component = None
+    if _split_series(ds, split_fieldmaps, fieldmap_re):
+        component = image_component(ds)
+        if component:
+            dest_dir_name = f'{dest_dir_name}_{component}'
+    if owners is not None:
+        dest_dir_name = uid_dir_name(dest_dir_name, str(ds.get('SeriesInstanceUID', '')), owners)
+    return dest_dir_name, component
+
+
+def _write_instance(src_file, dest_file, data, st, checker, dest_dir_name, failed, series):
+    try:
+        write_copy(src_file, dest_file, data, st)
+    except Exception as e:
+        print(f"Failed to process {src_file}: {e}")
+        # Taken out of the index by _drop_failed() once all writes are done
+        # (this may run in a writer thread)
+        failed.append((src_file, series, dest_dir_name, dest_file, e))
+        try:
+            os.remove(dest_file)
+        except OSError:
+            pass
+        return
+    if checker is not None:
+        checker.submit(dest_dir_name, dest_file)
+
+
+def _copy_instance(src_file, ds, out_dir, series, split_fieldmaps, fieldmap_re, checker=None,
+                   data=None, st=None, writer=None, listed=False, owners=None, failed=None):
+    """Copy one imaging instance into its series directory under out_dir and index it (and queue its check)
+
+    data and st are the contents and stat of src_file if already read; with a
+    writer (bh_sort_io.Writer) the file is written in its pool. A listed
+    instance was not parsed: ds only holds what its DICOMDIR record tells.
+    owners ({series directory name: SeriesInstanceUID} of out_dir) keys the
+    series directories on SeriesInstanceUID. Instances that could not be
+    written are appended to failed (see _drop_failed()).
+    """
+    failed = [] if failed is None else failed
+    dest_dir_name, component = _series_dir_name(ds, split_fieldmaps, fieldmap_re, owners)
+    uid = str(ds.SOPInstanceUID)
+    dest_dir = os.path.join(out_dir, dest_dir_name)
+    if dest_dir_name not in series:
+        series[dest_dir_name] = series_entry(ds, component)
+        series[dest_dir_name]['example_file'] = f'{uid}.dcm'
+        # Created once per series (each call is a round trip on network storage)
+        os.makedirs(dest_dir, exist_ok=True)
+    elif not series[dest_dir_name].get('_merged') \
+            and str(ds.get('SeriesInstanceUID', '')) != series[dest_dir_name]['series_uid']:
+        series[dest_dir_name]['_merged'] = True
+        print(f"Warning: series {ds.get('SeriesInstanceUID', '')} shares {os.path.join(out_dir, dest_dir_name)} "
+              f"with series {series[dest_dir_name]['series_uid']}; use --series-key uid to keep them apart")
+    if listed:
+        add_listed_instance(series[dest_dir_name], ds.get('InstanceNumber'), f'{uid}.dcm')
+    else:
+        add_instance(series[dest_dir_name], ds, f'{uid}.dcm')
+    dest_file = os.path.join(dest_dir, f'{uid}.dcm')
+    print(f"Copy {src_file} -> {dest_file}")
+    if writer is None:
+        _write_instance(src_file, dest_file, data, st, checker, dest_dir_name, failed, series)
+    else:
+        writer.submit(_write_instance, src_file, dest_file, data, st, checker, dest_dir_name, failed, series)
+
+
+def _drop_failed(failed, skipped):
+    """Remove the instances that could not be written from their index entries and report them as skipped
+
+    A series left without instances is dropped (with its directory, if empty).
+    """
+    for src_file, series, dest_dir_name, dest_file, error in failed:
+        skipped.append((src_file, f'write failed: {error}'))
+        remove_instance(series[dest_dir_name], os.path.basename(dest_file))
+        if series[dest_dir_name]['n_files'] <= 0:
+            del series[dest_dir_name]
+            try:
+                os.rmdir(os.path.dirname(dest_file))
+            except OSError:
+                pass
+
+
+def _directory_owners(out_dir):
+    """{series directory name: SeriesInstanceUID} of the series already sorted into out_dir"""
+    return {name: entry.get('series_uid', '') for name, entry in read_index(out_dir).items()}
+
+
+def _read_all(paths, io_jobs):
+    """Yield (path, read result or exception) of each file, read ahead in threads if io_jobs > 1"""
+    if io_jobs > 1:
+        yield from prefetch(paths, read_instance, io_jobs)
+        return
+    for path in paths:
+        try:
+            yield path, read_header(path)
+        except Exception as e:
+            yield path, e
+
+
+def _imaging_datasets(paths, io_jobs=1, skipped=None):
+    """Yield (path, dataset, contents or None, stat or None) of the imaging DICOM files among paths
+
+    Files are classified from their first bytes (see bh_file_types.py) and
+    only the header of DICOM files is parsed: the pixel data is neither loaded
+    nor decoded (see bh_pixel_integrity.py for checking it). With io_jobs > 1,
+    files are read and parsed ahead in io_jobs threads (see bh_sort_io.py).
+    Skipped files are appended to skipped as (path, reason).
+    """
+    skipped = [] if skipped is None else skipped
+    for src_file, result in _read_all(paths, io_jobs):
+        if isinstance(result, NotDicom):
+            skipped.append((src_file, str(result)))
+        elif isinstance(result, Exception):
+            print(f"Failed to process {src_file}: {result}")
+            skipped.append((src_file, f'unreadable: {result}'))
+        elif 'PixelData' not in result[0]:
+            sop_class = result[0].get('SOPClassUID')
+            skipped.append((src_file, f"DICOM without pixel data ({sop_class.name if sop_class else 'unknown'})"))
+        else:
+            yield (src_file,) + result
+
+
+# Series and study elements a listed instance takes from the header of the first instance of its series
+LISTED_ELEMENTS = ('StudyInstanceUID', 'StudyDate', 'StudyTime', 'SeriesInstanceUID', 'SeriesNumber',
+                   'SeriesDescription')
+
+
+def _listed_dataset(header, sop_uid, instance_number):
+    """Dataset standing in for an instance known from its DICOMDIR record"""
+    from pydicom import Dataset
+
+    ds = Dataset()
+    for keyword in LISTED_ELEMENTS:
+        if keyword in header:
+            ds[keyword] = header[keyword]
+    ds.SOPInstanceUID = sop_uid
+    if instance_number is not None:
+        ds.InstanceNumber = instance_number
+    return ds
+
+
+def _listed_series(series, io_jobs, skipped, split_fieldmaps, fieldmap_re):
+    """Yield (path, dataset, contents, stat, listed) of the instances of one DICOMDIR series
+
+    The header of the first instance is read; the others are listed unless
+    the records disagree with that header or the series is split by image
+    component, in which case every header is read.
+    """
+    instances = []
+    for path, sop_uid, number in series['instances']:
+        if os.path.isfile(path):
+            instances.append((path, sop_uid, number))
+        else:
+            skipped.append((path, 'listed in DICOMDIR but missing'))
+    if not instances:
+        return
+    path, sop_uid, _ = instances[0]
+    try:
+        header, _, st = read_header(path)
+    except Exception:
+        header = None
+    if header is None or 'PixelData' not in header or str(header.get('SOPInstanceUID', '')) != sop_uid \
+            or str(header.get('SeriesInstanceUID', '')) != series['series_uid'] or not sop_uid \
+            or _split_series(header, split_fieldmaps, fieldmap_re):
+        for item in _imaging_datasets([path for path, _, _ in instances], io_jobs, skipped):
+            yield item + (False,)
+        return
+    yield path, header, None, st, False
+    for path, sop_uid, number in instances[1:]:
+        if sop_uid:
+            yield path, _listed_dataset(header, sop_uid, number), None, None, True
+        else:
+            yield from (item + (False,) for item in _imaging_datasets([path], 1, skipped))
+
+
+def _instances(src_dir, io_jobs=1, skipped=None, dicomdir=False, split_fieldmaps=False, fieldmap_re=None):
+    """Yield (path, dataset, contents, stat, listed) of the imaging instances under src_dir
+
+    With dicomdir, the instances listed in the DICOMDIR files under src_dir are
+    taken from their records (see bh_dicomdir.py) and only the other files are parsed.
+    """
+    skipped = [] if skipped is None else skipped
+    listed_files = set()
+    for path in find_dicomdirs(src_dir) if dicomdir else []:
+        try:
+            series_list, others = read_dicomdir(path)
+        except Exception as e:
+            print(f"Warning: {path} cannot be used ({e}); sorting its files from their headers")
+            continue
+        print(f"Using {path}: {len(series_list)} series")
+        for other, record_type in others:
+            listed_files.add(other)
+            skipped.append((other, f'{record_type} record in DICOMDIR'))
+        for series in series_list:
+            listed_files.update(path for path, _, _ in series['instances'])
+            yield from _listed_series(series, io_jobs, skipped, split_fieldmaps, fieldmap_re)
+    paths = (path for path in walk_files(src_dir) if path not in listed_files)
+    for item in _imaging_datasets(paths, io_jobs, skipped):
+        yield item + (False,)
+
+
+def _print_skipped(src_dir, skipped):
+    if skipped:
+        counts = collections.Counter(reason.split(':')[0] for _, reason in skipped)
+        print(f"Skipped {len(skipped)} files in {src_dir}: "
+              + ', '.join(f'{n} {reason}' for reason, n in counts.most_common()))
+
+
+def _add_integrity(out_dir, series, report):
+    """Record the checks of the series of out_dir in their index entries and print the damaged ones"""
+    for dest_dir_name, result in sorted(report.items()):
+        series[dest_dir_name]['integrity'] = result
+        if result['problems']:
+            file_name, problem = result['problems'][0]
+            print(f"Warning: {os.path.join(out_dir, dest_dir_name)}: {len(result['problems'])} of "
+                  f"{result['checked']} files damaged (e.g. {file_name}: {problem})")
+
+
+def copy_dicom_files(src_dir: str, sorted_dir: str = '../sorted/',
+                     split_fieldmaps: bool = False, fieldmap_pattern: str = 'field',
+                     verify: str = None, verify_jobs: int = None, io_jobs: int = 1,
+                     skipped: list = None, dicomdir: bool = False, series_key: str = 'name') -> dict:
     if not os.path.exists(sorted_dir):
         os.makedirs(sorted_dir)
 
-    for root, _, files in os.walk(src_dir):
-        for file in files:
-            src_file = os.path.join(root, file)
-            try:
-                ds = pydicom.dcmread(src_file)
-                if hasattr(ds, 'pixel_array'):
-                    dest_dir_name = generate_dest_dir_name(ds)
-                    out_dir = os.path.join(sorted_dir, os.path.basename(os.path.normpath(src_dir)))
-                    dest_dir = os.path.join(out_dir, dest_dir_name)
-                    os.makedirs(dest_dir, exist_ok=True)
-                    uid = str(ds.SOPInstanceUID)
-                    dest_file = os.path.join(dest_dir, f'{uid}.dcm')
-                    shutil.copy2(src_file, dest_file)
-                    print(f"Copy {src_file} -> {dest_file}")
-            except Exception as e:
-                print(f"Failed to process {src_file}: {e}")
-
-def main() -> int:
+    out_dir = os.path.join(sorted_dir, os.path.basename(os.path.normpath(src_dir)))
+    fieldmap_re = re.compile(fieldmap_pattern, re.IGNORECASE)
+    series = {}
+    owners = _directory_owners(out_dir) if series_key == 'uid' else None
+    checker = IntegrityChecker(verify, verify_jobs) if verify else None
+    writer = Writer(io_jobs) if io_jobs > 1 else None
+    skipped = [] if skipped is None else skipped
+    failed = []
+
+    for src_file, ds, data, st, listed in _instances(src_dir, io_jobs, skipped, dicomdir, split_fieldmaps,
+                                                     fieldmap_re):
+        try:
+            _copy_instance(src_file, ds, out_dir, series, split_fieldmaps, fieldmap_re, checker, data, st, writer,
+                           listed, owners, failed)
+        except Exception as e:
+            print(f"Failed to process {src_file}: {e}")
+    if writer is not None:
+        writer.close()
+    _drop_failed(failed, skipped)
+    _print_skipped(src_dir, skipped)
+    if checker is not None:
+        _add_integrity(out_dir, series, checker.report())
+
+    # Record per-series header information (ImageType, image component, ...)
+    if series:
+        return write_index(out_dir, series)
+    return {}
+
+
+def copy_dicom_studies(src_dir: str, sorted_dir: str = '../sorted/',
+                       split_fieldmaps: bool = False, fieldmap_pattern: str = 'field',
+                       verify: str = None, verify_jobs: int = None, io_jobs: int = 1,
+                       skipped: list = None, dicomdir: bool = False, series_key: str = 'name') -> dict:
+    """Sort src_dir like copy_dicom_files, with one directory per study (StudyInstanceUID)
+
+    Each study goes to <sorted_dir>/<src_dir name>.<StudyInstanceUID>, to be
+    renamed once its session label is known (see bh_study.session_labels).
+
+    Returns:
+        dict: {StudyInstanceUID: {'directory', 'study_date', 'study_time', 'index'}}
+    """
+    if not os.path.exists(sorted_dir):
+        os.makedirs(sorted_dir)
+
+    base = os.path.basename(os.path.normpath(src_dir))
+    fieldmap_re = re.compile(fieldmap_pattern, re.IGNORECASE)
+    studies = {}
+    series = {}
+    owners = {}
+    # One checker per study; its reports are keyed by series directory name
+    checkers = {}
+    writer = Writer(io_jobs) if io_jobs > 1 else None
+    skipped = [] if skipped is None else skipped
+    failed = []
+
+    for src_file, ds, data, st, listed in _instances(src_dir, io_jobs, skipped, dicomdir, split_fieldmaps,
+                                                     fieldmap_re):
+        try:
+            study_uid = str(ds.get('StudyInstanceUID', '')) or 'unknown'
+            if study_uid not in studies:
+                studies[study_uid] = {
+                    'directory': f'{base}.{study_uid}',
+                    'study_date': str(ds.get('StudyDate', '') or ''),
+                    'study_time': str(ds.get('StudyTime', '') or ''),
+                }
+                series[study_uid] = {}
+                if series_key == 'uid':
+                    owners[study_uid] = _directory_owners(os.path.join(sorted_dir, studies[study_uid]['directory']))
+                if verify:
+                    checkers[study_uid] = IntegrityChecker(verify, verify_jobs)
+            _copy_instance(src_file, ds, os.path.join(sorted_dir, studies[study_uid]['directory']),
+                           series[study_uid], split_fieldmaps, fieldmap_re, checkers.get(study_uid), data, st,
+                           writer, listed, owners.get(study_uid), failed)
+        except Exception as e:
+            print(f"Failed to process {src_file}: {e}")
+    if writer is not None:
+        writer.close()
+    _drop_failed(failed, skipped)
+    _print_skipped(src_dir, skipped)
+
+    for study_uid, checker in checkers.items():
+        _add_integrity(os.path.join(sorted_dir, studies[study_uid]['directory']), series[study_uid],
+                       checker.report())
+    for study_uid, study in studies.items():
+        study['index'] = write_index(os.path.join(sorted_dir, study['directory']), series[study_uid]) \
+            if series[study_uid] else {}
+    return studies
+
+def main(argv=None) -> int:
     start_time = time.time()
     parser = argparse.ArgumentParser(description=__desc__, epilog=__epilog__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('dirs', metavar='DICOM_DIR', help='DICOM directory (one or more).', nargs='+')
+    parser.add_argument('--split-fieldmaps', action='store_true',
+                        help='Sort each image component (magnitude, phase, real, imaginary) of '
+                             'GE fieldmap series into its own directory, e.g. 05_2D-field_map1_phase')
+    parser.add_argument('--fieldmap-pattern', default='field',
+                        help='Regular expression (case-insensitive) on SeriesDescription '
+                             'selecting fieldmap series for --split-fieldmaps (default: field)')
+    parser.add_argument('--verify', action='store_const', const='length',
+                        help='Check the length of the pixel data of each copied file while sorting; '
+                             'damaged series are reported and recorded in series_index.json')
+    parser.add_argument('--verify-decode', action='store_const', const='decode', dest='verify',
+                        help='As --verify, and also decode the pixel data of each file')
+    parser.add_argument('--verify-jobs', type=int, metavar='N',
+                        help='Worker threads for --verify (default: CPUs, at most 8)')
+    parser.add_argument('--io-jobs', type=int, default=1, metavar='N',
+                        help='Files read and written at the same time (default: 1); use e.g. 16 '
+                             'when DICOM_DIR is on network storage (NFS/SMB)')
+    parser.add_argument('--series-key', choices=['name', 'uid'], default='name',
+                        help='Series directories by SeriesNumber_SeriesDescription (name, default), or one '
+                             'per SeriesInstanceUID with a suffix from the UID (uid), e.g. 03_rest__1a2b3c4d')
+    parser.add_argument('--dicomdir', action='store_true',
+                        help='Take the series of the instances listed in a DICOMDIR (CD/DVD/USB exports) '
+                             'from its records; only one header per series is read')
 
-    if len(sys.argv) == 1:
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
         parser.print_help(sys.stderr)
         return 1
 
     try:
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
+        for src_dir in args.dirs:
+            if not os.path.isdir(src_dir):
+                print(parser.format_usage().rstrip())
+                print(f"Error: '{src_dir}' is not a directory")
+                return 1
         for src_dir in args.dirs:
             print(f"Processing directory: {src_dir}")
-            copy_dicom_files(src_dir)
+            copy_dicom_files(src_dir, split_fieldmaps=args.split_fieldmaps,
+                             fieldmap_pattern=args.fieldmap_pattern, verify=args.verify,
+                             verify_jobs=args.verify_jobs, io_jobs=args.io_jobs, dicomdir=args.dicomdir,
+                             series_key=args.series_key)
         elapsed_time = time.time() - start_time
         print(f"Execution time: {elapsed_time:.2f} seconds.")
         return 0
@@ -86,4 +446,5 @@ def main() -> int:
         return 1
 
 if __name__ == '__main__':
-    sys.exit(main())
+    from bh_server import run_served
+    sys.exit(run_served('bh_dcm_sort_uid', main))
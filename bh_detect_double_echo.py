@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Detect double-echo fieldmaps per session from DICOM header data
+# Used by batch-heudiconv bids-double-echo (bh05_make_bids_double_echo_fieldmap.sh) to convert each session with
+# the right dcm2niix configuration (code/merge.json or not).
+
+import os
+import re
+import sys
+import argparse
+from bh_series_index import read_index
+from bh_study import read_subjlist, sorted_dir
+
+MAGNITUDE_VALUES = ('M', 'MAGNITUDE')
+
+
+def _is_magnitude(image_type):
+    return any(str(value).upper() in MAGNITUDE_VALUES for value in image_type)
+
+
+def header_echo_times(series_path):
+    """Return (distinct echo times, is magnitude) of a series directory from its headers"""
+    import pydicom
+
+    echo_times = set()
+    magnitude = False
+    for file in os.listdir(series_path):
+        try:
+            ds = pydicom.dcmread(os.path.join(series_path, file), stop_before_pixels=True,
+                                 specific_tags=['EchoTime', 'ImageType'])
+        except Exception:
+            continue
+        if ds.get('EchoTime') is not None:
+            echo_times.add(float(ds.EchoTime))
+        magnitude = magnitude or _is_magnitude(ds.get('ImageType', []))
+    return sorted(echo_times), magnitude
+
+
+def has_double_echo_fieldmap(dicom_dir, fieldmap_pattern='field'):
+    """Whether a sorted session has a magnitude fieldmap series with two or more echo times
+
+    The sort-time index is used when it has the echo times of a series;
+    other fieldmap series are scanned once, reading only EchoTime and ImageType.
+    """
+    fieldmap_re = re.compile(fieldmap_pattern, re.IGNORECASE)
+    index = read_index(dicom_dir)
+    for dir_name in sorted(os.listdir(dicom_dir)):
+        series_path = os.path.join(dicom_dir, dir_name)
+        if not os.path.isdir(series_path) or not fieldmap_re.search(dir_name):
+            continue
+        entry = index.get(dir_name)
+        if entry is not None and 'echo_times' in entry:
+            echo_times, magnitude = entry['echo_times'], _is_magnitude(entry.get('image_type', []))
+        else:
+            echo_times, magnitude = header_echo_times(series_path)
+        if magnitude and len(echo_times) >= 2:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Detect sessions with double-echo fieldmaps from DICOM headers',
+        epilog='''
+Examples:
+  %(prog)s my_study_2024
+  %(prog)s my_study_2024 -o my_study_2024/tmp/fmap_routing.tsv
+
+Prints one line per session of the subject list:
+  directory <TAB> subject_ID <TAB> session <TAB> double_echo (yes/no)
+
+A session has a double-echo fieldmap when a magnitude series whose directory
+name matches the fieldmap pattern contains two or more distinct EchoTime values.
+        ''',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('study_name', help='Name of your research study')
+    parser.add_argument('-o', '--output', help='Write the routing table to this file instead of stdout')
+    parser.add_argument('--fieldmap-pattern', default='field',
+                        help='Regular expression (case-insensitive) on series directory names (default: field)')
+    args = parser.parse_args()
+
+    study_name = args.study_name.rstrip('/')
+    try:
+        _, sessions = read_subjlist(study_name)
+    except OSError as e:
+        print(f"Error: Could not read subject list: {e}", file=sys.stderr)
+        return 1
+
+    lines = []
+    for session in sessions:
+        dicom_dir = sorted_dir(study_name, session)
+        double_echo = os.path.isdir(dicom_dir) and has_double_echo_fieldmap(dicom_dir, args.fieldmap_pattern)
+        lines.append(f"{session.directory}\t{session.subject}\t{session.session}\t{'yes' if double_echo else 'no'}\n")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.writelines(lines)
+    else:
+        sys.stdout.writelines(lines)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# Series mapping of media exports from their DICOMDIR
+# CD/DVD/USB exports ship a DICOMDIR that lists every instance under its
+# patient, study and series. With --dicomdir, bh_dcm_sort_uid.py takes the
+# series of each listed instance from these records instead of parsing every
+# file: the header of one instance per series is read (for the series directory
+# name and the series index), and the other instances are only copied. Files
+# the DICOMDIR does not list are sorted from their headers as usual.
+
+import os
+from bh_file_types import PREFIX_SIZE, MEDIA_DIRECTORY_UID, media_storage_sop_class
+
+
+class DicomdirError(Exception):
+    """A DICOMDIR whose records cannot be followed"""
+
+
+def find_dicomdirs(src_dir):
+    """Return the paths of the DICOMDIR files under src_dir"""
+    found = []
+    for root, _, files in os.walk(src_dir):
+        for file in files:
+            if file.upper() != 'DICOMDIR':
+                continue
+            path = os.path.join(root, file)
+            with open(path, 'rb') as f:
+                if media_storage_sop_class(f.read(PREFIX_SIZE)) == MEDIA_DIRECTORY_UID:
+                    found.append(path)
+    return sorted(found)
+
+
+def _resolve(root, components, listings):
+    """Path of a ReferencedFileID under root, matching names case-insensitively (None if missing)
+
+    Media written on one system are often mounted with lower-case names on another.
+    """
+    path = root
+    for component in components:
+        if os.path.exists(os.path.join(path, component)):
+            path = os.path.join(path, component)
+            continue
+        if path not in listings:
+            try:
+                listings[path] = {name.upper(): name for name in os.listdir(path)}
+            except OSError:
+                return None
+        name = listings[path].get(component.upper())
+        if name is None:
+            return None
+        path = os.path.join(path, name)
+    return path
+
+
+def _siblings(records, offset):
+    """Yield the in-use records of one directory entity, starting at offset"""
+    seen = set()
+    while offset:
+        if offset in seen or offset not in records:
+            raise DicomdirError(f'broken record offset {offset}')
+        seen.add(offset)
+        record = records[offset]
+        if record.get('RecordInUseFlag', 0xFFFF) != 0:
+            yield record
+        offset = record.get('OffsetOfTheNextDirectoryRecord', 0)
+
+
+def _lower(records, record):
+    return _siblings(records, record.get('OffsetOfReferencedLowerLevelDirectoryEntity', 0))
+
+
+def read_dicomdir(path):
+    """Read the series and instances a DICOMDIR lists
+
+    Returns:
+        tuple: ([series, ...], [(path, record type), ...] of the listed files that are not images)
+            where each series is a dict with study_uid, series_uid and
+            instances: [(path, SOPInstanceUID, InstanceNumber or None), ...] (the path of a
+            missing file is its ReferencedFileID under the DICOMDIR directory)
+
+    Raises:
+        DicomdirError: the records cannot be followed
+    """
+    import pydicom
+
+    ds = pydicom.dcmread(path)
+    records = {record.seq_item_tell: record for record in ds.get('DirectoryRecordSequence', [])}
+    root = os.path.dirname(path)
+    listings = {}
+    series_list = []
+    others = []
+
+    def referenced_file(record):
+        file_id = record.get('ReferencedFileID')
+        if not file_id:
+            return None
+        components = [file_id] if isinstance(file_id, str) else list(file_id)
+        return _resolve(root, components, listings) or os.path.join(root, *components)
+
+    first = ds.get('OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity', 0)
+    for patient in _siblings(records, first):
+        if patient.DirectoryRecordType != 'PATIENT':
+            continue
+        for study in _lower(records, patient):
+            if study.DirectoryRecordType != 'STUDY':
+                continue
+            for series in _lower(records, study):
+                if series.DirectoryRecordType != 'SERIES':
+                    continue
+                entry = {
+                    'study_uid': str(study.get('StudyInstanceUID', '')),
+                    'series_uid': str(series.get('SeriesInstanceUID', '')),
+                    'instances': [],
+                }
+                for record in _lower(records, series):
+                    file_path = referenced_file(record)
+                    if file_path is None:
+                        continue
+                    if record.DirectoryRecordType != 'IMAGE':
+                        others.append((file_path, record.DirectoryRecordType))
+                        continue
+                    number = record.get('InstanceNumber')
+                    entry['instances'].append((file_path, str(record.get('ReferencedSOPInstanceUIDInFile', '')),
+                                               int(number) if number not in (None, '') else None))
+                if entry['instances']:
+                    series_list.append(entry)
+    return series_list, others
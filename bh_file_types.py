@@ -0,0 +1,97 @@
+# Classification of the files of a PACS export from their first bytes
+# DICOM/original often holds more than DICOM images: DICOMDIR, PDF reports,
+# JPEG thumbnails, zip archives, vendor XML. Parsing each of them with pydicom
+# only to have it fail is slow, so the sorter reads a small prefix of every
+# file first and skips what is not a DICOM dataset, recording why.
+
+import os
+import struct
+
+# Bytes read to classify a file: the preamble, the DICM magic and the file meta group
+PREFIX_SIZE = 4096
+
+# MediaStorageSOPClassUID of a DICOMDIR
+MEDIA_DIRECTORY_UID = b'1.2.840.10008.1.3.10'
+
+# (magic at the start of the file, description) of non-DICOM files found in exports
+MAGIC = [
+    (b'%PDF', 'PDF document'),
+    (b'\xff\xd8\xff', 'JPEG image'),
+    (b'\x89PNG', 'PNG image'),
+    (b'GIF8', 'GIF image'),
+    (b'BM', 'BMP image'),
+    (b'PK\x03\x04', 'zip archive'),
+    (b'\x1f\x8b', 'gzip archive'),
+    (b'<?xml', 'XML document'),
+    (b'<', 'HTML/XML document'),
+    (b'{', 'JSON document'),
+]
+
+
+class NotDicom(Exception):
+    """A file skipped by the sorter; the message says what it is"""
+
+
+def _raw_dataset(prefix, size):
+    """Whether prefix looks like a DICOM dataset without preamble (little endian, group 0002 or 0008)"""
+    if len(prefix) < 8:
+        return False
+    group, element = struct.unpack('<HH', prefix[:4])
+    if group not in (0x0002, 0x0008) or element > 0x0100:
+        return False
+    vr = prefix[4:6]
+    if vr.isalpha() and vr.isupper():
+        return True
+    return struct.unpack('<I', prefix[4:8])[0] < size
+
+
+def media_storage_sop_class(prefix):
+    """MediaStorageSOPClassUID from the file meta group in prefix (b'' if not found)"""
+    # The file meta group is always explicit VR little endian
+    start = prefix.find(b'\x02\x00\x02\x00UI')
+    if start == -1 or len(prefix) < start + 8:
+        return b''
+    length = struct.unpack('<H', prefix[start + 6:start + 8])[0]
+    return prefix[start + 8:start + 8 + length].rstrip(b'\x00 ')
+
+
+def classify(prefix, size):
+    """Classify a file from its first PREFIX_SIZE bytes and its size
+
+    Returns:
+        str: 'part10' (preamble and DICM) or 'raw' (dataset without preamble,
+             to be read with force=True)
+
+    Raises:
+        NotDicom: the file is not a DICOM dataset (or is a DICOMDIR)
+    """
+    if prefix[128:132] == b'DICM':
+        if media_storage_sop_class(prefix) == MEDIA_DIRECTORY_UID:
+            raise NotDicom('DICOMDIR')
+        return 'part10'
+    if _raw_dataset(prefix, size):
+        return 'raw'
+    if size == 0:
+        raise NotDicom('empty file')
+    for magic, description in MAGIC:
+        if prefix.startswith(magic):
+            raise NotDicom(description)
+    raise NotDicom('not DICOM')
+
+
+def write_skip_report(path, skipped):
+    """Write the skipped files [(path, reason), ...] as a TSV (removing a stale report if there are none)
+
+    Returns:
+        int: Number of skipped files
+    """
+    if not skipped:
+        if os.path.exists(path):
+            os.remove(path)
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('path\treason\n')
+        for file, reason in skipped:
+            f.write(f'{file}\t{reason}\n')
+    return len(skipped)
@@ -8,8 +8,79 @@ import json
 import glob
 import re
 import argparse
+import sys
+from bh_sidecar_cache import use_cache
 
-def main():
+def fix_session(session_dir, sidecar_cache):
+    """Fix the IntendedFor fields of the fieldmaps of one session (or subject) directory
+
+    Returns:
+        int: Number of fieldmap JSON files changed
+    """
+    subject_id = os.path.basename(session_dir)
+    session_id = 'single-session'
+    if os.path.basename(session_dir).startswith('ses-'):
+        subject_id = os.path.basename(os.path.dirname(session_dir))
+        session_id = os.path.basename(session_dir)
+
+    # Look for all JSON files in the fmap directory
+    fmap_dir = os.path.join(session_dir, 'fmap')
+    if not os.path.exists(fmap_dir):
+        return 0
+
+    print(f"Processing {subject_id}/{session_id}...")
+    fixed = 0
+
+    for fmap_json in glob.glob(os.path.join(fmap_dir, '*_epi.json')):
+        # Extract direction information from the JSON filename
+        direction_match = re.search(r'_dir-([A-Z]+)_', os.path.basename(fmap_json))
+        if not direction_match:
+            continue
+
+        direction = direction_match.group(1)  # 'AP' or 'PA'
+
+        # Load the JSON file (a copy, as the cached content is shared)
+        try:
+            data = dict(sidecar_cache.load(fmap_json))
+        except Exception as e:
+            print(f"  Warning: Could not read {os.path.basename(fmap_json)}: {e}")
+            continue
+
+        # Check if IntendedFor field exists
+        if 'IntendedFor' not in data:
+            continue
+
+        # Record the original length of IntendedFor
+        original_count = len(data['IntendedFor'])
+
+        # Keep only functional scans that match the fieldmap direction
+        filtered_intended_for = []
+        for intended_file in data['IntendedFor']:
+            # Check the direction of the functional scan
+            intended_direction_match = re.search(r'_dir-([A-Z]+)_', intended_file)
+            if intended_direction_match and intended_direction_match.group(1) == direction:
+                filtered_intended_for.append(intended_file)
+
+        # Only update the JSON if there were changes
+        if len(filtered_intended_for) != original_count:
+            # Set the updated IntendedFor list
+            data['IntendedFor'] = filtered_intended_for
+
+            # Write the changes to the JSON file
+            try:
+                with open(fmap_json, 'w') as f:
+                    json.dump(data, f, indent=2)
+                sidecar_cache.store(fmap_json, data)
+
+                fixed += 1
+                print(f"  ✓ Updated {os.path.basename(fmap_json)}: IntendedFor reduced from {original_count} to {len(filtered_intended_for)} entries")
+            except Exception as e:
+                print(f"  Warning: Could not write {os.path.basename(fmap_json)}: {e}")
+
+    return fixed
+
+
+def main(argv=None):
     # Set up command line arguments
     parser = argparse.ArgumentParser(
         description='Fix IntendedFor field in fieldmap JSON files for your study',
@@ -30,7 +101,11 @@ Prerequisites:
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument('study_name', help='Name of your research study')
-    args = parser.parse_args()
+    parser.add_argument('--sidecar-cache', metavar='FILE',
+                        help='Share parsed sidecar JSON with other tools through FILE '
+                             '(default: $BH_SIDECAR_CACHE, or no persistent cache)')
+    args = parser.parse_args(argv)
+    sidecar_cache = use_cache(args.sidecar_cache)
     
     # Construct the BIDS directory path
     bids_dir = os.path.join(args.study_name, 'bids', 'rawdata')
@@ -40,7 +115,7 @@ Prerequisites:
         print(f"Error: BIDS directory not found at {bids_dir}")
         print(f"Please ensure BIDS conversion is completed for study '{args.study_name}'")
         print(f"Run: bh05_make_bids.sh {args.study_name}")
-        return
+        return 1
     
     print(f"Processing BIDS data for study '{args.study_name}' in: {bids_dir}")
     print("")
@@ -50,8 +125,6 @@ Prerequisites:
     
     # Process each subject
     for subject_dir in glob.glob(os.path.join(bids_dir, 'sub-*')):
-        subject_id = os.path.basename(subject_dir)
-        
         # Process each session
         session_dirs = glob.glob(os.path.join(subject_dir, 'ses-*'))
         
@@ -60,60 +133,8 @@ Prerequisites:
             session_dirs = [subject_dir]
             
         for session_dir in session_dirs:
-            session_id = os.path.basename(session_dir) if 'ses-' in session_dir else 'single-session'
-            
-            # Look for all JSON files in the fmap directory
-            fmap_dir = os.path.join(session_dir, 'fmap')
-            if not os.path.exists(fmap_dir):
-                continue
-                
-            print(f"Processing {subject_id}/{session_id}...")
-            
-            for fmap_json in glob.glob(os.path.join(fmap_dir, '*_epi.json')):
-                # Extract direction information from the JSON filename
-                direction_match = re.search(r'_dir-([A-Z]+)_', os.path.basename(fmap_json))
-                if not direction_match:
-                    continue
-                    
-                direction = direction_match.group(1)  # 'AP' or 'PA'
-                
-                # Load the JSON file
-                try:
-                    with open(fmap_json, 'r') as f:
-                        data = json.load(f)
-                except Exception as e:
-                    print(f"  Warning: Could not read {os.path.basename(fmap_json)}: {e}")
-                    continue
-                
-                # Check if IntendedFor field exists
-                if 'IntendedFor' not in data:
-                    continue
-                    
-                # Record the original length of IntendedFor
-                original_count = len(data['IntendedFor'])
-                
-                # Keep only functional scans that match the fieldmap direction
-                filtered_intended_for = []
-                for intended_file in data['IntendedFor']:
-                    # Check the direction of the functional scan
-                    intended_direction_match = re.search(r'_dir-([A-Z]+)_', intended_file)
-                    if intended_direction_match and intended_direction_match.group(1) == direction:
-                        filtered_intended_for.append(intended_file)
-                
-                # Only update the JSON if there were changes
-                if len(filtered_intended_for) != original_count:
-                    # Set the updated IntendedFor list
-                    data['IntendedFor'] = filtered_intended_for
-                    
-                    # Write the changes to the JSON file
-                    try:
-                        with open(fmap_json, 'w') as f:
-                            json.dump(data, f, indent=2)
-                        
-                        fixed_files_count += 1
-                        print(f"  ✓ Updated {os.path.basename(fmap_json)}: IntendedFor reduced from {original_count} to {len(filtered_intended_for)} entries")
-                    except Exception as e:
-                        print(f"  Warning: Could not write {os.path.basename(fmap_json)}: {e}")
+            fixed_files_count += fix_session(session_dir, sidecar_cache)
+    sidecar_cache.save()
 
     print("")
     if fixed_files_count > 0:
@@ -125,6 +146,8 @@ Prerequisites:
     else:
         print(f"No IntendedFor fields needed fixing in study '{args.study_name}'")
         print("All fieldmap references appear to be correctly matched!")
+    return 0
 
 if __name__ == "__main__":
-    main()
+    from bh_server import run_served
+    sys.exit(run_served('bh_fix_intendedfor', main))
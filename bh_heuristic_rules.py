@@ -0,0 +1,164 @@
+# Table-driven heuristic rules for heudiconv
+#
+# A study declares its BIDS keys and series matching rules as data instead of
+# a hand-written chain of "'X' in s.dcm_dir_name" checks:
+#
+#   RULES = {
+#       'keys': {
+#           't1w': 'sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T1w',
+#           'func_rest_PA': 'sub-{subject}/{session}/func/sub-{subject}_{session}_task-rest_dir-PA_run-{item:02d}_bold',
+#       },
+#       'rules': [
+#           {'key': 't1w', 'contains': ['T1_MPR']},
+#           {'key': 'func_rest_PA', 'contains': ['BOLD_REST', 'PA'], 'min_dim4': 200},
+#       ],
+#   }
+#   infotodict = make_infotodict(RULES)
+#
+# Rule fields (all optional except key; every given condition must hold):
+#   contains    substrings that must all occur in dcm_dir_name
+#   excludes    substrings that must not occur in dcm_dir_name
+#   regex       regular expression searched in dcm_dir_name
+#   min_dim4    minimum number of volumes (s.dim4 >= min_dim4)
+#   max_dim4    maximum number of volumes (s.dim4 <= max_dim4)
+#   image_type  value that must be an element of s.image_type (e.g. 'M' or 'P')
+#
+# The rules are compiled once: all substrings of all rules go into a single
+# Aho-Corasick automaton, so each series name is scanned once and only the
+# rules whose substrings were all found are checked further.
+
+import re
+import json
+import collections
+
+
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    if template is None or not template:
+        raise ValueError('Template must be a valid format string')
+    return template, outtype, annotation_classes
+
+
+class SubstringAutomaton:
+    """Aho-Corasick automaton reporting which of a set of substrings occur in a text"""
+
+    def __init__(self, words):
+        self.words = list(words)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        for word_id, word in enumerate(self.words):
+            state = 0
+            for char in word:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state].add(word_id)
+
+        # Breadth-first construction of failure links
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0) if state else 0
+                self._out[child] |= self._out[self._fail[child]]
+
+    def find(self, text):
+        """Return the set of word ids occurring in text"""
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._out[state]:
+                found |= self._out[state]
+        return found
+
+
+class RuleMatcher:
+    """Rules compiled for one-pass classification of seqinfo entries"""
+
+    def __init__(self, rules):
+        self.rules = [dict(rule) for rule in rules]
+        for rule in self.rules:
+            for field in ('contains', 'excludes'):
+                if isinstance(rule.get(field), str):
+                    rule[field] = [rule[field]]
+        words = sorted({word for rule in self.rules
+                        for word in rule.get('contains', []) + rule.get('excludes', []) if word})
+        word_ids = {word: i for i, word in enumerate(words)}
+        self._automaton = SubstringAutomaton(words)
+
+        self._required = []
+        self._excluded = []
+        self._regex = []
+        self._unconditional = []
+        # Rules are indexed by one of their required substrings and only
+        # considered when that substring was found
+        self._by_word = collections.defaultdict(list)
+        for i, rule in enumerate(self.rules):
+            if 'key' not in rule:
+                raise ValueError(f'Rule {i} has no key: {rule}')
+            required = frozenset(word_ids[word] for word in rule.get('contains', []) if word)
+            self._required.append(required)
+            self._excluded.append(frozenset(word_ids[word] for word in rule.get('excludes', []) if word))
+            self._regex.append(re.compile(rule['regex']) if rule.get('regex') else None)
+            if required:
+                self._by_word[min(required)].append(i)
+            else:
+                self._unconditional.append(i)
+
+    def _conditions_hold(self, i, s, found):
+        rule = self.rules[i]
+        if not self._required[i] <= found or self._excluded[i] & found:
+            return False
+        if self._regex[i] is not None and not self._regex[i].search(s.dcm_dir_name):
+            return False
+        if 'min_dim4' in rule and not s.dim4 >= rule['min_dim4']:
+            return False
+        if 'max_dim4' in rule and not s.dim4 <= rule['max_dim4']:
+            return False
+        if 'image_type' in rule and rule['image_type'] not in s.image_type:
+            return False
+        return True
+
+    def match(self, s):
+        """Return the keys of all rules matching seqinfo entry s, in rule order"""
+        found = self._automaton.find(s.dcm_dir_name)
+        candidates = set(self._unconditional)
+        for word_id in found:
+            candidates.update(self._by_word.get(word_id, ()))
+        return [self.rules[i]['key'] for i in sorted(candidates) if self._conditions_hold(i, s, found)]
+
+
+def load_rules(path):
+    """Read a rule table ({'keys': ..., 'rules': ...}) from a JSON file"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def make_infotodict(table):
+    """Build a heudiconv infotodict function from a rule table"""
+    keys = {name: create_key(template) for name, template in table['keys'].items()}
+    for rule in table['rules']:
+        if rule.get('key') not in keys:
+            raise ValueError(f"Rule refers to an undefined key: {rule}")
+    matcher = RuleMatcher(table['rules'])
+
+    def infotodict(seqinfo):
+        """Heuristic evaluator for determining which runs belong where (rule table)"""
+        info = {key: [] for key in keys.values()}
+        for s in seqinfo:
+            for name in matcher.match(s):
+                if s.series_id not in info[keys[name]]:
+                    info[keys[name]].append(s.series_id)
+        return info
+
+    return infotodict
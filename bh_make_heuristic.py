@@ -0,0 +1,315 @@
+# Generate code/heuristic_<study_name>.py (or a rule table) from the sorted DICOM series
+# Used by `batch-heudiconv heuristic` (bh04_make_heuristic.sh). Series
+# information comes from the sort-time series index; series sorted without
+# an index are counted on disk and read for one header.
+
+import os
+import json
+import datetime
+from bh_series_index import read_index, strip_uid_suffix
+from bh_study import uses_session
+
+# (sequence type, patterns in the upper-cased series description), checked in order
+SEQUENCE_PATTERNS = [
+    ('T1w', ('MPRAGE', 'T1W', 'T1', '3D_T1', 'IR-FSPGR', 'BRAVO', 'SAG', 'SPGR')),
+    ('T2w', ('T2W', 'T2', 'T2_TSE', 'SPC_T2', 'FLAIR', 'CUBE', 'T2FLAIR')),
+    ('func_rest', ('REST', 'RESTING', 'RESTING_STATE', 'RS_MB', 'RESTING_STATE_FMRI', 'FMRI_RESTING')),
+    ('dwi', ('DWI', 'DTI', 'DIFF', 'EP2D_DIFF', 'DTI_30', 'TENSOR', 'DTI_MPG', 'DTIMPG')),
+    ('fieldmap', ('FIELD', 'FIELD_MAP', 'FIELD_MAPPING', '2D-FIELD_MAP')),
+    ('phase_encoding', ('_AP', '_PA', '_LR', '_RL')),
+]
+
+DICOM_EXTENSIONS = ('.dcm', '.IMA')
+
+
+def series_description(dir_name):
+    """Series directory name without its series number prefix (e.g. '01_MPRAGE' -> 'MPRAGE')
+
+    The SeriesInstanceUID suffix of --series-key uid is dropped as well.
+    """
+    number, sep, rest = strip_uid_suffix(dir_name).partition('_')
+    return rest if sep and number[:1].isdigit() else dir_name
+
+
+def detect_sequence_type(dir_name, dim4=1):
+    """Classify a series directory as T1w, T2w, func_rest, dwi, fieldmap_* or unknown"""
+    desc_upper = series_description(dir_name).upper()
+    for seq_type, patterns in SEQUENCE_PATTERNS:
+        if not any(p in desc_upper for p in patterns):
+            continue
+        if seq_type == 'func_rest':
+            return 'func_rest' if dim4 > 100 else 'unknown'
+        if seq_type == 'dwi':
+            return 'dwi' if dim4 > 5 else 'unknown'
+        if seq_type == 'fieldmap':
+            return 'fieldmap_siemens' if 'MAPPING' in desc_upper else 'fieldmap_ge'
+        if seq_type == 'phase_encoding':
+            if any(p in desc_upper for p in ('REST', 'RESTING', 'RS')):
+                return 'func_rest_dir'
+            if any(p in desc_upper for p in ('DWI', 'DTI', 'DIFF')):
+                return 'dwi_dir'
+            return 'unknown'
+        return seq_type
+    return 'unknown'
+
+
+def _count_dicom_files(series_path):
+    return sum(1 for _, _, files in os.walk(series_path)
+               for f in files if f.endswith(DICOM_EXTENSIONS))
+
+
+def _temporal_positions(series_path):
+    """NumberOfTemporalPositions of the first DICOM file of a series (None if absent)"""
+    import pydicom
+
+    for root, _, files in os.walk(series_path):
+        for f in sorted(files):
+            if not f.endswith(DICOM_EXTENSIONS):
+                continue
+            try:
+                ds = pydicom.dcmread(os.path.join(root, f), stop_before_pixels=True,
+                                     specific_tags=['NumberOfTemporalPositions'])
+                return int(ds.get('NumberOfTemporalPositions', 0) or 0) or None
+            except Exception:
+                return None
+    return None
+
+
+def series_dim4(series_path, entry=None):
+    """Number of volumes: NumberOfTemporalPositions if > 1, otherwise the number of files"""
+    if entry is not None and 'temporal_positions' in entry:
+        temporal_positions = entry['temporal_positions']
+    else:
+        temporal_positions = _temporal_positions(series_path)
+    if temporal_positions and temporal_positions > 1:
+        return temporal_positions
+    n_files = entry['n_files'] if entry is not None else _count_dicom_files(series_path)
+    return max(n_files, 1)
+
+
+def scan_series(sorted_root, indexes=None):
+    """Return [(series directory name, sequence type, dim4)] of all sorted sessions
+
+    Args:
+        sorted_root: DICOM/sorted directory of the study
+        indexes: Optional {session directory name: series index} already in memory
+    """
+    indexes = indexes or {}
+    series_list = []
+    for session_name in sorted(os.listdir(sorted_root)):
+        session_path = os.path.join(sorted_root, session_name)
+        if not os.path.isdir(session_path):
+            continue
+        index = indexes[session_name] if session_name in indexes else read_index(session_path)
+        for dir_name in sorted(os.listdir(session_path)):
+            series_path = os.path.join(session_path, dir_name)
+            if not os.path.isdir(series_path):
+                continue
+            dim4 = series_dim4(series_path, index.get(dir_name))
+            series_list.append((dir_name, detect_sequence_type(dir_name, dim4), dim4))
+    return series_list
+
+
+def _unique_rules(series_list):
+    """Yield (sequence type, series description) once per combination, in series order"""
+    seen = set()
+    for dir_name, seq_type, _ in series_list:
+        condition_key = (seq_type, series_description(dir_name))
+        if condition_key not in seen:
+            seen.add(condition_key)
+            yield condition_key
+
+
+HEADER = '''# heuristic.py for study: {study_name}
+# Generated by bh04_make_heuristic.sh on {date}
+# Please review and modify as needed for your specific study
+
+import os
+
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    if template is None or not template:
+        raise ValueError('Template must be a valid format string')
+    return template, outtype, annotation_classes
+
+def infotodict(seqinfo):
+    """Heuristic evaluator for determining which runs belong where
+    
+    This function maps DICOM series to BIDS file naming conventions
+    for study: {study_name}
+
+    allowed template fields - follow python string module:
+
+    item: index within category
+    subject: participant id
+    seqitem: run number during scanning
+    subindex: sub index within group
+    """
+
+    ##### BIDS templates for study: {study_name} ############
+'''
+
+KEYS_WITH_SESSION = '''    
+    # Anatomical scans
+    t1w = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T1w')
+    #t2w = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T2w')
+
+    # Functional scans
+    func_rest = create_key('sub-{subject}/{session}/func/sub-{subject}_{session}_task-rest_run-{item:02d}_bold')
+    #func_rest_PA = create_key('sub-{subject}/{session}/func/sub-{subject}_{session}_dir-PA_task-rest_run-{item:02d}_bold')
+    #func_rest_AP = create_key('sub-{subject}/{session}/func/sub-{subject}_{session}_dir-AP_task-rest_run-{item:02d}_bold')
+
+    # Diffusion scans
+    dwi = create_key('sub-{subject}/{session}/dwi/sub-{subject}_{session}_run-{item:02d}_dwi')
+    #dwi_PA = create_key('sub-{subject}/{session}/dwi/sub-{subject}_{session}_dir-PA_run-{item:02d}_dwi')
+    #dwi_AP = create_key('sub-{subject}/{session}/dwi/sub-{subject}_{session}_dir-AP_run-{item:02d}_dwi')
+
+    # Fieldmaps
+    fmap_mag = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_magnitude')
+    fmap_phase = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_phasediff')
+    #fmap_PA = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_dir-PA_fieldmap')
+    #fmap_AP = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_dir-AP_fieldmap')
+'''
+
+KEYS_WITHOUT_SESSION = '''    
+    # Anatomical scans
+    t1w = create_key('sub-{subject}/anat/sub-{subject}_run-{item:02d}_T1w')
+    #t2w = create_key('sub-{subject}/anat/sub-{subject}_run-{item:02d}_T2w')
+
+    # Functional scans
+    func_rest = create_key('sub-{subject}/func/sub-{subject}_task-rest_run-{item:02d}_bold')
+    #func_rest_PA = create_key('sub-{subject}/func/sub-{subject}_dir-PA_task-rest_run-{item:02d}_bold')
+    #func_rest_AP = create_key('sub-{subject}/func/sub-{subject}_dir-AP_task-rest_run-{item:02d}_bold')
+
+    # Diffusion scans
+    dwi = create_key('sub-{subject}/dwi/sub-{subject}_run-{item:02d}_dwi')
+    #dwi_PA = create_key('sub-{subject}/dwi/sub-{subject}_dir-PA_run-{item:02d}_dwi')
+    #dwi_AP = create_key('sub-{subject}/dwi/sub-{subject}_dir-AP_run-{item:02d}_dwi')
+
+    # Fieldmaps
+    fmap_mag = create_key('sub-{subject}/fmap/sub-{subject}_magnitude')
+    fmap_phase = create_key('sub-{subject}/fmap/sub-{subject}_phasediff')
+'''
+
+COMMON = '''
+    # Initialize dictionary to collect series
+    info = {t1w: [], func_rest: [], dwi: [], fmap_mag: [], fmap_phase: []}
+
+    ############################################################################
+    # Series identification rules for this study
+    ############################################################################
+
+    for idx, s in enumerate(seqinfo):
+        """
+        The namedtuple `s` contains the following fields:
+        * total_files_till_now, example_dcm_file, series_id, dcm_dir_name
+        * dim1, dim2, dim3, dim4, TR, TE, protocol_name
+        * is_motion_corrected, is_derived, patient_id, study_description
+        * referring_physician_name, series_description, image_type
+        """
+
+        # Sequence matching rules based on your study's DICOM structure
+
+'''
+
+RULES = {
+    'T1w': '''        # T1-weighted: {desc}
+        if '{desc}' in s.dcm_dir_name:
+            info[t1w].append(s.series_id)
+
+''',
+    'func_rest': '''        # Resting-state fMRI: {desc}
+        if '{desc}' in s.dcm_dir_name:
+            info[func_rest].append(s.series_id)
+
+''',
+    'dwi': '''        # Diffusion-weighted: {desc}
+        if '{desc}' in s.dcm_dir_name:
+            info[dwi].append(s.series_id)
+
+''',
+    'fieldmap_siemens': '''        # Fieldmap (magnitude and phasediff: Siemens): {desc}
+        if '{desc}' in s.dcm_dir_name and 'M' in s.image_type:
+            info[fmap_mag].append(s.series_id)
+        if '{desc}' in s.dcm_dir_name and 'P' in s.image_type:
+            info[fmap_phase].append(s.series_id)
+
+''',
+    'fieldmap_ge': '''        # Fieldmap (magnitude and field: GE): {desc}
+        if '{desc}' in s.dcm_dir_name:
+            # GE fieldmaps need special handling - review and adjust
+            info[fmap_mag].append(s.series_id)
+
+''',
+}
+
+FOOTER = '''
+    return info
+
+# Automatic IntendedFor field population
+POPULATE_INTENDED_FOR_OPTS = {
+    'matching_parameters': ['ImagingVolume', 'Shims'],
+    'criterion': 'Closest'
+}
+'''
+
+RULES_LOADER = '''# heuristic.py for study: {study_name}
+# Generated by bh04_make_heuristic.sh --rules on {date}
+# The series matching rules are in heuristic_{study_name}_rules.json
+# (same directory); review and modify that file as needed for your study
+
+import os
+
+# bh_heuristic_rules.py is shipped with the batch-heudiconv scripts, which put
+# their directory on PYTHONPATH when they run heudiconv
+from bh_heuristic_rules import load_rules, make_infotodict
+
+infotodict = make_infotodict(load_rules(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'heuristic_{study_name}_rules.json')))
+
+# Automatic IntendedFor field population
+POPULATE_INTENDED_FOR_OPTS = {{
+    'matching_parameters': ['ImagingVolume', 'Shims'],
+    'criterion': 'Closest'
+}}
+'''
+
+
+def render_heuristic(study_name, pattern, series_list):
+    """Return the text of heuristic_<study_name>.py with one if-statement per series type"""
+    text = HEADER.format(study_name=study_name, date=datetime.date.today().isoformat())
+    text += KEYS_WITH_SESSION if uses_session(pattern) else KEYS_WITHOUT_SESSION
+    text += COMMON
+    for seq_type, desc in _unique_rules(series_list):
+        if seq_type in RULES:
+            text += RULES[seq_type].format(desc=desc)
+    return text + FOOTER
+
+
+def render_rules(pattern, series_list):
+    """Return the rule table (heuristic_<study_name>_rules.json) for bh_heuristic_rules.py"""
+    ses_dir, ses_name = ('{session}/', '_{session}') if uses_session(pattern) else ('', '')
+    rules = []
+    for seq_type, desc in _unique_rules(series_list):
+        if seq_type in ('T1w', 'func_rest', 'dwi'):
+            rules.append({'key': seq_type.lower(), 'contains': [desc]})
+        elif seq_type == 'fieldmap_siemens':
+            rules.append({'key': 'fmap_mag', 'contains': [desc], 'image_type': 'M'})
+            rules.append({'key': 'fmap_phase', 'contains': [desc], 'image_type': 'P'})
+        elif seq_type == 'fieldmap_ge':
+            rules.append({'key': 'fmap_mag', 'contains': [desc]})
+    table = {
+        'keys': {
+            't1w': f'sub-{{subject}}/{ses_dir}anat/sub-{{subject}}{ses_name}_run-{{item:02d}}_T1w',
+            'func_rest': f'sub-{{subject}}/{ses_dir}func/sub-{{subject}}{ses_name}_task-rest_run-{{item:02d}}_bold',
+            'dwi': f'sub-{{subject}}/{ses_dir}dwi/sub-{{subject}}{ses_name}_run-{{item:02d}}_dwi',
+            'fmap_mag': f'sub-{{subject}}/{ses_dir}fmap/sub-{{subject}}{ses_name}_magnitude',
+            'fmap_phase': f'sub-{{subject}}/{ses_dir}fmap/sub-{{subject}}{ses_name}_phasediff',
+        },
+        'rules': rules,
+    }
+    return json.dumps(table, indent=2) + '\n'
+
+
+def render_rules_loader(study_name):
+    """Return the text of a heuristic file that loads heuristic_<study_name>_rules.json"""
+    return RULES_LOADER.format(study_name=study_name, date=datetime.date.today().isoformat())
@@ -0,0 +1,174 @@
+# Merging of BIDS trees written to private directories (e.g. the shards of
+# `batch-heudiconv shard` or the scratch directory of a session) into bids/rawdata
+# Files are moved into place (a rename on the same file system) and never
+# overwrite a different file of the same name: such conflicts are reported and
+# the file is left in the private tree. A file identical to the one already in
+# place is dropped. participants.tsv is merged row by row.
+
+import os
+import csv
+import errno
+import fcntl
+import shutil
+import filecmp
+import contextlib
+
+# Written by heudiconv for its own bookkeeping; the copy merged last is kept
+BOOKKEEPING_DIRS = ('.heudiconv',)
+# Top-level tables merged row by row, keyed on their first column
+TABLES = ('participants.tsv',)
+
+
+def read_table(path):
+    """Return (columns, {key: row dict}) of a TSV keyed on its first column"""
+    with open(path, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        columns = list(reader.fieldnames or [])
+        rows = {row[columns[0]]: row for row in reader} if columns else {}
+    return columns, rows
+
+
+def write_table(path, columns, rows):
+    """Write {key: row dict} sorted by key (through a temporary file)"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns, delimiter='\t', restval='n/a', extrasaction='ignore',
+                                lineterminator='\n')
+        writer.writeheader()
+        for key in sorted(rows):
+            writer.writerow(rows[key])
+    os.replace(tmp, path)
+
+
+def merge_table(src, dest):
+    """Merge the rows of the TSV src into dest
+
+    Rows of new keys are added (new columns too); a key present in both with a
+    different non-'n/a' value in a shared column is a conflict and leaves
+    dest unchanged.
+
+    Returns:
+        list: Conflicting keys
+    """
+    src_columns, src_rows = read_table(src)
+    if not os.path.exists(dest):
+        shutil.copy(src, dest)
+        return []
+    columns, rows = read_table(dest)
+    conflicts = []
+    for key, row in src_rows.items():
+        if key not in rows:
+            continue
+        for column in set(columns) & set(src_columns):
+            a, b = rows[key].get(column, 'n/a'), row.get(column, 'n/a')
+            if a != b and 'n/a' not in (a, b):
+                conflicts.append(key)
+                break
+    if conflicts:
+        return conflicts
+
+    columns += [c for c in src_columns if c not in columns]
+    for key, row in src_rows.items():
+        merged = rows.setdefault(key, {})
+        for column, value in row.items():
+            if merged.get(column, 'n/a') == 'n/a':
+                merged[column] = value
+    write_table(dest, columns, rows)
+    return []
+
+
+def _remove_empty_dirs(root):
+    for dirpath, _, _ in sorted(os.walk(root), key=lambda entry: -len(entry[0])):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+
+def merge_tree(src_root, dest_root):
+    """Move the files of src_root into dest_root
+
+    Returns:
+        tuple: (number of files moved, number of identical files dropped,
+                list of conflicting paths relative to src_root)
+    """
+    moved = identical = 0
+    conflicts = []
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            src = os.path.join(dirpath, name)
+            rel = os.path.relpath(src, src_root)
+            dest = os.path.join(dest_root, rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            if rel in TABLES:
+                keys = merge_table(src, dest)
+                if keys:
+                    conflicts.append(f"{rel} ({', '.join(keys)})")
+                else:
+                    os.remove(src)
+                    moved += 1
+            elif rel.split(os.sep)[0] in BOOKKEEPING_DIRS or not os.path.lexists(dest):
+                shutil.move(src, dest)
+                moved += 1
+            elif filecmp.cmp(src, dest, shallow=False):
+                os.remove(src)
+                identical += 1
+            else:
+                conflicts.append(rel)
+    _remove_empty_dirs(src_root)
+    return moved, identical, conflicts
+
+
+@contextlib.contextmanager
+def locked(lock_path):
+    """Hold an exclusive lock on lock_path (flock, shared by all processes of a study)"""
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def publish_tree(src, dest):
+    """Move the directory src to dest, replacing dest, with one rename of the finished tree
+
+    On another file system src is first copied next to dest, so that dest
+    never holds a partial copy.
+    """
+    parent = os.path.dirname(dest)
+    os.makedirs(parent, exist_ok=True)
+    tmp = os.path.join(parent, f'.{os.path.basename(dest)}.{os.getpid()}.tmp')
+    try:
+        os.rename(src, tmp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copytree(src, tmp)
+        shutil.rmtree(src)
+    old = None
+    if os.path.exists(dest):
+        old = f'{tmp}.old'
+        os.rename(dest, old)
+    os.rename(tmp, dest)
+    if old:
+        shutil.rmtree(old)
+
+
+def publish_session(staging, rawdata, session_rel, lock_path):
+    """Publish one session converted into the BIDS root staging into rawdata
+
+    The session directory (sub-*/ses-*, or sub-* without sessions) is put in
+    place with publish_tree(). The other files heudiconv wrote (participants.tsv,
+    dataset_description.json, .heudiconv/, ...) are merged under the lock;
+    existing files that differ are kept.
+
+    Returns:
+        list: Paths (relative to rawdata) of existing files kept instead of the staged ones
+    """
+    publish_tree(os.path.join(staging, session_rel), os.path.join(rawdata, session_rel))
+    with locked(lock_path):
+        _, _, kept = merge_tree(staging, rawdata)
+    return kept
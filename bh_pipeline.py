@@ -0,0 +1,1347 @@
+# Stages of the batch-heudiconv workflow (prep, sort, subjlist, heuristic, bids,
+# fix-intendedfor, reorganize-fmaps), run in one process by batch-heudiconv.
+# A Study object carries what one stage learns (subject list, series indexes)
+# to the next, so an end-to-end run does not rescan the sorted DICOM tree or
+# re-read the subject list. Each stage returns an exit code like the former
+# bh0X shell scripts. pipeline() runs the same work as per-session tasks of a
+# dependency graph (see bh_dag.py).
+
+import os
+import stat
+import time
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+from bh_series_index import read_index, write_index
+from bh_pixel_integrity import damaged_series
+from bh_file_types import write_skip_report
+from bh_study import (Session, read_subjlist, write_subjlist, subjlist_path, parse_directory_name,
+                      session_labels, uses_session, bids_session_dir, sorted_dir)
+
+# Directory of the batch-heudiconv scripts (the templates are in code/)
+BATCHPATH = os.path.dirname(os.path.realpath(__file__))
+
+STUDY_DIRS = [
+    'DICOM/original',
+    'DICOM/sorted',
+    'DICOM/converted',
+    'bids/derivatives',
+    'bids/rawdata',
+    'tmp',
+    'code',
+]
+
+
+class Study:
+    """A study workspace and the state loaded from it during one run"""
+
+    def __init__(self, study_name, rawdata=None, pregrouped=False, heuristic=None):
+        self.name = study_name.rstrip('/')
+        # BIDS root conversions write to (a private directory when sharded)
+        self.rawdata = rawdata or self.path('bids', 'rawdata')
+        # Whether heudiconv takes its series grouping from the series indexes (see bh_pregrouped.py)
+        self.pregrouped = pregrouped
+        # Heuristic file other than code/heuristic_<study_name>.py (bh_convert_double_echo.py -f)
+        self._heuristic = heuristic
+        self._subjlist = None
+        self._indexes = {}
+
+    def path(self, *parts):
+        return os.path.join(self.name, *parts)
+
+    @property
+    def heuristic_file(self):
+        return self._heuristic or self.path('code', f'heuristic_{self.name}.py')
+
+    @property
+    def heudiconv_heuristic(self):
+        """Heuristic file given to heudiconv (the pregrouped wrapper of heuristic_file if pregrouped)"""
+        if self.pregrouped:
+            from bh_pregrouped import pregrouped_heuristic_file
+            return pregrouped_heuristic_file(self.name)
+        return self.heuristic_file
+
+    def subjlist(self):
+        """Return (pattern, sessions) of the subject list, reading the file once"""
+        if self._subjlist is None:
+            self._subjlist = read_subjlist(self.name)
+        return self._subjlist
+
+    def set_subjlist(self, pattern, sessions):
+        self._subjlist = (pattern, sessions)
+
+    def index(self, directory):
+        """Return the series index of a sorted directory, reading the file once"""
+        if directory not in self._indexes:
+            self._indexes[directory] = read_index(self.path('DICOM', 'sorted', directory))
+        return self._indexes[directory]
+
+    def set_index(self, directory, index):
+        self._indexes[directory] = index
+
+    def forget_sorted(self):
+        """Drop the series indexes (the sorted directories were moved away)"""
+        self._indexes = {}
+
+    def sorted_directories(self):
+        sorted_root = self.path('DICOM', 'sorted')
+        return sorted(d for d in os.listdir(sorted_root)
+                      if os.path.isdir(os.path.join(sorted_root, d)))
+
+
+def _write_pregrouped_heuristic(study):
+    """Write the heuristic wrapper heudiconv is run with when pregrouped"""
+    if study.pregrouped:
+        from bh_pregrouped import write_pregrouped_heuristic
+
+        path = write_pregrouped_heuristic(study.name, study.heuristic_file)
+        print(f"Grouping series from the series indexes: {os.path.relpath(path, study.name)}")
+
+
+def _missing_study(study):
+    if os.path.isdir(study.name):
+        return False
+    print(f"Error: Study directory '{study.name}' does not exist")
+    print(f"Please run: bh01_prep_dir.sh {study.name}")
+    return True
+
+
+def prep(study):
+    """Create the study workspace and copy the template heuristics into code/"""
+    for d in STUDY_DIRS:
+        os.makedirs(study.path(d), exist_ok=True)
+
+    templates = os.path.join(BATCHPATH, 'code')
+    if os.path.isdir(templates):
+        for name in os.listdir(templates):
+            src = os.path.join(templates, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, study.path('code', name), dirs_exist_ok=True)
+            else:
+                shutil.copy(src, study.path('code', name))
+    else:
+        print(f"Warning: No template heuristics found in {templates}")
+
+    print(f"Directory structure for study '{study.name}' has been prepared:")
+    print("")
+    print("Next steps:")
+    print(f"1. Copy your DICOM files to: {study.name}/DICOM/original/")
+    print(f"2. Run: bh02_sort_dicom.sh {study.name}")
+    print("")
+    print("Directory structure created:")
+    print(f"  {study.name}/")
+    print("  ├── DICOM/")
+    print("  │   ├── original/    # Place your original DICOM files here")
+    print("  │   ├── sorted/      # Sorted DICOM files will be stored here")
+    print("  │   └── converted/   # Backup of processed DICOM files")
+    print("  ├── bids/")
+    print("  │   ├── rawdata/     # BIDS-formatted output will be stored here")
+    print("  │   └── derivatives/ # Processed data location")
+    print("  ├── code/            # Heuristic files for this study")
+    print("  └── tmp/             # Working files")
+    return 0
+
+
+def _replace_spaces(root):
+    """Replace spaces with underscores in names below root (deepest first)"""
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for name in dirnames + filenames:
+            if ' ' in name:
+                new_name = name.replace(' ', '_').replace('__', '_')
+                os.rename(os.path.join(dirpath, name), os.path.join(dirpath, new_name))
+
+
+def original_directories(study):
+    original_root = study.path('DICOM', 'original')
+    if not os.path.isdir(original_root):
+        return []
+    return sorted(d for d in os.listdir(original_root)
+                  if os.path.isdir(os.path.join(original_root, d)))
+
+
+def _missing_original(study):
+    if original_directories(study):
+        return False
+    print("Error: No directories found in DICOM/original/")
+    print("Please copy DICOM directories to DICOM/original/ first")
+    print("")
+    print("Expected structure:")
+    print(f"  {study.name}/DICOM/original/")
+    print("  ├── subject_01/")
+    print("  ├── subject_02/")
+    print("  └── ...")
+    return True
+
+
+def sort_directory(study_name, directory, split_fieldmaps=False, fieldmap_pattern='field', verify=None,
+                   io_jobs=1, dicomdir=False, series_key='name'):
+    """Sort DICOM/original/<directory> into DICOM/sorted/<directory>; returns its series index
+
+    verify ('length' or 'decode') checks the pixel data of the copied files (see bh_pixel_integrity.py).
+    io_jobs > 1 keeps that many file reads and writes in flight (see bh_sort_io.py).
+    With dicomdir, instances listed in a DICOMDIR are sorted from its records (see bh_dicomdir.py).
+    series_key 'uid' gives each SeriesInstanceUID its own series directory.
+    Files that are not imaging DICOM are listed in tmp/sort_skipped/<directory>.tsv.
+    """
+    # pydicom is only needed (and imported) for sorting
+    from bh_dcm_sort_uid import copy_dicom_files
+
+    print(f"Processing directory: {directory}")
+    skipped = []
+    index = copy_dicom_files(os.path.join(study_name, 'DICOM', 'original', directory),
+                             os.path.join(study_name, 'DICOM', 'sorted'),
+                             split_fieldmaps=split_fieldmaps, fieldmap_pattern=fieldmap_pattern,
+                             verify=verify, io_jobs=io_jobs, skipped=skipped, dicomdir=dicomdir,
+                             series_key=series_key)
+    write_skip_report(skip_report_path(study_name, directory), skipped)
+    print(f"  Sorted subject: {directory}")
+    return index
+
+
+def _move_sorted(sorted_root, src, dest, index):
+    """Rename a sorted directory, merging it into dest if that exists; returns the series index of dest"""
+    src_path = os.path.join(sorted_root, src)
+    dest_path = os.path.join(sorted_root, dest)
+    if not os.path.isdir(src_path):
+        return read_index(dest_path)
+    if not os.path.isdir(dest_path):
+        os.rename(src_path, dest_path)
+        return index
+    for series in os.listdir(src_path):
+        if not os.path.isdir(os.path.join(src_path, series)):
+            continue
+        os.makedirs(os.path.join(dest_path, series), exist_ok=True)
+        for name in os.listdir(os.path.join(src_path, series)):
+            os.replace(os.path.join(src_path, series, name), os.path.join(dest_path, series, name))
+    shutil.rmtree(src_path)
+    return write_index(dest_path, index)
+
+
+def _sort_studies(study, directories, pattern, sessions_from, split_fieldmaps=False, fieldmap_pattern='field',
+                  verify=None, io_jobs=1, dicomdir=False, series_key='name'):
+    """Sort each study (StudyInstanceUID) into DICOM/sorted/<subject>_<session>
+
+    The subject is taken from the original directory name (its {subject} part
+    under pattern); the session labels follow from the StudyDate/StudyTime of
+    all studies of the subject (see bh_study.session_labels).
+
+    Returns:
+        list: Session of each sorted directory
+    """
+    from bh_dcm_sort_uid import copy_dicom_studies
+
+    sorted_root = study.path('DICOM', 'sorted')
+    # {subject: {StudyInstanceUID: [study sorted from one original directory, ...]}}
+    subjects = {}
+    for d in directories:
+        session = parse_directory_name(d, pattern)
+        subject = session.subject if session else d
+        print(f"Processing directory: {d}")
+        skipped = []
+        found = copy_dicom_studies(study.path('DICOM', 'original', d), sorted_root,
+                                   split_fieldmaps=split_fieldmaps, fieldmap_pattern=fieldmap_pattern,
+                                   verify=verify, io_jobs=io_jobs, skipped=skipped, dicomdir=dicomdir,
+                                   series_key=series_key)
+        write_skip_report(skip_report_path(study.name, d), skipped)
+        for study_uid, s in found.items():
+            subjects.setdefault(subject, {}).setdefault(study_uid, []).append(s)
+
+    sessions = []
+    for subject, studies in sorted(subjects.items()):
+        labels = session_labels([(uid, parts[0]['study_date'], parts[0]['study_time'])
+                                 for uid, parts in studies.items()], sessions_from)
+        for study_uid, parts in studies.items():
+            directory = f'{subject}_{labels[study_uid]}'
+            for s in parts:
+                study.set_index(directory, _move_sorted(sorted_root, s['directory'], directory, s['index']))
+            print(f"  Sorted study {parts[0]['study_date'] or '(no date)'} of {subject} into: {directory}")
+            sessions.append(Session(directory, subject, labels[study_uid]))
+    return sorted(sessions)
+
+
+def skip_report_path(study_name, directory):
+    return os.path.join(study_name, 'tmp', 'sort_skipped', f'{directory}.tsv')
+
+
+def _report_skipped(study, directories):
+    """Print how many files of the original directories sorting skipped (see tmp/sort_skipped/)"""
+    n_skipped = 0
+    for d in directories:
+        path = skip_report_path(study.name, d)
+        if os.path.exists(path):
+            with open(path) as f:
+                n_skipped += sum(1 for _ in f) - 1
+    if n_skipped:
+        print(f"Skipped {n_skipped} files that are not imaging DICOM (see tmp/sort_skipped/)")
+        print("")
+
+
+def _report_integrity(study, directories):
+    """Write tmp/pixel_integrity_<study>.tsv for the sorted directories and print a summary"""
+    from bh_pixel_integrity import write_report
+
+    os.makedirs(study.path('tmp'), exist_ok=True)
+    report = study.path('tmp', f'pixel_integrity_{study.name}.tsv')
+    n_damaged = write_report(report, {d: study.index(d) for d in directories})
+    if n_damaged:
+        print(f"Warning: {n_damaged} series with damaged pixel data (see tmp/{os.path.basename(report)}); "
+              "re-transfer them before converting")
+    else:
+        print(f"Pixel data checked: no damaged series (tmp/{os.path.basename(report)})")
+    print("")
+
+
+def sort(study, split_fieldmaps=False, fieldmap_pattern='field', pattern=None, sessions_from=None, verify=None,
+         io_jobs=1, dicomdir=False, series_key='name'):
+    """Sort DICOM/original/<dir> into DICOM/sorted/<dir>/<series> and keep the series indexes
+
+    With a pattern, the subject list of the sorted directories is written as
+    well. With sessions_from ('order' or 'date'), the studies of each subject
+    are sorted into DICOM/sorted/<subject>_<session> and the subject list uses
+    '{subject}_{session}'. With verify, the pixel data of the copied files is
+    checked and the damaged series are listed in tmp/pixel_integrity_<study>.tsv.
+    io_jobs > 1 overlaps the file I/O of sorting (for network storage). With
+    dicomdir, media exports are sorted from the records of their DICOMDIR.
+    series_key 'uid' keys the series directories on SeriesInstanceUID.
+    """
+    if _missing_study(study) or _missing_original(study):
+        return 1
+
+    print("Cleaning up filenames (replacing spaces with underscores)...")
+    _replace_spaces(study.path('DICOM', 'original'))
+
+    print("Sorting DICOM files by series...")
+    directories = original_directories(study)
+    if sessions_from:
+        sessions = _sort_studies(study, directories, pattern or '{subject}', sessions_from,
+                                 split_fieldmaps, fieldmap_pattern, verify, io_jobs, dicomdir, series_key)
+        pattern = '{subject}_{session}'
+        sorted_dirs = [s.directory for s in sessions]
+    else:
+        for d in directories:
+            study.set_index(d, sort_directory(study.name, d, split_fieldmaps, fieldmap_pattern, verify, io_jobs,
+                                              dicomdir, series_key))
+        sessions = [s for s in (parse_directory_name(d, pattern) for d in directories) if s] if pattern else []
+        sorted_dirs = directories
+
+    print("")
+    print("DICOM sorting completed successfully!")
+    print("")
+    _report_skipped(study, directories)
+    if verify:
+        _report_integrity(study, sorted_dirs)
+    if pattern:
+        if not sessions:
+            print(f"Error: No matching directories found with pattern: {pattern}")
+            return 1
+        os.makedirs(study.path('tmp'), exist_ok=True)
+        write_subjlist(study.name, pattern, sessions)
+        study.set_subjlist(pattern, sessions)
+        print(f"Subject list created: tmp/subjlist_{study.name}.tsv ({len(sessions)} sessions, "
+              f"pattern: {pattern})")
+        print("")
+        print("Next steps:")
+        print(f"1. Generate heuristic: bh04_make_heuristic.sh {study.name}")
+        print(f"2. Review sorted structure in: {study.name}/DICOM/sorted/")
+        return 0
+
+    print("Next steps:")
+    print(f"1. Create subject list: bh03_make_subjlist.sh {study.name} '<pattern>'")
+    print("")
+    print("   <pattern> should be one of the following:")
+    print("   '{subject}_{session}'  - for directories like 'sub001_ses01'")
+    print("   '{subject}-{session}'  - for directories like 'sub001-ses01'")
+    print("   '{subject}'           - for directories like 'sub001' (single session)")
+    print("")
+    print(f"   Example: bh03_make_subjlist.sh {study.name} '{{subject}}_{{session}}'")
+    print("")
+    print(f"2. Review sorted structure in: {study.name}/DICOM/sorted/")
+    print("")
+    print("File locations:")
+    print("  - Original files: DICOM/original/ (preserved)")
+    print("  - Sorted files:   DICOM/sorted/ (ready for conversion)")
+    return 0
+
+
+def subjlist(study, pattern):
+    """Write tmp/subjlist_<study>.tsv from the sorted directory names"""
+    if _missing_study(study):
+        return 1
+    if not os.path.isdir(study.path('DICOM', 'sorted')):
+        print("Error: DICOM/sorted directory not found")
+        print(f"Please run: bh02_sort_dicom.sh {study.name}")
+        return 1
+    os.makedirs(study.path('tmp'), exist_ok=True)
+
+    directories = study.sorted_directories()
+    sessions = [s for s in (parse_directory_name(d, pattern) for d in directories) if s]
+    if not sessions:
+        print(f"Error: No matching directories found with pattern: {pattern}")
+        print("")
+        print("Available directories in DICOM/sorted/:")
+        for d in directories:
+            print(d)
+        print("")
+        print("Common patterns:")
+        print("  - If directories are like 'sub001_ses01': use '{subject}_{session}'")
+        print("  - If directories are like 'sub001': use '{subject}'")
+        return 1
+
+    write_subjlist(study.name, pattern, sessions)
+    study.set_subjlist(pattern, sessions)
+
+    subjlist_file = os.path.relpath(subjlist_path(study.name), study.name)
+    print(f"Subject list created successfully: {subjlist_file}")
+    print("")
+    print("Content preview:")
+    with open(subjlist_path(study.name), 'r') as f:
+        print(f.read())
+    print(f"Study: {study.name}")
+    print(f"Pattern used: {pattern}")
+    print(f"Subjects found: {len(sessions)}")
+    print("")
+    if os.path.isfile(study.heuristic_file):
+        print(f"Next step: Convert to BIDS with: bh05_make_bids.sh {study.name}")
+        print(f"Note: Heuristic file already exists at: code/heuristic_{study.name}.py")
+    else:
+        print(f"Next step: Create heuristic file with: bh04_make_heuristic.sh {study.name}")
+    return 0
+
+
+def heuristic(study, rules=False):
+    """Generate code/heuristic_<study>.py (or a rule table and its loader) from the sorted series"""
+    from bh_make_heuristic import scan_series, render_heuristic, render_rules, render_rules_loader
+
+    if not os.path.isdir(study.path('DICOM', 'sorted')):
+        print(f"Error: Study '{study.name}' - sorted DICOM directory not found")
+        print(f"Please run: bh02_sort_dicom.sh {study.name}")
+        return 1
+    try:
+        pattern, _ = study.subjlist()
+    except OSError:
+        print(f"Error: Study '{study.name}' - subject list not found")
+        print(f"Please run: bh03_make_subjlist.sh {study.name} '<pattern>'")
+        return 1
+    os.makedirs(study.path('code'), exist_ok=True)
+
+    print(f"Analyzing DICOM structure for study: {study.name}")
+    print("")
+    indexes = {d: study.index(d) for d in study.sorted_directories()}
+    series_list = scan_series(study.path('DICOM', 'sorted'), indexes)
+    if not series_list:
+        print("Error: No series found in DICOM/sorted/")
+        return 1
+
+    print(f"Found sequences in study '{study.name}':")
+    print("----------------------------------------")
+    for series_name, seq_type, dim4 in series_list:
+        print(f"{series_name:<30} -> {seq_type:<15} (volumes: {dim4})")
+    print("")
+
+    if rules:
+        rules_file = study.path('code', f'heuristic_{study.name}_rules.json')
+        print(f"Generating rule table: code/heuristic_{study.name}_rules.json")
+        with open(rules_file, 'w') as f:
+            f.write(render_rules(pattern, series_list))
+        with open(study.heuristic_file, 'w') as f:
+            f.write(render_rules_loader(study.name))
+        print("")
+        print("Rule table and heuristic file created successfully!")
+        print("")
+        print(f"Files: {rules_file}")
+        print(f"       {study.heuristic_file}")
+        print("")
+        print("Next steps:")
+        print(f"1. Review the rules in code/heuristic_{study.name}_rules.json")
+        print("   (fields: key, contains, excludes, regex, min_dim4, max_dim4, image_type)")
+        print(f"2. Run BIDS conversion: bh05_make_bids.sh {study.name}")
+        return 0
+
+    print(f"Generating heuristic file: code/heuristic_{study.name}.py")
+    with open(study.heuristic_file, 'w') as f:
+        f.write(render_heuristic(study.name, pattern, series_list))
+    print("")
+    print("Heuristic file created successfully!")
+    print("")
+    print(f"File: {study.heuristic_file}")
+    print("")
+    print("Next steps:")
+    print("1. Review the generated heuristic file")
+    print("2. Modify sequence matching rules if needed")
+    print(f"3. Run BIDS conversion: bh05_make_bids.sh {study.name}")
+    print("")
+    print("Note: The heuristic file may need manual adjustments for:")
+    print("  - Complex sequence naming patterns")
+    print("  - Multiple phase encoding directions")
+    print("  - Multi-echo sequences")
+    return 0
+
+
+def heudiconv_inputs(study, session):
+    """heudiconv arguments selecting the DICOM files of one session ([] if it has no sorted series)
+
+    The series directories of the session are passed with --files, so
+    heudiconv reads exactly this session instead of expanding a template over
+    DICOM/sorted (and does not see series_index.json). A session holding
+    several studies (StudyInstanceUIDs) is grouped as one (-g all). Pregrouped,
+    heudiconv groups with the heuristic's grouping function (-g custom).
+    """
+    root = sorted_dir(study.name, session)
+    if not os.path.isdir(root):
+        return []
+    with os.scandir(root) as entries:
+        series = sorted(entry.name for entry in entries if entry.is_dir())
+    if not series:
+        return []
+    args = ['--files'] + [os.path.join('DICOM', 'sorted', session.directory, name) for name in series]
+    if study.pregrouped:
+        args += ['-g', 'custom']
+    elif len({entry.get('study_uid') for entry in study.index(session.directory).values()}) > 1:
+        args += ['-g', 'all']
+    return args
+
+
+def heudiconv_env():
+    """Environment for heudiconv with the batch-heudiconv directory on PYTHONPATH
+
+    Heuristics import the bh_*.py modules shipped with the scripts (rule tables,
+    sidecar cache, pregrouped series) through this PYTHONPATH entry.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([BATCHPATH] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    return env
+
+
+def run_heudiconv(study, session, capture_output=False, heudiconv_args=()):
+    """Run heudiconv for one session (in the study directory); returns its exit code
+
+    With capture_output, the output of heudiconv is printed through sys.stdout
+    (so that it can be captured too) instead of going to the terminal directly.
+    heudiconv_args are added to its command line (e.g. --dcmconfig).
+    """
+    inputs = heudiconv_inputs(study, session)
+    if not inputs:
+        print(f"  Error: No sorted series in DICOM/sorted/{session.directory}")
+        return 1
+    cmd = ['heudiconv'] + inputs + [
+        '-o', os.path.relpath(study.rawdata, study.name),
+        '-f', os.path.relpath(study.heudiconv_heuristic, study.name),
+        '-s', session.subject,
+        '-ss', session.session,
+        '-c', 'dcm2niix', '-b', '--overwrite'] + list(heudiconv_args)
+    # Output is created world-readable (see fix_new_permissions())
+    if not capture_output:
+        return subprocess.run(cmd, cwd=study.name, env=heudiconv_env(), umask=0o022).returncode
+    result = subprocess.run(cmd, cwd=study.name, env=heudiconv_env(), umask=0o022,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True)
+    print(result.stdout, end='')
+    return result.returncode
+
+
+def convert_session(study, session, pattern, capture_output=False, heudiconv_args=()):
+    """heudiconv plus the direct conversion of split GE fieldmaps for one session
+
+    heudiconv_args are added to the heudiconv command line (see run_heudiconv()).
+
+    Returns:
+        bool: Whether heudiconv (and the fieldmap conversion) succeeded
+    """
+    from bh_dcm2niix import ConversionError
+    from bh_convert_ge_fieldmaps import split_fieldmap_series, convert_session as convert_ge_fieldmaps
+
+    print(f"  Using DICOM files: DICOM/sorted/{session.directory}/*/")
+    for name, problems in damaged_series(study.index(session.directory)).items():
+        print(f"  Warning: {name} has {len(problems)} files with damaged pixel data "
+              f"(e.g. {problems[0][0]}: {problems[0][1]})")
+    print("  Running heudiconv...")
+    ok = run_heudiconv(study, session, capture_output, heudiconv_args) == 0
+    if not ok:
+        print(f"  Warning: heudiconv reported an error for subject {session.subject} session {session.session}")
+        print("  Check the logs and heuristic file for issues")
+    else:
+        print(f"  ✓ Successfully processed subject {session.subject}")
+
+    # GE fieldmaps split by image component at sort time are converted directly
+    index = study.index(session.directory)
+    if split_fieldmap_series(index):
+        print("  Converting split GE fieldmaps...")
+        try:
+            convert_ge_fieldmaps(study.name, session, uses_session(pattern), index=index, rawdata=study.rawdata)
+        except ConversionError as e:
+            print(f"  Error: {e}")
+            ok = False
+    return ok
+
+
+def convert_session_staged(study, session, pattern, scratch, reorganize=False, keep_extra=False,
+                           capture_output=False):
+    """Convert one session in a scratch directory and publish it into the BIDS root of the study
+
+    heudiconv and the fieldmap fixups (IntendedFor, optionally the GE
+    fieldmap reorganization) work in a private BIDS root under scratch, so
+    their temporary files and rewrites stay off the shared file system. The
+    finished session directory is then moved into place in one step and the
+    top-level files (participants.tsv, ...) are merged under a lock. If
+    heudiconv fails, nothing is published and the scratch directory is removed.
+
+    Returns:
+        bool: Whether heudiconv succeeded
+    """
+    from bh_merge import publish_session
+
+    os.makedirs(scratch, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f'bh_{session.subject}_{session.session}_', dir=scratch)
+    try:
+        staged = Study(study.name, rawdata=staging, pregrouped=study.pregrouped)
+        staged.set_index(session.directory, study.index(session.directory))
+        print(f"  Staging in {staging}")
+        if not convert_session(staged, session, pattern, capture_output):
+            print(f"  Error: Conversion failed; nothing was published into {study.rawdata}")
+            return False
+        session_dir = postprocess_session(study.name, session, reorganize, keep_extra, rawdata=staging)
+        if session_dir is None:
+            return True
+        print(f"  Publishing {os.path.relpath(session_dir, staging)} into {study.rawdata}")
+        kept = publish_session(staging, study.rawdata, os.path.relpath(session_dir, staging),
+                               study.path('tmp', 'publish.lock'))
+        for path in kept:
+            print(f"  Note: Kept the existing {path} (the converted one differs)")
+        return True
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _set_mode(path, mode, st=None):
+    st = st or os.lstat(path)
+    if stat.S_ISLNK(st.st_mode) or stat.S_IMODE(st.st_mode) == mode:
+        return 0
+    os.chmod(path, mode)
+    return 1
+
+
+def set_permissions(path):
+    """Make the directories under path (and path itself) 755 and the files 644
+
+    Only entries whose mode differs are changed; symbolic links are left alone.
+
+    Returns:
+        int: Number of entries changed
+    """
+    changed = _set_mode(path, 0o755)
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(entry.path)
+                    changed += _set_mode(entry.path, 0o755, st)
+                else:
+                    changed += _set_mode(entry.path, 0o644, st)
+    return changed
+
+
+def fix_new_permissions(study, sessions, since, jobs=8):
+    """Set the permissions of the output of this run in the BIDS root of the study
+
+    heudiconv makes the converted files read-only, so the session (and
+    .heudiconv) directories of the converted sessions are fixed, in parallel,
+    along with top-level entries changed since the run started (participants.tsv,
+    ...). The rest of the dataset is not visited, so the cost follows the
+    size of the new output.
+
+    Args:
+        sessions: Sessions converted in this run
+        since: Start time of the run (time.time())
+
+    Returns:
+        int: Number of entries changed
+    """
+    if not os.path.isdir(study.rawdata):
+        return 0
+    directories = set()
+    for session in sessions:
+        for with_session in (True, False):
+            session_dir, _ = bids_session_dir(study.name, session, with_session, study.rawdata)
+            if os.path.isdir(session_dir):
+                directories.add(session_dir)
+                break
+        directories.add(os.path.join(study.rawdata, '.heudiconv', session.subject))
+
+    # Allow for file systems with coarse time stamps
+    since -= 1
+    changed = _set_mode(study.rawdata, 0o755)
+    with os.scandir(study.rawdata) as entries:
+        for entry in entries:
+            st = entry.stat(follow_symlinks=False)
+            if st.st_ctime >= since:
+                changed += _set_mode(entry.path, 0o755 if stat.S_ISDIR(st.st_mode) else 0o644, st)
+
+    directories = sorted(d for d in directories if os.path.isdir(d))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        changed += sum(executor.map(set_permissions, directories))
+    return changed
+
+
+def backup_dicom(study):
+    """Move DICOM/sorted and DICOM/original to DICOM/converted and recreate them empty
+
+    A backup from an earlier conversion is kept: the new one gets a time stamp.
+    """
+    converted = study.path('DICOM', 'converted')
+    os.makedirs(converted, exist_ok=True)
+    for name in ('sorted', 'original'):
+        if os.path.isdir(study.path('DICOM', name)):
+            dest = os.path.join(converted, name)
+            if os.path.exists(dest):
+                dest = f"{dest}_{time.strftime('%Y%m%d_%H%M%S')}"
+            shutil.move(study.path('DICOM', name), dest)
+        os.makedirs(study.path('DICOM', name), exist_ok=True)
+    study.forget_sorted()
+
+
+def _finish_conversion(study, sessions, pattern, started, ok, title='BIDS conversion'):
+    """Fix the permissions of the new output, then back up the DICOM files if every session converted"""
+    print("Setting file permissions...")
+    fix_new_permissions(study, sessions, started)
+    if not ok:
+        print("Error: Some conversions failed; DICOM files were not backed up")
+        return 1
+    print("Backing up DICOM files...")
+    backup_dicom(study)
+
+    print("")
+    print("============================================")
+    print(f"{title} completed for study: {study.name}")
+    print("============================================")
+    print("")
+    print("Results:")
+    print(f"  - BIDS dataset: {study.name}/bids/rawdata/")
+    print(f"  - Subjects processed: {len(sessions)}")
+    print(f"  - Pattern used: {pattern}")
+    print(f"  - DICOM backup: {study.name}/DICOM/converted/")
+    print("")
+    print("Next steps:")
+    print("1. Validate BIDS dataset: https://bids-standard.github.io/bids-validator/")
+    print("2. Review conversion logs for any warnings")
+    print("3. Check dataset_description.json and README files")
+    print("")
+    print("Optional post-processing:")
+    print(f"  - Fix IntendedFor fields: bh_fix_intendedfor.py {study.name}")
+    print(f"  - Reorganize GE fieldmaps: bh_reorganize_fieldmaps.py {study.name}")
+    return 0
+
+
+def bids(study, jobs=1, memory_budget=None, cpu_budget=None, cpus_per_job=1, scratch=None):
+    """Convert every session of the subject list with heudiconv, then back up the DICOM files
+
+    With jobs > 1, sessions are converted concurrently: each is admitted when
+    its estimated peak memory and CPUs fit in the budgets (default: 75% of
+    the physical memory and all available CPUs), largest sessions first.
+    With scratch, each session is converted and fixed up in a scratch
+    directory and then published (see convert_session_staged()).
+    """
+    if _missing_study(study):
+        return 1
+    try:
+        pattern, sessions = study.subjlist()
+    except OSError:
+        print(f"Error: Subject list not found: tmp/subjlist_{study.name}.tsv")
+        print(f"Please run: bh03_make_subjlist.sh {study.name} '<pattern>'")
+        return 1
+    if not os.path.isfile(study.heuristic_file):
+        print(f"Error: Heuristic file not found: code/heuristic_{study.name}.py")
+        print(f"This file defines how DICOM sequences in '{study.name}' should be converted to BIDS")
+        print(f"Please run: bh04_make_heuristic.sh {study.name}")
+        return 1
+    if not os.path.isdir(study.path('DICOM', 'sorted')):
+        print("Error: Sorted DICOM directory not found")
+        print(f"Please run: bh02_sort_dicom.sh {study.name}")
+        return 1
+
+    print(f"Pattern detected from subject list: {pattern}")
+    shutil.rmtree(study.path('bids', '.heudiconv'), ignore_errors=True)
+
+    print(f"Starting BIDS conversion for study: {study.name}")
+    print(f"Using heuristic: code/heuristic_{study.name}.py")
+    _write_pregrouped_heuristic(study)
+    print(f"Using pattern: {pattern}")
+    print("")
+
+    started = time.time()
+    if jobs > 1:
+        ok = _convert_concurrently(study, sessions, pattern, jobs, memory_budget, cpu_budget, cpus_per_job,
+                                   scratch)
+    else:
+        ok = True
+        for i, session in enumerate(sessions, start=1):
+            print(f"[{i}/{len(sessions)}] Processing: Subject={session.subject} Session={session.session} "
+                  f"(Directory: {session.directory})")
+            if scratch:
+                ok = convert_session_staged(study, session, pattern, scratch) and ok
+            else:
+                ok = convert_session(study, session, pattern) and ok
+            print("")
+
+    return _finish_conversion(study, sessions, pattern, started, ok)
+
+
+# code/merge.json: dcm2niix configuration (heudiconv --dcmconfig) merging the echoes of a series
+MERGE_CONFIG = '{\n"merge_imgs": true\n}\n'
+
+
+def _merge_config(study):
+    """code/merge.json (dcm2niix merges the echoes of each series), created if missing"""
+    path = study.path('code', 'merge.json')
+    if not os.path.isfile(path):
+        print("Creating merge.json for double-echo fieldmap processing...")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(MERGE_CONFIG)
+        print("Created code/merge.json")
+    return path
+
+
+def _load_magnitude_heuristic(study, sessions, magnitude_heuristic):
+    """Import the magnitude heuristic once the series indexes it relies on are found; None on error"""
+    from bh_series_index import index_path
+    from bh_simulate_heuristic import load_heuristic
+
+    missing = [session.directory for session in sessions
+               if not os.path.isfile(index_path(sorted_dir(study.name, session)))]
+    if missing:
+        print(f"Error: Series index not found in DICOM/sorted/{missing[0]}"
+              + (f" (and {len(missing) - 1} more sessions)" if len(missing) > 1 else ""))
+        print("The magnitude series are converted from the series indexes written by the sorter")
+        print(f"Please run: bh02_sort_dicom.sh {study.name}")
+        return None
+    try:
+        return load_heuristic(magnitude_heuristic)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return None
+
+
+def bids_double_echo(study, fieldmap_pattern='field', magnitude_heuristic=None):
+    """Convert every session like bids(), merging the echoes of double-echo fieldmaps
+
+    Sessions with a magnitude fieldmap series holding two or more echo times
+    (see bh_detect_double_echo.py) are converted with code/merge.json, the
+    others with the standard settings.
+
+    With a magnitude heuristic (default: code/heuristic_<study_name>_magnitude.py
+    if it exists), heudiconv converts everything else in one run per session
+    and the magnitude series it selects are converted with dcm2niix merging
+    their echoes (see bh_convert_double_echo.py); this needs the series indexes.
+    """
+    from bh_detect_double_echo import has_double_echo_fieldmap
+
+    if _missing_study(study):
+        return 1
+    inputs = _check_conversion_inputs(study)
+    if inputs is None:
+        return 1
+    pattern, sessions = inputs
+    default_magnitude = study.path('code', f'heuristic_{study.name}_magnitude.py')
+    if magnitude_heuristic is None and os.path.isfile(default_magnitude):
+        magnitude_heuristic = default_magnitude
+    if magnitude_heuristic:
+        from bh_convert_double_echo import convert_magnitude
+
+        magnitude = _load_magnitude_heuristic(study, sessions, magnitude_heuristic)
+        if magnitude is None:
+            return 1
+    else:
+        merge_config = os.path.relpath(_merge_config(study), study.name)
+
+    print(f"Pattern detected from subject list: {pattern}")
+    shutil.rmtree(study.path('bids', '.heudiconv'), ignore_errors=True)
+
+    print(f"Starting BIDS conversion with double-echo fieldmap handling for study: {study.name}")
+    print(f"Using heuristic: {os.path.relpath(study.heuristic_file, study.name)}")
+    if magnitude_heuristic:
+        print(f"Using magnitude heuristic: {os.path.relpath(magnitude_heuristic, study.name)} "
+              "(echoes merged by dcm2niix)")
+    _write_pregrouped_heuristic(study)
+    print(f"Using pattern: {pattern}")
+    print("")
+
+    if not magnitude_heuristic:
+        print("Detecting double-echo fieldmaps from DICOM headers...")
+        double_echo = {session.directory for session in sessions
+                       if os.path.isdir(sorted_dir(study.name, session))
+                       and has_double_echo_fieldmap(sorted_dir(study.name, session), fieldmap_pattern)}
+        print(f"  Sessions with double-echo fieldmaps: {len(double_echo)} of {len(sessions)}")
+        print("")
+
+    started = time.time()
+    ok = True
+    for i, session in enumerate(sessions, start=1):
+        print(f"[{i}/{len(sessions)}] Processing: Subject={session.subject} Session={session.session} "
+              f"(Directory: {session.directory})")
+        if magnitude_heuristic:
+            session_ok = convert_session(study, session, pattern)
+            if session_ok:
+                print("  Converting magnitude fieldmaps (merging echoes)...")
+                session_ok = convert_magnitude(study, session, magnitude)
+        else:
+            if session.directory in double_echo:
+                print(f"  ✓ Detected double-echo fieldmap for {session.subject}_{session.session} "
+                      f"(using {merge_config})")
+                heudiconv_args = ['--dcmconfig', merge_config]
+            else:
+                print(f"  No double-echo fieldmap for {session.subject}_{session.session} (standard conversion)")
+                heudiconv_args = []
+            session_ok = convert_session(study, session, pattern, heudiconv_args=heudiconv_args)
+        ok = session_ok and ok
+        print("")
+    return _finish_conversion(study, sessions, pattern, started, ok, 'Double-echo fieldmap BIDS conversion')
+
+
+def permissions(study, since=0):
+    """Set the permissions of the sessions in the subject list (e.g. after running heudiconv by hand)
+
+    Top-level entries of bids/rawdata are fixed if changed after since (seconds since the epoch).
+    """
+    if _missing_study(study):
+        return 1
+    try:
+        _, sessions = study.subjlist()
+    except OSError:
+        print(f"Error: Subject list not found: tmp/subjlist_{study.name}.tsv")
+        print(f"Please run: bh03_make_subjlist.sh {study.name} '<pattern>'")
+        return 1
+    changed = fix_new_permissions(study, sessions, since)
+    print(f"Permissions set on {changed} files and directories")
+    return 0
+
+
+def fix_intendedfor(study, sidecar_cache=None):
+    import bh_fix_intendedfor
+
+    argv = [study.name] + (['--sidecar-cache', sidecar_cache] if sidecar_cache else [])
+    return bh_fix_intendedfor.main(argv)
+
+
+def reorganize_fmaps(study, keep_extra=False, jobs=1, dry_run=False, sidecar_cache=None):
+    import bh_reorganize_fieldmaps
+
+    argv = [study.name, '--jobs', str(jobs)]
+    argv += ['--keep-extra'] if keep_extra else []
+    argv += ['--dry-run'] if dry_run else []
+    argv += ['--sidecar-cache', sidecar_cache] if sidecar_cache else []
+    return bh_reorganize_fieldmaps.main(argv)
+
+
+def _heuristic_task(study_name, rules):
+    if heuristic(Study(study_name), rules) != 0:
+        raise RuntimeError('heuristic generation failed')
+
+
+def _convert_task(study_name, session, pattern, index, rawdata=None, scratch=None, reorganize=False,
+                  keep_extra=False, pregrouped=False):
+    study = Study(study_name, rawdata, pregrouped)
+    study.set_index(session.directory, index)
+    if scratch:
+        ok = convert_session_staged(study, session, pattern, scratch, reorganize, keep_extra, capture_output=True)
+    else:
+        ok = convert_session(study, session, pattern, capture_output=True)
+    if not ok:
+        raise RuntimeError(f'heudiconv failed for {session.subject}/{session.session}')
+
+
+def _conversion_task(study, session, pattern, cpus_per_job=1, deps=(), scratch=None, reorganize=False,
+                     keep_extra=False):
+    """Task converting one session, with its cost and resources estimated from the sorted files
+
+    The estimate is made when the task is ready, i.e. after the session was sorted.
+    With scratch, the session is also post-processed before it is published.
+    """
+    from bh_dag import Task
+    from bh_resources import estimate_session
+
+    estimate = None
+
+    def get_estimate():
+        nonlocal estimate
+        if estimate is None:
+            estimate = estimate_session(sorted_dir(study.name, session), cpus=cpus_per_job)
+        return estimate
+
+    return Task(f'convert {session.subject}/{session.session}', 'convert', _convert_task,
+                lambda: (study.name, session, pattern, study.index(session.directory), study.rawdata,
+                         scratch, reorganize, keep_extra, study.pregrouped),
+                deps=deps, cost=lambda: get_estimate().cost,
+                resources=lambda: {'memory': get_estimate().memory_mb, 'cpus': get_estimate().cpus})
+
+
+def _budgets(memory_budget=None, cpu_budget=None):
+    from bh_resources import default_memory_budget_mb, default_cpu_budget
+
+    return {'memory': memory_budget or default_memory_budget_mb(),
+            'cpus': cpu_budget or default_cpu_budget()}
+
+
+def _convert_concurrently(study, sessions, pattern, jobs, memory_budget=None, cpu_budget=None,
+                          cpus_per_job=1, scratch=None):
+    """Convert sessions in parallel under the memory and CPU budgets; returns whether all finished"""
+    from bh_dag import run_graph, DONE
+
+    budgets = _budgets(memory_budget, cpu_budget)
+    print(f"Converting up to {jobs} sessions at once "
+          f"(memory budget: {budgets['memory'] or 'unlimited'} MB, CPU budget: {budgets['cpus']})")
+    tasks = []
+    for session in sessions:
+        task = _conversion_task(study, session, pattern, cpus_per_job, scratch=scratch)
+        task.prepare()
+        print(f"  {session.subject}/{session.session}: estimated peak memory {task.resources['memory']} MB, "
+              f"relative cost {task.cost:.0f}")
+        tasks.append(task)
+    print("")
+    status = run_graph(tasks, {'convert': jobs}, budgets=budgets)
+    print("")
+    return all(state == DONE for state in status.values())
+
+
+def postprocess_session(study_name, session, reorganize=False, keep_extra=False, rawdata=None):
+    """Fix IntendedFor (and reorganize GE fieldmaps) of one converted session
+
+    Returns:
+        str: The session directory, or None if the session has no BIDS output
+    """
+    from bh_fix_intendedfor import fix_session
+    from bh_reorganize_fieldmaps import process_session
+    from bh_sidecar_cache import get_cache
+
+    # Follow the layout heudiconv produced (with or without ses-*)
+    session_dir, prefix = bids_session_dir(study_name, session, True, rawdata)
+    if not os.path.isdir(session_dir):
+        session_dir, prefix = bids_session_dir(study_name, session, False, rawdata)
+    if not os.path.isdir(session_dir):
+        print(f"  No BIDS output for {session.subject}/{session.session}, skipping...")
+        return None
+
+    fix_session(session_dir, get_cache())
+    if reorganize:
+        process_session(session_dir, os.path.join(session_dir, f'{prefix}_scans.tsv'), keep_extra)
+    # Runs in a worker process, which does not save the cache when it exits
+    get_cache().save()
+    set_permissions(session_dir)
+    return session_dir
+
+
+def pipeline(study, pattern, jobs=2, convert_jobs=1, split_fieldmaps=False, fieldmap_pattern='field',
+             rules=False, new_heuristic=False, reorganize=False, keep_extra=False,
+             memory_budget=None, cpu_budget=None, cpus_per_job=1, scratch=None, verify=None, io_jobs=1,
+             dicomdir=False, series_key='name'):
+    """Sort, convert and post-process each session as soon as its previous stage is done
+
+    Each original directory becomes a chain of tasks sort -> convert -> post,
+    so one session can be converting while another is still being sorted.
+    When the heuristic has to be generated, conversions wait for all sorts
+    (the heuristic is built from all sorted series). Conversions are admitted
+    under memory and CPU budgets, largest ready session first (see bids()).
+    With scratch, sessions are post-processed in the scratch directory as part
+    of their conversion and then published (see convert_session_staged()).
+    With verify, sorting checks the pixel data; io_jobs is per sort task (see sort()).
+    With dicomdir, media exports are sorted from the records of their DICOMDIR;
+    series_key is passed on to sorting (see sort()).
+    The DICOM files are backed up only if every task succeeded.
+    """
+    from bh_dag import Task, run_graph, DONE
+
+    if _missing_study(study) or _missing_original(study):
+        return 1
+
+    print("Cleaning up filenames (replacing spaces with underscores)...")
+    _replace_spaces(study.path('DICOM', 'original'))
+    directories = original_directories(study)
+
+    # Sorted directories are named after the original ones, so the subject
+    # list is known before sorting
+    sessions = [s for s in (parse_directory_name(d, pattern) for d in directories) if s]
+    if not sessions:
+        print(f"Error: No matching directories found with pattern: {pattern}")
+        return 1
+    os.makedirs(study.path('tmp'), exist_ok=True)
+    write_subjlist(study.name, pattern, sessions)
+    study.set_subjlist(pattern, sessions)
+    print(f"Subject list created: tmp/subjlist_{study.name}.tsv ({len(sessions)} sessions)")
+    _write_pregrouped_heuristic(study)
+    shutil.rmtree(study.path('bids', '.heudiconv'), ignore_errors=True)
+
+    tasks = []
+    for session in sessions:
+        tasks.append(Task(f'sort {session.directory}', 'sort', sort_directory,
+                          (study.name, session.directory, split_fieldmaps, fieldmap_pattern, verify, io_jobs,
+                           dicomdir, series_key),
+                          on_done=lambda index, d=session.directory: study.set_index(d, index)))
+    heuristic_deps = ()
+    if new_heuristic or not os.path.isfile(study.heuristic_file):
+        tasks.append(Task('heuristic', 'heuristic', _heuristic_task, (study.name, rules),
+                          deps=[f'sort {s.directory}' for s in sessions]))
+        heuristic_deps = ('heuristic',)
+
+    for session in sessions:
+        name = f'{session.subject}/{session.session}'
+        tasks.append(_conversion_task(study, session, pattern, cpus_per_job,
+                                      deps=(f'sort {session.directory}',) + heuristic_deps,
+                                      scratch=scratch, reorganize=reorganize, keep_extra=keep_extra))
+        if not scratch:
+            tasks.append(Task(f'post {name}', 'post', postprocess_session,
+                              (study.name, session, reorganize, keep_extra),
+                              deps=(f'convert {name}',)))
+
+    print(f"Running {len(tasks)} tasks ({jobs} sort/post jobs, {convert_jobs} conversion jobs)")
+    print("")
+    started = time.time()
+    status = run_graph(tasks, {'sort': jobs, 'heuristic': 1, 'convert': convert_jobs, 'post': jobs},
+                       budgets=_budgets(memory_budget, cpu_budget))
+
+    failed = [name for name, state in status.items() if state != DONE]
+    print("")
+    _report_skipped(study, [s.directory for s in sessions])
+    if verify:
+        _report_integrity(study, [s.directory for s in sessions if status[f'sort {s.directory}'] == DONE])
+    if failed:
+        print(f"Error: {len(failed)} tasks did not finish: {', '.join(failed)}")
+        print("DICOM files were not backed up; fix the problem and run again")
+        return 1
+
+    print("Setting file permissions...")
+    fix_new_permissions(study, sessions, started)
+    print("Backing up DICOM files...")
+    backup_dicom(study)
+    print("")
+    print(f"Pipeline completed for study: {study.name} ({len(sessions)} sessions)")
+    return 0
+
+
+def _check_conversion_inputs(study):
+    """Check for the subject list, heuristic and sorted DICOM files; returns (pattern, sessions) or None"""
+    try:
+        pattern, sessions = study.subjlist()
+    except OSError:
+        print(f"Error: Subject list not found: tmp/subjlist_{study.name}.tsv")
+        print(f"Please run: bh03_make_subjlist.sh {study.name} '<pattern>'")
+        return None
+    if not os.path.isfile(study.heuristic_file):
+        print(f"Error: Heuristic file not found: {os.path.relpath(study.heuristic_file, study.name)}")
+        print(f"Please run: bh04_make_heuristic.sh {study.name}")
+        return None
+    if not os.path.isdir(study.path('DICOM', 'sorted')):
+        print("Error: Sorted DICOM directory not found")
+        print(f"Please run: bh02_sort_dicom.sh {study.name}")
+        return None
+    return pattern, sessions
+
+
+def shard(study, n_shards, jobs=1, cpus_per_job=1, run_local=False, scratch=None):
+    """Split the subject list into shards of balanced estimated DICOM volume
+
+    Writes one subject list per shard, tmp/shards/manifest.json and a SLURM
+    array job (tmp/shards/shards.sbatch) running `batch-heudiconv run-shard`
+    for each shard. With run_local, the shards are run here as separate
+    processes and merged.
+    """
+    import bh_shard
+    from bh_resources import estimate_session
+
+    if _missing_study(study):
+        return 1
+    inputs = _check_conversion_inputs(study)
+    if inputs is None:
+        return 1
+    pattern, sessions = inputs
+
+    estimates = {s.directory: estimate_session(sorted_dir(study.name, s), cpus=cpus_per_job) for s in sessions}
+    parts = bh_shard.partition([(s, estimates[s.directory].cost) for s in sessions], n_shards)
+    shutil.rmtree(bh_shard.shard_dir(study.name), ignore_errors=True)
+    os.makedirs(bh_shard.shard_dir(study.name))
+
+    shards = []
+    for k, (cost, members) in enumerate(parts):
+        members.sort(key=lambda s: s.directory)
+        write_subjlist(study.name, pattern, members, bh_shard.shard_subjlist(study.name, k))
+        # Memory of the shard's largest sessions converted at the same time
+        memory = sorted((estimates[s.directory].memory_mb for s in members), reverse=True)[:jobs]
+        shards.append({'sessions': members, 'cost': cost, 'memory_mb': sum(memory)})
+    bh_shard.write_manifest(study.name, pattern, shards)
+
+    sbatch = os.path.join(bh_shard.shard_dir(study.name), 'shards.sbatch')
+    with open(sbatch, 'w') as f:
+        f.write(bh_shard.render_sbatch(study.name, BATCHPATH, len(shards), jobs, cpus_per_job,
+                                       max(s['memory_mb'] for s in shards), scratch))
+
+    print(f"Split {len(sessions)} sessions of study '{study.name}' into {len(shards)} shards:")
+    for k, s in enumerate(shards):
+        print(f"  {bh_shard.shard_name(k)}: {len(s['sessions'])} sessions, "
+              f"{sum(estimates[m.directory].total_mb for m in s['sessions']):.0f} MB of DICOM files, "
+              f"relative cost {s['cost']:.0f}")
+    print("")
+    print(f"Manifest: {bh_shard.manifest_path(study.name)}")
+    print(f"SLURM array job: {sbatch}")
+    print("")
+
+    if run_local:
+        # The scratch directory is meant for the nodes; fall back to the local
+        # temporary directory if it names variables not set here
+        local_scratch = scratch and os.path.expandvars(scratch)
+        if local_scratch and '$' in local_scratch:
+            local_scratch = tempfile.gettempdir()
+        return _run_shards_locally(study, len(shards), jobs, cpus_per_job, local_scratch)
+    print("Next steps:")
+    print(f"1. Submit the array job: sbatch {sbatch}")
+    print(f"   (or run a single shard: batch-heudiconv run-shard {study.name} <shard>)")
+    print(f"2. When all shards finished, merge them: batch-heudiconv merge-shards {study.name}")
+    return 0
+
+
+def _run_shards_locally(study, n_shards, jobs=1, cpus_per_job=1, scratch=None):
+    """Run every shard as a separate batch-heudiconv process, then merge"""
+    import bh_shard
+
+    print(f"Running {n_shards} shards as local processes...")
+    processes = []
+    for k in range(n_shards):
+        log = os.path.join(bh_shard.shard_dir(study.name), f'{bh_shard.shard_name(k)}.log')
+        with open(log, 'w') as f:
+            processes.append((k, log, subprocess.Popen(
+                [os.path.join(BATCHPATH, 'batch-heudiconv'), 'run-shard', study.name, str(k),
+                 '--jobs', str(jobs), '--cpus-per-job', str(cpus_per_job)]
+                + (['--scratch', scratch] if scratch else []),
+                stdout=f, stderr=subprocess.STDOUT)))
+    for k, log, process in processes:
+        status = process.wait()
+        print(f"  {bh_shard.shard_name(k)}: {'done' if status == 0 else f'failed (exit code {status})'} "
+              f"(log: {log})")
+    print("")
+    return merge_shards(study)
+
+
+def run_shard(study, k, jobs=1, memory_budget=None, cpu_budget=None, cpus_per_job=1, scratch=None):
+    """Convert the sessions of one shard into its private BIDS root (bids/shards/shard_NNN)"""
+    import bh_shard
+
+    if _missing_study(study):
+        return 1
+    subjlist = bh_shard.shard_subjlist(study.name, k)
+    if not os.path.isfile(subjlist):
+        print(f"Error: Shard {k} not found: {subjlist}")
+        print(f"Please run: batch-heudiconv shard {study.name} -n <shards>")
+        return 1
+    if os.path.exists(bh_shard.shard_done_marker(study.name, k)):
+        os.remove(bh_shard.shard_done_marker(study.name, k))
+
+    shard_study = Study(study.name, rawdata=bh_shard.shard_output(study.name, k), pregrouped=study.pregrouped)
+    shard_study.set_subjlist(*read_subjlist(study.name, subjlist))
+    inputs = _check_conversion_inputs(shard_study)
+    if inputs is None:
+        return 1
+    pattern, sessions = inputs
+    os.makedirs(shard_study.rawdata, exist_ok=True)
+    _write_pregrouped_heuristic(shard_study)
+    started = time.time()
+
+    print(f"Converting {bh_shard.shard_name(k)} of study {study.name} ({len(sessions)} sessions) "
+          f"into {shard_study.rawdata}")
+    print("")
+    if jobs > 1:
+        ok = _convert_concurrently(shard_study, sessions, pattern, jobs, memory_budget, cpu_budget,
+                                   cpus_per_job, scratch)
+    else:
+        ok = True
+        for i, session in enumerate(sessions, start=1):
+            print(f"[{i}/{len(sessions)}] Processing: Subject={session.subject} Session={session.session} "
+                  f"(Directory: {session.directory})")
+            if scratch:
+                ok = convert_session_staged(shard_study, session, pattern, scratch) and ok
+            else:
+                ok = convert_session(shard_study, session, pattern) and ok
+            print("")
+    fix_new_permissions(shard_study, sessions, started)
+    if not ok:
+        print(f"Error: Some conversions of {bh_shard.shard_name(k)} failed")
+        return 1
+    open(bh_shard.shard_done_marker(study.name, k), 'w').close()
+    print(f"{bh_shard.shard_name(k)} completed")
+    return 0
+
+
+def merge_shards(study, force=False):
+    """Merge the private BIDS roots of the shards into bids/rawdata
+
+    Nothing is merged while a shard has not finished (no .done marker): its
+    array task may still be writing, or it failed. With force, the finished
+    shards are merged and the others are left in place. Files conflicting with
+    a different file already in bids/rawdata are left in the shard and
+    reported. The DICOM files are backed up once every shard finished and
+    merged without conflicts.
+    """
+    import bh_shard
+    from bh_merge import merge_tree
+
+    if _missing_study(study):
+        return 1
+    try:
+        manifest = bh_shard.read_manifest(study.name)
+    except OSError:
+        print(f"Error: Shard manifest not found: {bh_shard.manifest_path(study.name)}")
+        print(f"Please run: batch-heudiconv shard {study.name} -n <shards>")
+        return 1
+
+    unfinished = [entry['shard'] for entry in manifest['shards']
+                  if not os.path.exists(bh_shard.shard_done_marker(study.name, entry['shard']))]
+    if unfinished:
+        names = ', '.join(bh_shard.shard_name(k) for k in unfinished)
+        if not force:
+            print(f"Error: Shards did not finish: {names}")
+            print("Nothing was merged: their output may still be being written")
+            print(f"Please run them again (batch-heudiconv run-shard {study.name} <shard>) and merge when they "
+                  f"finished, or merge the finished shards only: batch-heudiconv merge-shards {study.name} --force")
+            return 1
+        print(f"Warning: Shards did not finish and are not merged: {names}")
+        print("")
+
+    rawdata = study.path('bids', 'rawdata')
+    os.makedirs(rawdata, exist_ok=True)
+    started = time.time()
+    sessions = []
+    conflicts = []
+    for entry in manifest['shards']:
+        k = entry['shard']
+        if k in unfinished:
+            continue
+        if os.path.isfile(bh_shard.shard_subjlist(study.name, k)):
+            sessions += read_subjlist(study.name, bh_shard.shard_subjlist(study.name, k))[1]
+        output = bh_shard.shard_output(study.name, k)
+        if not os.path.isdir(output):
+            print(f"  {bh_shard.shard_name(k)}: no output")
+            continue
+        moved, identical, shard_conflicts = merge_tree(output, rawdata)
+        print(f"  {bh_shard.shard_name(k)}: {moved} files merged, {identical} identical files dropped, "
+              f"{len(shard_conflicts)} conflicts")
+        conflicts += [os.path.join(output, path) for path in shard_conflicts]
+    print("")
+
+    print("Setting file permissions...")
+    fix_new_permissions(study, sessions, started)
+    if conflicts:
+        print(f"Error: {len(conflicts)} files differ from the files already in bids/rawdata and were not merged:")
+        for path in conflicts:
+            print(f"  {path}")
+        print(f"Resolve them and run again: batch-heudiconv merge-shards {study.name}")
+        return 1
+    if unfinished:
+        print(f"Error: Shards did not finish: {', '.join(bh_shard.shard_name(k) for k in unfinished)}")
+        print(f"Run them again (batch-heudiconv run-shard {study.name} <shard>), then merge again")
+        return 1
+
+    print("Backing up DICOM files...")
+    backup_dicom(study)
+    shutil.rmtree(study.path('bids', 'shards'), ignore_errors=True)
+    print("")
+    print(f"Merged {len(manifest['shards'])} shards into {rawdata}")
+    return 0
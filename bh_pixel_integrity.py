@@ -0,0 +1,121 @@
+# Pixel data integrity checks of sorted DICOM files (bh_dcm_sort_uid.py --verify)
+# A file cut short in transfer still has a complete header, so sorting
+# alone does not notice it; dcm2niix fails on it (or converts a damaged
+# volume) much later. Each copied file is checked in a pool of worker threads
+# while the sorter goes on copying: the length of native PixelData against
+# Rows x Columns x frames x samples x BitsAllocated, the frames of
+# encapsulated (compressed) PixelData, and optionally a full decode.
+
+import os
+import concurrent.futures
+
+
+def expected_pixel_bytes(ds):
+    """Length of native (uncompressed) PixelData implied by the image header, padded to even"""
+    rows = int(ds.get('Rows', 0) or 0)
+    columns = int(ds.get('Columns', 0) or 0)
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    samples = int(ds.get('SamplesPerPixel', 1) or 1)
+    bits = int(ds.get('BitsAllocated', 0) or 0)
+    if str(ds.get('PhotometricInterpretation', '')) == 'YBR_FULL_422':
+        # Two samples per pixel: chroma is subsampled horizontally
+        samples = 2
+    n_bytes = (rows * columns * frames * samples * bits + 7) // 8
+    return n_bytes + n_bytes % 2
+
+
+def check_file(path, decode=False):
+    """Return the problem found with the pixel data of a DICOM file (None if it is intact)"""
+    import pydicom
+    from pydicom.encaps import generate_frames
+
+    try:
+        # force: datasets without preamble are sorted too (see bh_file_types.py)
+        ds = pydicom.dcmread(path, force=True)
+    except Exception as e:
+        return f'unreadable: {e}'
+    if 'PixelData' not in ds:
+        # pydicom drops encapsulated pixel data cut off before its end
+        return 'pixel data missing or truncated'
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    try:
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID')
+        if transfer_syntax is not None and transfer_syntax.is_compressed:
+            found = sum(1 for _ in generate_frames(ds.PixelData, number_of_frames=frames))
+            if found < frames:
+                return f'{found} of {frames} compressed frames'
+        else:
+            expected, found = expected_pixel_bytes(ds), len(ds.PixelData)
+            if found < expected:
+                return f'truncated pixel data ({found} of {expected} bytes)'
+            if found > expected + 1:
+                return f'pixel data longer than the header implies ({found} of {expected} bytes)'
+        if decode:
+            ds.pixel_array
+    except Exception as e:
+        return f'damaged pixel data: {e}'
+    return None
+
+
+class IntegrityChecker:
+    """Check files in worker threads as they are submitted, collecting the problems per series
+
+    check is 'length' (PixelData length, or frame count if compressed) or
+    'decode' (also decode the pixel data).
+    """
+
+    def __init__(self, check='length', jobs=None):
+        self.decode = check == 'decode'
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs or min(8, os.cpu_count() or 1))
+        self._pending = []
+
+    def submit(self, series, path):
+        """Queue the check of path (a file of the series directory series)"""
+        self._pending.append((series, path, self._pool.submit(check_file, path, self.decode)))
+
+    def report(self):
+        """Wait for the queued checks
+
+        Returns:
+            dict: {series: {'checked': number of files, 'problems': [[file name, problem], ...]}}
+        """
+        report = {}
+        for series, path, future in self._pending:
+            entry = report.setdefault(series, {'checked': 0, 'problems': []})
+            entry['checked'] += 1
+            problem = future.result()
+            if problem:
+                entry['problems'].append([os.path.basename(path), problem])
+        self._pending = []
+        self._pool.shutdown()
+        return report
+
+
+def damaged_series(index):
+    """Return {series directory name: problems} of the series an index records as damaged"""
+    return {name: entry['integrity']['problems'] for name, entry in index.items()
+            if entry.get('integrity', {}).get('problems')}
+
+
+def write_report(path, indexes):
+    """Write the checks recorded in series indexes as a TSV, one row per checked series
+
+    Args:
+        indexes: {sorted directory name: series index}
+
+    Returns:
+        int: Number of damaged series
+    """
+    n_damaged = 0
+    with open(path, 'w') as f:
+        f.write('directory\tseries\tchecked\tdamaged\tproblem\n')
+        for directory, index in sorted(indexes.items()):
+            for name, entry in sorted(index.items()):
+                result = entry.get('integrity')
+                if result is None:
+                    continue
+                problems = result['problems']
+                n_damaged += bool(problems)
+                problem = f'{problems[0][0]}: {problems[0][1]}' if problems else 'n/a'
+                f.write(f"{directory}\t{name}\t{result['checked']}\t{len(problems)}\t{problem}\n")
+    return n_damaged
@@ -0,0 +1,128 @@
+# Series grouping for heudiconv from the sort-time series index
+# heudiconv groups the files it is given into series by reading every DICOM
+# header. bh_dcm_sort_uid.py already did that: series_index.json lists the
+# instances of each sorted series (ordered by InstanceNumber) with the header
+# values of heudiconv's seqinfo. The heuristic written by write_pregrouped_heuristic()
+# wraps the study heuristic with a `grouping` function that builds the seqinfo
+# from the index, so that `heudiconv -g custom` reads no header to group a
+# session. Series the index cannot stand in for (no instance list, mixed or
+# multi-frame series, files added after sorting, ...) are grouped by heudiconv
+# from their headers as usual.
+
+import os
+from bh_series_index import read_index
+from bh_simulate_heuristic import seqinfo_from_entry
+
+PREGROUPED_HEURISTIC = '''# heuristic.py for study: {study_name}
+# Generated by batch-heudiconv (--pregrouped); do not edit
+# heuristic_{study_name}.py with the series grouping taken from the series
+# indexes of DICOM/sorted (run heudiconv with -g custom)
+
+import importlib.util
+
+# bh_pregrouped.py is shipped with the batch-heudiconv scripts, which put
+# their directory on PYTHONPATH when they run heudiconv
+from bh_pregrouped import make_grouping
+
+_spec = importlib.util.spec_from_file_location('heuristic_{study_name}', {heuristic!r})
+_heuristic = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_heuristic)
+globals().update((name, value) for name, value in vars(_heuristic).items() if not name.startswith('__'))
+
+grouping = make_grouping(_heuristic)
+'''
+
+
+def pregrouped_heuristic_file(study_name):
+    return os.path.join(study_name, 'tmp', f'heuristic_{study_name}_pregrouped.py')
+
+
+def write_pregrouped_heuristic(study_name, heuristic_file):
+    """Write tmp/heuristic_<study_name>_pregrouped.py wrapping heuristic_file; returns its path"""
+    path = pregrouped_heuristic_file(study_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(PREGROUPED_HEURISTIC.format(study_name=study_name, heuristic=os.path.abspath(heuristic_file)))
+    return path
+
+
+def usable_entry(entry):
+    """Whether the seqinfo of a series can be built from its index entry"""
+    return bool(entry.get('instances')) and len(entry['instances']) == entry.get('n_files') \
+        and entry.get('uniform', False) and entry.get('number_of_frames', 1) == 1 \
+        and bool(entry.get('protocol_name'))
+
+
+# seqinfo fields heudiconv leaves None when the DICOM tag is absent (the index has '')
+OPTIONAL_FIELDS = ('patient_id', 'study_description', 'accession_number', 'patient_age', 'patient_sex',
+                   'series_uid')
+
+
+def _series_order(seqinfo):
+    number, _, protocol = seqinfo.series_id.partition('-')
+    try:
+        return int(number), protocol
+    except ValueError:
+        return 0, seqinfo.series_id
+
+
+def index_seqinfos(files, SeqInfo):
+    """Group files (paths <session>/<series>/<file>) by series from the series indexes
+
+    Returns:
+        tuple: ({SeqInfo: [file, ...]} of the indexed series, [files left to group from their headers])
+    """
+    by_series = {}
+    for path in files:
+        series_path, name = os.path.split(path)
+        by_series.setdefault(series_path, {})[name] = path
+
+    indexes = {}
+    seqinfos = {}
+    rest = []
+    for series_path, paths in by_series.items():
+        session_path, dir_name = os.path.split(series_path)
+        if session_path not in indexes:
+            indexes[session_path] = read_index(session_path)
+        entry = indexes[session_path].get(dir_name)
+        if entry is None or not usable_entry(entry) \
+                or {name for _, name in entry['instances']} != set(paths):
+            rest += paths.values()
+            continue
+        series_files = [paths[name] for _, name in entry['instances']]
+        seqinfo = seqinfo_from_entry(session_path, dir_name, entry, 0, seqinfo_class=SeqInfo)
+        seqinfo = seqinfo._replace(example_dcm_file=os.path.basename(series_files[0]),
+                                   **{field: getattr(seqinfo, field) or None for field in OPTIONAL_FIELDS})
+        seqinfos[seqinfo] = series_files
+    return seqinfos, rest
+
+
+def make_grouping(heuristic):
+    """Return the heudiconv `grouping` callable for a study heuristic (module)
+
+    A heuristic with a grouping of its own keeps it. With filter_dicom or
+    custom_seqinfo, which need the headers, all files are grouped by heudiconv.
+    """
+    if callable(getattr(heuristic, 'grouping', None)):
+        return heuristic.grouping
+    needs_headers = any(hasattr(heuristic, name) for name in ('filter_dicom', 'custom_seqinfo'))
+
+    def grouping(files, dcmfilter, SeqInfo):
+        from heudiconv.dicoms import group_dicoms_into_seqinfos
+
+        seqinfos, rest = ({}, list(files)) if needs_headers else index_seqinfos(files, SeqInfo)
+        if rest:
+            grouped = group_dicoms_into_seqinfos(
+                rest, 'all', dcmfilter=dcmfilter,
+                custom_seqinfo=getattr(heuristic, 'custom_seqinfo', None))
+            for group in grouped.values():
+                seqinfos.update(group)
+
+        # One study per session (as with -g all), series in heudiconv's order
+        result = {}
+        total = 0
+        for seqinfo in sorted(seqinfos, key=_series_order):
+            total += len(seqinfos[seqinfo])
+            result[seqinfo._replace(total_files_till_now=total)] = seqinfos[seqinfo]
+        return {'all': result}
+    return grouping
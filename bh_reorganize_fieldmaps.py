@@ -4,34 +4,43 @@
 # K.Nemoto 13 Jan 2026
 
 import os
+import io
 import json
 import sys
 import glob
-import shutil
+import fnmatch
 import argparse
-import pandas as pd
+import contextlib
+import concurrent.futures
 import re
+from bh_sidecar_cache import get_cache, use_cache, load_sidecar
 
 def check_image_type(json_file):
     """Check ImageType from JSON file to determine if it's magnitude or phase"""
     try:
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-            if 'ImageType' in data:
-                image_types = data['ImageType']
-                if isinstance(image_types, list):
-                    for img_type in image_types:
-                        if 'MAGNITUDE' in str(img_type).upper():
-                            return 'magnitude'
-                        elif 'PHASE' in str(img_type).upper():
-                            return 'phase'
-                return 'unknown'
+        data = load_sidecar(json_file)
+        if 'ImageType' in data:
+            image_types = data['ImageType']
+            if isinstance(image_types, list):
+                for img_type in image_types:
+                    if 'MAGNITUDE' in str(img_type).upper():
+                        return 'magnitude'
+                    elif 'PHASE' in str(img_type).upper():
+                        return 'phase'
+            return 'unknown'
     except:
         return 'unknown'
     return 'unknown'
 
 def update_scans_tsv(scans_file, rename_mapping, files_deleted):
-    """Update the scans.tsv file with new filenames and remove deleted files"""
+    """Update the scans.tsv file with new filenames and remove deleted files
+
+    Rows that were already updated are left alone, so this can be re-run
+    when rolling a journal forward. The file is replaced atomically.
+    """
+    # pandas is only needed (and imported) when there is a scans.tsv to update
+    import pandas as pd
+
     try:
         df = pd.read_csv(scans_file, sep='\t')
         
@@ -52,122 +61,283 @@ def update_scans_tsv(scans_file, rename_mapping, files_deleted):
                 print(f"  Removed from scans.tsv: {deleted_path}")
         
         # Save updated dataframe
-        df.to_csv(scans_file, sep='\t', index=False)
+        tmp_file = scans_file + '.tmp'
+        df.to_csv(tmp_file, sep='\t', index=False)
+        os.replace(tmp_file, scans_file)
         print(f"  ✓ Saved updated scans.tsv")
         
     except Exception as e:
         print(f"  Warning: Error updating scans.tsv: {e}")
 
-def reorganize_fieldmaps(fmap_dir, keep_extra=False):
-    """Reorganize GE fieldmap files after BIDS conversion
+# Journal left in a session directory while its plan is being applied
+JOURNAL_NAME = '.bh_reorganize_fieldmaps.journal'
+
+# Fieldmap files as named by heudiconv for GE, e.g. sub-01_magnitude12.nii.gz
+NUMBERED_MAGNITUDE = re.compile(r'magnitude([12])([1-4])\.(nii\.gz|json)$')
+
+def plan_fieldmap_reorganization(files, image_type_of, keep_extra=False):
+    """Compute the rename/delete plan for one fieldmap directory
+
+    Nothing is touched on disk apart from the sidecars read by image_type_of.
 
     Args:
-        fmap_dir: Path to fieldmap directory (e.g., study_name/bids/rawdata/sub-001/ses-123/fmap)
-        keep_extra: Whether to keep real and imaginary files (default: False)
+        files: Basenames present in the fieldmap directory
+        image_type_of: Callable mapping a sidecar basename to 'magnitude', 'phase' or 'unknown'
+        keep_extra: Whether to keep real and imaginary files
 
     Returns:
-        tuple: (rename_mapping, files_deleted) for updating scans.tsv
+        dict: 'ops' (ordered list of rename/delete operations), 'rename_mapping',
+              'files_deleted' and 'final_files'
     """
-
-    if not os.path.exists(fmap_dir):
-        print(f"  Fieldmap directory not found: {fmap_dir}")
-        return {}, []
-    
+    files = set(files)
+    ops = []
     rename_mapping = {}
     files_deleted = []
-    
-    # Process all nii.gz files
-    all_files = glob.glob(os.path.join(fmap_dir, '*.nii.gz'))
-    
-    for nii_file in all_files:
-        base_name = os.path.splitext(os.path.splitext(nii_file)[0])[0]
-        json_file = base_name + '.json'
-        
-        # Process magnitude files
-        for echo_num in ['1', '2']:
-            if f'magnitude{echo_num}' in os.path.basename(nii_file):
-                if os.path.exists(json_file):
-                    img_type = check_image_type(json_file)
-                    
-                    old_basename = os.path.basename(nii_file)
-                    
-                    if img_type == 'phase':
-                        # Rename magnitude to phase
-                        new_base = base_name.replace(f'magnitude{echo_num}', f'phase{echo_num}')[:-1]
-                        new_nii = new_base + '.nii.gz'
-                        new_json = new_base + '.json'
-                        new_basename = os.path.basename(new_nii)
-                        
-                        print(f"  Renaming phase: {old_basename} -> {new_basename}")
-                        rename_mapping[old_basename] = new_basename
-                        
-                        # Remove existing file if it exists
-                        if os.path.exists(new_nii):
-                            os.remove(new_nii)
-                        if os.path.exists(new_json):
-                            os.remove(new_json)
-                        
-                        os.rename(nii_file, new_nii)
-                        os.rename(json_file, new_json)
-                        
-                    elif img_type == 'magnitude':
-                        # Rename magnitude to simplified name
-                        new_base = base_name.replace(f'magnitude{echo_num}', f'magnitude{echo_num}')[:-1]
-                        new_nii = new_base + '.nii.gz'
-                        new_json = new_base + '.json'
-                        new_basename = os.path.basename(new_nii)
-                        
-                        print(f"  Renaming magnitude: {old_basename} -> {new_basename}")
-                        rename_mapping[old_basename] = new_basename
-                        
-                        # Remove existing file if it exists
-                        if os.path.exists(new_nii):
-                            os.remove(new_nii)
-                        if os.path.exists(new_json):
-                            os.remove(new_json)
-                        
-                        os.rename(nii_file, new_nii)
-                        os.rename(json_file, new_json)
-    
-    # Remove numbered magnitude files
-    print("  Removing numbered magnitude files...")
-    for pattern in ['*.nii.gz', '*.json']:
-        for file in glob.glob(os.path.join(fmap_dir, f'*{pattern}')):
-            basename = os.path.basename(file)
-            # Check if it matches pattern like "magnitude12", "magnitude14", etc.
-            if re.search(r'magnitude[12][1-4]\.(nii\.gz|json)$', basename):
-                print(f"  Removing: {basename}")
-                files_deleted.append(basename)
-                os.remove(file)
-    
+
+    def delete(basename):
+        ops.append({'op': 'delete', 'path': basename})
+        files.discard(basename)
+        files_deleted.append(basename)
+
+    # Rename numbered magnitude files according to the ImageType of their sidecar
+    for old_basename in sorted(f for f in files if f.endswith('.nii.gz')):
+        match = NUMBERED_MAGNITUDE.search(old_basename)
+        if not match:
+            continue
+        base_name = old_basename[:-len('.nii.gz')]
+        json_basename = base_name + '.json'
+        if json_basename not in files:
+            continue
+
+        img_type = image_type_of(json_basename)
+        if img_type not in ('magnitude', 'phase'):
+            continue
+
+        echo_num = match.group(1)
+        new_base = base_name[:match.start()] + f'{img_type}{echo_num}'
+        new_basename = new_base + '.nii.gz'
+
+        # A later series with the same target supersedes an earlier one
+        for superseded, target in list(rename_mapping.items()):
+            if target == new_basename:
+                del rename_mapping[superseded]
+                files_deleted.append(superseded)
+
+        ops.append({'op': 'rename', 'src': old_basename, 'dst': new_basename, 'label': img_type})
+        ops.append({'op': 'rename', 'src': json_basename, 'dst': new_base + '.json', 'label': img_type})
+        files.difference_update([old_basename, json_basename])
+        files.update([new_basename, new_base + '.json'])
+        rename_mapping[old_basename] = new_basename
+
+    # Remove numbered magnitude files that were not renamed
+    for basename in sorted(files):
+        if NUMBERED_MAGNITUDE.search(basename):
+            delete(basename)
+
     # Remove extra files (real and imaginary) by default
     if not keep_extra:
-        print("  Removing real and imaginary files...")
         for pattern in ['*_real.*', '*_imaginary.*']:
-            for file in glob.glob(os.path.join(fmap_dir, pattern)):
-                basename = os.path.basename(file)
-                print(f"  Removing: {basename}")
-                files_deleted.append(basename)
-                os.remove(file)
-    
+            for basename in sorted(fnmatch.filter(files, pattern)):
+                delete(basename)
+
+    return {
+        'ops': ops,
+        'rename_mapping': rename_mapping,
+        'files_deleted': files_deleted,
+        'final_files': sorted(files),
+    }
+
+def validate_plan(plan, files):
+    """Check a plan against a directory listing without touching disk
+
+    Returns:
+        list: Problems found (empty if the plan can be applied as is)
+    """
+    problems = []
+    files = set(files)
+    for op in plan['ops']:
+        if op['op'] == 'rename':
+            if op['src'] not in files:
+                problems.append(f"rename source missing: {op['src']}")
+            files.discard(op['src'])
+            files.add(op['dst'])
+        elif op['op'] == 'delete':
+            if op['path'] not in files:
+                problems.append(f"delete target missing: {op['path']}")
+            files.discard(op['path'])
+    for basename in files:
+        if basename.endswith('.nii.gz') and basename[:-len('.nii.gz')] + '.json' not in files:
+            problems.append(f"no sidecar after reorganization: {basename}")
+    return problems
+
+def write_journal(journal_file, journal):
+    """Durably write a journal next to the files it describes"""
+    tmp_file = journal_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(journal, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, journal_file)
+
+def apply_journal(journal_file):
+    """Apply (or roll forward) a journaled plan
+
+    Every operation is idempotent: a rename whose source is gone and whose
+    destination exists, or a delete whose target is gone, was already done
+    before an interruption and is skipped.
+    """
+    with open(journal_file, 'r') as f:
+        journal = json.load(f)
+    fmap_dir = journal['fmap_dir']
+
+    for op in journal['ops']:
+        if op['op'] == 'rename':
+            src = os.path.join(fmap_dir, op['src'])
+            dst = os.path.join(fmap_dir, op['dst'])
+            if os.path.exists(src):
+                if op['dst'].endswith('.nii.gz'):
+                    print(f"  Renaming {op['label']}: {op['src']} -> {op['dst']}")
+                os.replace(src, dst)
+                if op['dst'].endswith('.json'):
+                    get_cache().rename(src, dst)
+            elif not os.path.exists(dst):
+                print(f"  Warning: {op['src']} not found, cannot rename to {op['dst']}")
+        elif op['op'] == 'delete':
+            path = os.path.join(fmap_dir, op['path'])
+            if os.path.exists(path):
+                print(f"  Removing: {op['path']}")
+                os.remove(path)
+                get_cache().discard(path)
+
+    # Update scans.tsv with both renamed and deleted files
+    scans_file = journal['scans_file']
+    if os.path.exists(scans_file):
+        update_scans_tsv(scans_file, journal['rename_mapping'], journal['files_deleted'])
+    else:
+        print(f"  Warning: scans.tsv not found at {scans_file}")
+
+    os.remove(journal_file)
+
+def reorganize_fieldmaps(fmap_dir, scans_file, keep_extra=False, files=None, dry_run=False):
+    """Reorganize GE fieldmap files after BIDS conversion
+
+    The full plan is computed first and then applied as a journaled batch,
+    so an interrupted run can be rolled forward by running the script again.
+
+    Args:
+        fmap_dir: Path to fieldmap directory (e.g., study_name/bids/rawdata/sub-001/ses-123/fmap)
+        scans_file: Path to the scans.tsv that lists the fieldmap files
+        keep_extra: Whether to keep real and imaginary files (default: False)
+        files: Directory listing of fmap_dir, if already known (default: list it once here)
+        dry_run: Only print and validate the plan (default: False)
+
+    Returns:
+        dict: The plan (see plan_fieldmap_reorganization)
+    """
+    if files is None:
+        files = os.listdir(fmap_dir)
+
+    plan = plan_fieldmap_reorganization(
+        files, lambda basename: check_image_type(os.path.join(fmap_dir, basename)), keep_extra)
+
+    if dry_run:
+        print("  Planned operations:")
+        for op in plan['ops']:
+            if op['op'] == 'rename':
+                print(f"    rename {op['src']} -> {op['dst']}")
+            else:
+                print(f"    delete {op['path']}")
+        if not plan['ops']:
+            print("    (nothing to do)")
+        for problem in validate_plan(plan, files):
+            print(f"  Warning: {problem}")
+        return plan
+
+    if not plan['ops']:
+        print("  Fieldmaps are already organized, nothing to do")
+        return plan
+
+    journal_file = os.path.join(os.path.dirname(os.path.abspath(fmap_dir)), JOURNAL_NAME)
+    write_journal(journal_file, {
+        'fmap_dir': os.path.abspath(fmap_dir),
+        'scans_file': os.path.abspath(scans_file),
+        'ops': plan['ops'],
+        'rename_mapping': plan['rename_mapping'],
+        'files_deleted': plan['files_deleted'],
+    })
+    apply_journal(journal_file)
+
     # List final contents
     print("  Final fieldmap directory contents:")
-    final_files = sorted(os.listdir(fmap_dir))
-    if final_files:
-        for file in final_files:
+    if plan['final_files']:
+        for file in plan['final_files']:
             print(f"    {file}")
     else:
         print("    (no files remaining)")
-    
-    return rename_mapping, files_deleted
 
-def main():
+    return plan
+
+def process_session(session_dir, scans_file, keep_extra=False, indent='  ', dry_run=False):
+    """Reorganize the fieldmaps of one subject or session directory
+
+    Args:
+        session_dir: Directory containing fmap/ (sub-* or sub-*/ses-*)
+        scans_file: Path to the scans.tsv that lists the fieldmap files
+        keep_extra: Whether to keep real and imaginary files
+        indent: Prefix for messages printed by this function
+        dry_run: Only print and validate the plan
+
+    Returns:
+        bool: True if a fieldmap directory was found and processed
+    """
+    # Roll forward a run that was interrupted while applying its plan
+    journal_file = os.path.join(session_dir, JOURNAL_NAME)
+    if os.path.exists(journal_file) and not dry_run:
+        print(f"{indent}Resuming interrupted reorganization...")
+        apply_journal(journal_file)
+
+    # Check if session has fieldmap directory
+    fmap_dir = os.path.join(session_dir, 'fmap')
+    try:
+        files = os.listdir(fmap_dir)
+    except FileNotFoundError:
+        print(f"{indent}No fieldmap directory found, skipping...")
+        return False
+
+    reorganize_fieldmaps(fmap_dir, scans_file, keep_extra, files, dry_run)
+
+    return True
+
+def _run_session(task):
+    """Run process_session for one task, reporting an error without stopping the others
+
+    Returns:
+        tuple: (whether a fieldmap directory was processed, whether it failed)
+    """
+    try:
+        return process_session(**task['kwargs']), False
+    except Exception as e:
+        print(f"{task['kwargs']['indent']}Error: {e}")
+        return False, True
+
+def _process_session_captured(task):
+    """Run _run_session in a worker and return its output with the result"""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        result = _run_session(task)
+    # Pool workers do not run atexit handlers
+    get_cache().save()
+    return (buffer.getvalue(),) + result
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Reorganize GE fieldmap files after BIDS conversion for your study',
         epilog='''
 Examples:
   %(prog)s my_study_2024           # Reorganize GE fieldmaps for study 'my_study_2024'
   %(prog)s ge_pilot --keep-extra   # Keep real/imaginary files during reorganization
+  %(prog)s big_cohort --jobs 8     # Process 8 sessions in parallel
+  %(prog)s big_cohort --dry-run    # Show what would be renamed/removed
 
 This script handles issues specific to GE fieldmap conversion:
 1. Corrects magnitude/phase file naming based on DICOM ImageType
@@ -175,6 +345,10 @@ This script handles issues specific to GE fieldmap conversion:
 3. Updates scans.tsv files to reflect the changes
 4. Cleans up real/imaginary files (unless --keep-extra is specified)
 
+Each session's changes are planned first and applied as a journaled batch.
+If a run is interrupted, running the script again completes the pending
+changes (files and scans.tsv) before doing anything else.
+
 Prerequisites:
   - BIDS conversion completed with: bh05_make_bids.sh <study_name>
   - GE fieldmap data present in: <study_name>/bids/rawdata/sub-*/fmap/
@@ -189,8 +363,16 @@ This script supports both session-level and subject-level BIDS structures.
     parser.add_argument('study_name', help='Name of your research study')
     parser.add_argument('--keep-extra', action='store_true', 
                        help='Keep real and imaginary files (default: remove them)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                       help='Number of sessions to process in parallel (default: 1)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                       help='Print and validate the rename/delete plan without changing any files')
+    parser.add_argument('--sidecar-cache', metavar='FILE',
+                       help='Share parsed sidecar JSON with other tools through FILE '
+                            '(default: $BH_SIDECAR_CACHE, or no persistent cache)')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    use_cache(args.sidecar_cache)
     
     # Construct rawdata path
     rawdata_path = os.path.join(args.study_name, 'bids', 'rawdata')
@@ -199,74 +381,98 @@ This script supports both session-level and subject-level BIDS structures.
         print(f"Error: BIDS rawdata directory not found: {rawdata_path}")
         print(f"Please ensure BIDS conversion is completed for study '{args.study_name}'")
         print(f"Run: bh05_make_bids.sh {args.study_name}")
-        sys.exit(1)
+        return 1
     
     # Find all subject directories
     subject_dirs = glob.glob(os.path.join(rawdata_path, 'sub-*'))
     
     if not subject_dirs:
         print(f"Error: No subject directories found in {rawdata_path}")
-        sys.exit(1)
+        return 1
     
     print(f"Reorganizing GE fieldmaps for study '{args.study_name}'")
     print(f"Processing {len(subject_dirs)} subjects...")
     print("")
 
-    # Process each subject
-    subjects_processed = 0
-    for subject_dir in subject_dirs:
+    # Collect sessions (or subject-level fmap directories) as independent tasks
+    tasks = []
+    for subject_dir in sorted(subject_dirs):
         subject_id = os.path.basename(subject_dir)
-        print(f"Processing {subject_id}...")
 
         # Check for session directories (ses-*)
-        session_dirs = glob.glob(os.path.join(subject_dir, 'ses-*'))
+        session_dirs = sorted(glob.glob(os.path.join(subject_dir, 'ses-*')))
 
         if session_dirs:
-            # Process each session
             for session_dir in session_dirs:
                 session_id = os.path.basename(session_dir)
-                print(f"  Processing {session_id}...")
-
-                # Check if session has fieldmap directory
-                fmap_dir = os.path.join(session_dir, 'fmap')
-                if not os.path.exists(fmap_dir):
-                    print(f"    No fieldmap directory found, skipping...")
-                    continue
+                tasks.append({
+                    'subject_id': subject_id,
+                    'header': f"  Processing {session_id}...",
+                    'kwargs': {
+                        'session_dir': session_dir,
+                        'scans_file': os.path.join(session_dir, f"{subject_id}_{session_id}_scans.tsv"),
+                        'keep_extra': args.keep_extra,
+                        'dry_run': args.dry_run,
+                        'indent': '    ',
+                    },
+                })
+        else:
+            # No session directories, try subject-level fieldmap directory (legacy structure)
+            tasks.append({
+                'subject_id': subject_id,
+                'header': None,
+                'kwargs': {
+                    'session_dir': subject_dir,
+                    'scans_file': os.path.join(subject_dir, f"{subject_id}_scans.tsv"),
+                    'keep_extra': args.keep_extra,
+                    'dry_run': args.dry_run,
+                    'indent': '  ',
+                },
+            })
 
-                # Reorganize fieldmaps and get rename mapping and deleted files
-                rename_mapping, files_deleted = reorganize_fieldmaps(fmap_dir, args.keep_extra)
+    # Process sessions, in parallel if requested; output is printed per session
+    # in the same order as a serial run
+    if args.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+        results = executor.map(_process_session_captured, tasks)
+    else:
+        executor = None
+        results = None
 
-                # Update scans.tsv with both renamed and deleted files
-                scans_file = os.path.join(session_dir, f"{subject_id}_{session_id}_scans.tsv")
-                if os.path.exists(scans_file):
-                    update_scans_tsv(scans_file, rename_mapping, files_deleted)
-                else:
-                    print(f"    Warning: scans.tsv not found at {scans_file}")
+    subjects_processed = 0
+    failed = 0
+    current_subject = None
+    for task in tasks:
+        if task['subject_id'] != current_subject:
+            if current_subject is not None:
+                print("")
+            current_subject = task['subject_id']
+            print(f"Processing {current_subject}...")
+        if task['header']:
+            print(task['header'])
 
-                subjects_processed += 1
+        if results is not None:
+            output, processed, error = next(results)
+            print(output, end='')
         else:
-            # No session directories, try subject-level fieldmap directory (legacy structure)
-            fmap_dir = os.path.join(subject_dir, 'fmap')
-            if not os.path.exists(fmap_dir):
-                print(f"  No fieldmap directory found, skipping...")
-                continue
-
-            # Reorganize fieldmaps and get rename mapping and deleted files
-            rename_mapping, files_deleted = reorganize_fieldmaps(fmap_dir, args.keep_extra)
-
-            # Update scans.tsv with both renamed and deleted files
-            scans_file = os.path.join(subject_dir, f"{subject_id}_scans.tsv")
-            if os.path.exists(scans_file):
-                update_scans_tsv(scans_file, rename_mapping, files_deleted)
-            else:
-                print(f"  Warning: scans.tsv not found at {scans_file}")
+            processed, error = _run_session(task)
 
+        if processed:
             subjects_processed += 1
+        if error:
+            failed += 1
 
+    if current_subject is not None:
         print("")
+    if executor is not None:
+        executor.shutdown()
+    get_cache().save()
     
     print("=" * 50)
-    if subjects_processed > 0:
+    if args.dry_run:
+        print(f"Dry run: planned fieldmap reorganization for {subjects_processed} subjects in study '{args.study_name}'")
+        print("No files were changed. Run again without --dry-run to apply the plans.")
+    elif subjects_processed > 0:
         print(f"✓ Successfully reorganized GE fieldmaps for {subjects_processed} subjects in study '{args.study_name}'")
         print("")
         print("Next steps:")
@@ -277,6 +483,12 @@ This script supports both session-level and subject-level BIDS structures.
     else:
         print(f"No subjects with fieldmap data found in study '{args.study_name}'")
         print("This script is specifically for GE fieldmap reorganization.")
+    if failed:
+        print(f"Error: {failed} sessions could not be reorganized (see the messages above); "
+              "fix the problem and run again")
+        return 1
+    return 0
 
 if __name__ == '__main__':
-    main()
+    from bh_server import run_served
+    sys.exit(run_served('bh_reorganize_fieldmaps', main))
@@ -0,0 +1,80 @@
+# Resource estimates of session conversions for the job runners
+# heudiconv converts the series of a session one after another and dcm2niix
+# holds the pixel data of one series (plus its output buffers) in memory, so
+# peak memory follows the largest series while run time follows the total
+# amount of data. Both are estimated from the sorted DICOM files on disk.
+
+import os
+import collections
+
+# Memory of heudiconv/dcm2niix independent of the data (MB)
+DEFAULT_BASE_MEMORY_MB = 500
+# Peak memory per MB of DICOM data of the largest series
+MEMORY_FACTOR = 3.0
+# Per-file overhead of a conversion, as MB of data (header parsing, file opens)
+FILE_COST_MB = 0.05
+
+SessionCost = collections.namedtuple('SessionCost', [
+    'n_files', 'total_mb', 'largest_series_mb', 'memory_mb', 'cpus', 'cost'])
+
+
+def series_sizes(dicom_dir):
+    """Return {series directory name: (number of files, total bytes)} of a sorted session"""
+    sizes = {}
+    with os.scandir(dicom_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            n_files = n_bytes = 0
+            for root, _, files in os.walk(entry.path):
+                for f in files:
+                    try:
+                        n_bytes += os.stat(os.path.join(root, f)).st_size
+                    except OSError:
+                        continue
+                    n_files += 1
+            sizes[entry.name] = (n_files, n_bytes)
+    return sizes
+
+
+def estimate_session(dicom_dir, base_memory_mb=DEFAULT_BASE_MEMORY_MB, cpus=1):
+    """Estimate the peak memory, CPUs and relative run time of converting one session
+
+    Returns:
+        SessionCost: cost is the relative run time used to order the sessions
+    """
+    sizes = series_sizes(dicom_dir) if os.path.isdir(dicom_dir) else {}
+    n_files = sum(n for n, _ in sizes.values())
+    total_mb = sum(b for _, b in sizes.values()) / 2**20
+    largest_series_mb = max((b for _, b in sizes.values()), default=0) / 2**20
+    return SessionCost(
+        n_files=n_files,
+        total_mb=total_mb,
+        largest_series_mb=largest_series_mb,
+        memory_mb=int(base_memory_mb + MEMORY_FACTOR * largest_series_mb),
+        cpus=cpus,
+        cost=total_mb + FILE_COST_MB * n_files,
+    )
+
+
+def default_memory_budget_mb(fraction=0.75):
+    """A fraction of the physical memory of this machine in MB (None if unknown)
+
+    On SLURM, the memory allocated to the job (SLURM_MEM_PER_NODE) is used instead.
+    """
+    if os.environ.get('SLURM_MEM_PER_NODE', '').isdigit():
+        return int(int(os.environ['SLURM_MEM_PER_NODE']) * fraction)
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**20 * fraction)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_cpu_budget():
+    """CPUs available to this process (the SLURM allocation or the CPU affinity mask)"""
+    if os.environ.get('SLURM_CPUS_ON_NODE', '').isdigit():
+        return int(os.environ['SLURM_CPUS_ON_NODE'])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
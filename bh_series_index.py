@@ -0,0 +1,272 @@
+# Per-subject index of sorted DICOM series
+# Written by bh_dcm_sort_uid.py next to the series directories of each subject
+# (DICOM/sorted/<subject>/series_index.json) so that later stages can use
+# header information without parsing the DICOM files again. Each entry also
+# lists the instances of its series ordered by InstanceNumber, so that heudiconv
+# can be given its series grouping (see bh_pregrouped.py). The index file also
+# maps each SeriesInstanceUID to its series directories.
+
+import os
+import re
+import json
+
+INDEX_NAME = 'series_index.json'
+
+INDEX_FORMAT_VERSION = 1
+
+# Suffix of series directories keyed on SeriesInstanceUID (bh_dcm_sort_uid.py --series-key uid)
+UID_SUFFIX_RE = re.compile(r'__[0-9a-f]{8,40}$')
+
+# GE stores the image component of each instance in a private tag
+GE_IMAGE_COMPONENT_TAG = (0x0043, 0x102F)
+GE_IMAGE_COMPONENTS = {0: 'magnitude', 1: 'phase', 2: 'real', 3: 'imaginary'}
+
+# ImageType values naming the image component (Siemens/Philips style)
+IMAGE_TYPE_COMPONENTS = {
+    'M': 'magnitude', 'MAGNITUDE': 'magnitude',
+    'P': 'phase', 'PHASE': 'phase',
+    'R': 'real', 'REAL': 'real',
+    'I': 'imaginary', 'IMAGINARY': 'imaginary',
+}
+
+
+def image_component(ds):
+    """Return 'magnitude', 'phase', 'real' or 'imaginary' for a DICOM dataset (None if unknown)"""
+    element = ds.get(GE_IMAGE_COMPONENT_TAG)
+    if element is not None:
+        try:
+            value = element.value
+            if isinstance(value, bytes):
+                value = value.decode('ascii', 'ignore').strip('\x00 ')
+            return GE_IMAGE_COMPONENTS.get(int(value))
+        except (TypeError, ValueError):
+            pass
+    for value in ds.get('ImageType', []):
+        component = IMAGE_TYPE_COMPONENTS.get(str(value).upper())
+        if component:
+            return component
+    return None
+
+
+def acquisition_time(ds):
+    """Return AcquisitionDate/Time as used in scans.tsv (e.g. 2025-05-24T10:11:12.000000)"""
+    date = str(ds.get('AcquisitionDate', '') or ds.get('SeriesDate', '') or '')
+    time = str(ds.get('AcquisitionTime', '') or ds.get('SeriesTime', '') or '')
+    if len(date) != 8 or len(time) < 6:
+        return 'n/a'
+    fraction = time[7:13] if len(time) > 7 else ''
+    return f"{date[:4]}-{date[4:6]}-{date[6:8]}T{time[:2]}:{time[2:4]}:{time[4:6]}.{fraction.ljust(6, '0')}"
+
+
+def seqinfo_date_time(ds):
+    """Return the (date, time) strings heudiconv puts into its seqinfo (None if unknown)
+
+    AcquisitionDate/Time as they are if both are set, otherwise
+    AcquisitionDateTime or SeriesDate/Time as YYYYMMDD and HHMMSS.FFFFFF.
+    """
+    date = str(ds.get('AcquisitionDate', '') or '')
+    time = str(ds.get('AcquisitionTime', '') or '')
+    if date and time:
+        return date, time
+    value = str(ds.get('AcquisitionDateTime', '') or '')
+    if len(value) >= 14:
+        other_date, other_time = value[:8], value[8:].split('+')[0].split('-')[0]
+    else:
+        other_date = str(ds.get('SeriesDate', '') or '')
+        other_time = str(ds.get('SeriesTime', '') or '')
+    if len(other_date) == 8 and len(other_time) >= 6:
+        fraction = other_time[7:13] if len(other_time) > 7 else ''
+        return other_date, f"{other_time[:6]}.{fraction.ljust(6, '0')}"
+    return date or None, time or None
+
+
+def _private_int(element):
+    """Integer value of a private element, which may be unparsed bytes (VR UN)"""
+    if element is None or element.value in (None, b'', ''):
+        return None
+    value = element.value
+    if isinstance(value, bytes):
+        return int.from_bytes(value[:4], 'little') if len(value) in (2, 4) else None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _private_str(element):
+    """String value of a private element, which may be unparsed bytes (VR UN)"""
+    value = element.value
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'ignore').strip('\x00 ')
+    return str(value)
+
+
+def sequence_name(ds):
+    """Sequence name as heudiconv reads it: SequenceName, then the Siemens and Siemens XA tags"""
+    for tag in ((0x0018, 0x0024), (0x0019, 0x109C), (0x0018, 0x9005)):
+        element = ds.get(tag)
+        if element is not None and element.value:
+            return _private_str(element)
+    return ''
+
+
+def series_signature(ds):
+    """Header values that tell the series of an instance apart, as nibabel's is_same_series compares them"""
+    return [str(ds.get(keyword, '')) for keyword in (
+        'SeriesInstanceUID', 'SeriesNumber', 'ImageType', 'EchoNumbers', 'Rows', 'Columns',
+        'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness', 'SpacingBetweenSlices')] \
+        + [sequence_name(ds)]
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def series_entry(ds, component=None):
+    """Create the index entry of a series from the header of its first instance
+
+    Besides the series identity, the entry keeps the header fields heudiconv
+    puts into its seqinfo, so that a study can be classified from the index alone.
+    """
+    return {
+        'series_uid': str(ds.get('SeriesInstanceUID', '')),
+        'series_number': int(ds.get('SeriesNumber', 0) or 0),
+        'series_description': str(ds.get('SeriesDescription', '')),
+        'protocol_name': str(ds.get('ProtocolName', '')),
+        'sequence_name': sequence_name(ds),
+        'image_type': [str(v) for v in ds.get('ImageType', [])],
+        'component': component,
+        'echo_number': int(ds.get('EchoNumbers', 0) or 0) or None,
+        'echo_time': _float(ds.get('EchoTime')),
+        'repetition_time': _float(ds.get('RepetitionTime')),
+        'rows': int(ds.get('Rows', 0) or 0),
+        'columns': int(ds.get('Columns', 0) or 0),
+        'number_of_frames': int(ds.get('NumberOfFrames', 1) or 1),
+        'temporal_positions': int(ds.get('NumberOfTemporalPositions', 0) or 0) or None,
+        # Siemens NumberOfImagesInMosaic
+        'mosaic_slices': _private_int(ds.get((0x0019, 0x100A))),
+        'patient_id': str(ds.get('PatientID', '')),
+        'patient_age': str(ds.get('PatientAge', '')),
+        'patient_sex': str(ds.get('PatientSex', '')),
+        'study_uid': str(ds.get('StudyInstanceUID', '')),
+        'study_date': str(ds.get('StudyDate', '')),
+        'study_description': str(ds.get('StudyDescription', '')),
+        'referring_physician_name': str(ds.get('ReferringPhysicianName', '')),
+        'accession_number': str(ds.get('AccessionNumber', '')),
+        'acq_time': acquisition_time(ds),
+        'seqinfo_date_time': list(seqinfo_date_time(ds)),
+        'n_files': 0,
+        'instances': [],
+        # Whether all instances share the header values of series_signature()
+        'uniform': True,
+        '_signature': series_signature(ds),
+    }
+
+
+def add_instance(entry, ds, filename=None):
+    """Account for one more instance (file filename in the series directory) of a series in its index entry"""
+    entry['n_files'] += 1
+    if filename is not None:
+        entry['instances'].append([int(ds.get('InstanceNumber', 0) or 0), filename])
+    if entry['uniform'] and series_signature(ds) != entry['_signature']:
+        entry['uniform'] = False
+    if entry.get('_listed'):
+        # Echo times are incomplete once instances were indexed from DICOMDIR records
+        return
+    echo_time = _float(ds.get('EchoTime'))
+    echo_times = entry.setdefault('echo_times', [])
+    if echo_time is not None and echo_time not in echo_times:
+        echo_times.append(echo_time)
+        echo_times.sort()
+
+
+def add_listed_instance(entry, instance_number, filename):
+    """Account for an instance known only from its DICOMDIR record (see bh_dicomdir.py)
+
+    Its header was not read: the series no longer counts as uniform and its
+    echo times are left out, so that later stages read them from the files.
+    """
+    entry['n_files'] += 1
+    entry['instances'].append([int(instance_number or 0), filename])
+    entry['uniform'] = False
+    entry['_listed'] = True
+    entry.pop('echo_times', None)
+
+
+def remove_instance(entry, filename):
+    """Take back add_instance() / add_listed_instance() for an instance that could not be written
+
+    The header values taken from it (echo times, uniformity) are kept.
+    """
+    entry['n_files'] -= 1
+    for instance in entry['instances']:
+        if instance[1] == filename:
+            entry['instances'].remove(instance)
+            break
+    if entry.get('example_file') == filename and entry['instances']:
+        entry['example_file'] = entry['instances'][0][1]
+
+
+def uid_dir_name(name, series_uid, owners):
+    """Series directory name keyed on series_uid: name + '__' + the start of its SHA-1
+
+    The name does not depend on which series is sorted first, so series can be
+    sorted independently. owners ({directory name: SeriesInstanceUID}) is
+    updated; a name owned by another series takes a longer part of the digest.
+    """
+    import hashlib
+
+    digest = hashlib.sha1(series_uid.encode()).hexdigest()
+    for length in range(8, len(digest) + 1, 4):
+        candidate = f'{name}__{digest[:length]}'
+        if owners.setdefault(candidate, series_uid) == series_uid:
+            return candidate
+    raise ValueError(f'no free directory name for series {series_uid} ({name})')
+
+
+def strip_uid_suffix(dir_name):
+    """Series directory name without the suffix of uid_dir_name()"""
+    return UID_SUFFIX_RE.sub('', dir_name)
+
+
+def series_by_uid(index):
+    """Return {SeriesInstanceUID: [series directory name, ...]} of a series index"""
+    by_uid = {}
+    for name, entry in sorted(index.items()):
+        by_uid.setdefault(entry.get('series_uid', ''), []).append(name)
+    return by_uid
+
+
+def index_path(subject_dir):
+    return os.path.join(subject_dir, INDEX_NAME)
+
+
+def read_index(subject_dir):
+    """Return {series directory name: entry} for a sorted subject directory ({} if not indexed)"""
+    try:
+        with open(index_path(subject_dir), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get('version') != INDEX_FORMAT_VERSION:
+        return {}
+    return index.get('series', {})
+
+
+def write_index(subject_dir, series):
+    """Write (merge into) the index of a sorted subject directory and return the merged series"""
+    merged = read_index(subject_dir)
+    for name, entry in series.items():
+        entry = {key: value for key, value in entry.items() if not key.startswith('_')}
+        if 'instances' in entry:
+            entry['instances'] = sorted(entry['instances'])
+        merged[name] = entry
+    tmp_file = index_path(subject_dir) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': INDEX_FORMAT_VERSION, 'series': merged, 'series_uids': series_by_uid(merged)},
+                  f, indent=2, sort_keys=True)
+    os.replace(tmp_file, index_path(subject_dir))
+    return merged
@@ -0,0 +1,425 @@
+# Local server for repeated sort and post-processing runs
+# A watcher or scheduler that runs the tools many times a day pays for the
+# imports (pydicom, pandas) and for parsing the same sidecars on every call.
+# 'batch-heudiconv serve' keeps one process with the libraries imported, the
+# sidecar cache (bh_sidecar_cache.py) and the Study objects of the studies it
+# has seen. When it is running, 'batch-heudiconv sort|fix-intendedfor|reorganize-fmaps',
+# bh_dcm_sort_uid.py, bh_fix_intendedfor.py and bh_reorganize_fieldmaps.py hand
+# their command line to it instead of running it themselves:
+#
+#   client --(Unix socket: argv, cwd, BH_SIDECAR_CACHE*, umask, stdin/stdout/stderr)--> server
+#   client <------------------------------ exit code ---------------------------------- server
+#
+# The server runs the command in its own process, one request at a time, with
+# the client's working directory, umask, standard streams and the environment
+# variables the tools read (FORWARDED_ENV), so the output and the exit code are
+# the same as for a local run. A client that finds the server busy with another
+# request runs its command locally instead of waiting, so parallel runs stay
+# parallel. Without a server (or with BH_NO_SERVER set) the tools run locally
+# as before.
+#
+# The socket lives in a directory only its user can enter. Both sides check
+# that the other runs as the same user (SO_PEERCRED), and the client also
+# checks the owner and mode of the socket, so that it never sends its terminal
+# to a socket created by someone else.
+
+import os
+import sys
+import json
+import stat
+import time
+
+# Modules whose main(argv) the server runs, by the program name clients send
+MODULE_PROGRAMS = ('bh_dcm_sort_uid', 'bh_fix_intendedfor', 'bh_reorganize_fieldmaps')
+
+# Imported when the server starts
+WARM_MODULES = ('pydicom', 'pandas') + MODULE_PROGRAMS
+
+# Environment variables the served tools read, passed on from the client
+FORWARDED_ENV = ('BH_SIDECAR_CACHE', 'BH_SIDECAR_CACHE_SIZE')
+
+# Seconds a client waits for the server to take its request before running it locally
+BUSY_TIMEOUT = 0.2
+
+# Sent by the server when it takes a connection
+READY = b'R'
+
+
+class ServerError(Exception):
+    """A socket or socket directory that must not be used"""
+
+
+def socket_path():
+    """Path of the server socket: $BH_SERVER_SOCKET, else batch-heudiconv/server.sock in $XDG_RUNTIME_DIR or /tmp
+
+    Without $XDG_RUNTIME_DIR the directory is /tmp/batch-heudiconv-<uid>.
+    """
+    path = os.environ.get('BH_SERVER_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, 'batch-heudiconv', 'server.sock')
+    return os.path.join(f'/tmp/batch-heudiconv-{os.getuid()}', 'server.sock')
+
+
+def _check_private(path, kind, mode):
+    """Raise ServerError unless path is a kind (stat.S_ISDIR, ...) owned by this user with exactly mode"""
+    st = os.lstat(path)
+    if not kind(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != mode:
+        raise ServerError(f"{path} is not owned by this user with mode {mode:o}")
+
+
+def _socket_dir(path):
+    """Create the directory of the socket (mode 700) or check an existing one"""
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    _check_private(directory, stat.S_ISDIR, 0o700)
+
+
+def _peer_uid(sock):
+    """User id of the process at the other end of a Unix socket (None if unknown)"""
+    import socket
+    import struct
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _connect(path, timeout=None):
+    """Socket connected to a server of this user at path, which has taken the connection
+
+    Returns None if no server is listening, or if it did not take the
+    connection within timeout seconds (busy with another request).
+
+    Raises:
+        ServerError: the socket, or the process listening on it, belongs to another user
+    """
+    import socket
+
+    try:
+        _check_private(path, stat.S_ISSOCK, 0o600)
+    except FileNotFoundError:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if _peer_uid(sock) not in (None, os.getuid()):
+            raise ServerError(f"{path} is served by another user")
+        sock.settimeout(timeout)
+        if sock.recv(1) != READY:
+            sock.close()
+            return None
+        sock.settimeout(None)
+    except ServerError:
+        sock.close()
+        raise
+    except OSError:
+        # Includes socket.timeout
+        sock.close()
+        return None
+    return sock
+
+
+def _send(sock, request, fds=()):
+    import socket
+
+    socket.send_fds(sock, [b'R'], list(fds))
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+
+def _std_fds():
+    """File descriptors 0-2 of this process (/dev/null for any that is closed)"""
+    fds = []
+    for fd in (0, 1, 2):
+        try:
+            os.fstat(fd)
+            fds.append(fd)
+        except OSError:
+            fds.append(os.open(os.devnull, os.O_RDWR))
+    return fds
+
+
+def forward(program, argv):
+    """Run a command line on the server; returns its exit code
+
+    Returns None (run the command locally) if no server is running, if it is
+    busy with another request or if its socket cannot be trusted.
+    """
+    if os.environ.get('BH_NO_SERVER'):
+        return None
+    path = socket_path()
+    if not os.path.lexists(path):
+        return None
+    try:
+        sock = _connect(path, BUSY_TIMEOUT)
+    except (ServerError, OSError) as e:
+        print(f"Warning: Not using the batch-heudiconv server: {e}", file=sys.stderr)
+        return None
+    if sock is None:
+        return None
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {'program': program, 'argv0': sys.argv[0], 'argv': list(argv), 'cwd': os.getcwd(),
+               'env': {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ},
+               'umask': umask}
+    with sock:
+        _send(sock, request, _std_fds())
+        reply = sock.makefile('rb').readline()
+    if not reply:
+        print("Error: The batch-heudiconv server stopped before the command finished", file=sys.stderr)
+        return 1
+    return json.loads(reply)['exit']
+
+
+def run_served(program, main, commands=None):
+    """Entry point of a served tool: forward sys.argv to the server if one is running, else run main()
+
+    With commands, only command lines starting with one of them are forwarded.
+    """
+    argv = sys.argv[1:]
+    if commands is None or (argv and argv[0] in commands):
+        status = forward(program, argv)
+        if status is not None:
+            return status
+    return main()
+
+
+class Studies:
+    """Study objects kept between requests, per working directory
+
+    A study is loaded again when its subject list or one of its series
+    indexes was changed by anything but the requests of this server.
+    """
+
+    def __init__(self):
+        self._studies = {}
+        self._used = []
+
+    @staticmethod
+    def _stamps(study_name):
+        """{file: mtime} of the subject list and the series indexes of a study"""
+        from bh_study import subjlist_path
+        from bh_series_index import INDEX_NAME
+
+        files = [subjlist_path(study_name)]
+        sorted_root = os.path.join(study_name, 'DICOM', 'sorted')
+        if os.path.isdir(sorted_root):
+            files += [os.path.join(entry.path, INDEX_NAME) for entry in os.scandir(sorted_root) if entry.is_dir()]
+        stamps = {}
+        for file in files:
+            try:
+                stamps[file] = os.stat(file).st_mtime_ns
+            except OSError:
+                pass
+        return stamps
+
+    def get(self, study_name, pregrouped=False):
+        """Study for study_name under the working directory"""
+        from bh_pipeline import Study
+
+        key = (os.getcwd(), study_name.rstrip('/'), pregrouped)
+        entry = self._studies.get(key)
+        if entry is None or entry['stamps'] != self._stamps(os.path.abspath(key[1])):
+            entry = self._studies[key] = {'study': Study(study_name, pregrouped=pregrouped), 'stamps': None}
+        self._used.append(key)
+        return entry['study']
+
+    def checkpoint(self):
+        """Take the files of the studies used by the last request as they are now"""
+        for key in self._used:
+            try:
+                self._studies[key]['stamps'] = self._stamps(os.path.join(key[0], key[1]))
+            except OSError:
+                del self._studies[key]
+        self._used = []
+
+
+def _exit_status(code):
+    """Exit code of a SystemExit code (printing a message code)"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _run(handler, request, fds):
+    """Run handler(argv) as the client would have: its cwd, environment, umask and standard streams"""
+    import traceback
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+    saved_cwd, saved_env, saved_argv = os.getcwd(), dict(os.environ), sys.argv
+    saved_umask = os.umask(request['umask'])
+    for fd, client_fd in zip((0, 1, 2), fds):
+        os.dup2(client_fd, fd)
+    try:
+        os.chdir(request['cwd'])
+        for name in FORWARDED_ENV:
+            os.environ.pop(name, None)
+        os.environ.update({name: value for name, value in request['env'].items() if name in FORWARDED_ENV})
+        sys.argv = [request.get('argv0', request['program'])] + request['argv']
+        status = handler(request['argv'])
+    except SystemExit as e:
+        status = _exit_status(e.code)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip((0, 1, 2), saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        sys.argv = saved_argv
+        os.umask(saved_umask)
+    return status if isinstance(status, int) else 1
+
+
+def _receive(conn):
+    """Read a request and the file descriptors sent with it (a client has a few seconds to send it)"""
+    import socket
+
+    conn.settimeout(5)
+    _, fds, _, _ = socket.recv_fds(conn, 1, 3)
+    try:
+        request = json.loads(conn.makefile('rb').readline())
+        conn.settimeout(None)
+        return request, fds
+    except (OSError, ValueError):
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def _listen(path):
+    """Listening socket at path (None if a server is already listening there)
+
+    Raises:
+        ServerError: the socket directory (or a socket left there) belongs to another user
+    """
+    import socket
+
+    _socket_dir(path)
+    if os.path.lexists(path):
+        _check_private(path, stat.S_ISSOCK, 0o600)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return None
+        except OSError:
+            # Left behind by a server that did not exit cleanly
+            os.unlink(path)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+    return listener
+
+
+def serve(programs, studies=None):
+    """Serve requests until stopped; programs maps the program names clients send to main(argv) functions
+
+    studies (Studies) is the Study cache the programs use, if any.
+
+    Returns:
+        int: Exit code (1 if a server is already running)
+    """
+    import importlib
+    from bh_sidecar_cache import save_all
+
+    path = socket_path()
+    try:
+        listener = _listen(path)
+    except ServerError as e:
+        print(f"Error: {e}")
+        print("Please set BH_SERVER_SOCKET to a path in a directory of your own")
+        return 1
+    if listener is None:
+        print(f"Error: A batch-heudiconv server is already running at {path}")
+        print("Please run: batch-heudiconv serve --stop")
+        return 1
+    programs = dict(programs)
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+    for module in MODULE_PROGRAMS:
+        programs.setdefault(module, sys.modules[module].main)
+    # Output of the commands reaches the clients in order with that of their subprocesses
+    sys.stdout.reconfigure(line_buffering=True)
+    print(f"batch-heudiconv server listening on {path} (pid {os.getpid()})", flush=True)
+
+    try:
+        while True:
+            conn, _ = listener.accept()
+            with conn:
+                try:
+                    if _peer_uid(conn) not in (None, os.getuid()):
+                        continue
+                    conn.sendall(READY)
+                    request, fds = _receive(conn)
+                except (OSError, ValueError):
+                    continue
+                try:
+                    if request.get('stop'):
+                        conn.sendall(json.dumps({'exit': 0}).encode() + b'\n')
+                        break
+                    handler = programs.get(request.get('program'))
+                    if handler is None or len(fds) != 3:
+                        conn.sendall(json.dumps({'exit': 1}).encode() + b'\n')
+                        continue
+                    start = time.time()
+                    status = _run(handler, request, fds)
+                    save_all()
+                    if studies is not None:
+                        studies.checkpoint()
+                    print(f"{request['program']} {' '.join(request['argv'])} (in {request['cwd']}): "
+                          f"exit {status} after {time.time() - start:.2f} s", flush=True)
+                    try:
+                        conn.sendall(json.dumps({'exit': status}).encode() + b'\n')
+                    except OSError:
+                        pass
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+    print("batch-heudiconv server stopped")
+    return 0
+
+
+def stop():
+    """Stop the server; returns an exit code"""
+    path = socket_path()
+    try:
+        # Waits for the request the server is running
+        sock = _connect(path)
+    except ServerError as e:
+        print(f"Error: {e}")
+        return 1
+    if sock is None:
+        print(f"No batch-heudiconv server is running at {path}")
+        return 1
+    with sock:
+        _send(sock, {'stop': True})
+        sock.makefile('rb').readline()
+    print(f"Stopped the batch-heudiconv server at {path}")
+    return 0
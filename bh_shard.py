@@ -0,0 +1,115 @@
+# Partitioning of a study into shards converted on separate machines
+# The sessions of the subject list are split into shards of balanced
+# estimated DICOM volume (see bh_resources.py). Each shard gets a subject list
+# of its own (tmp/shards/shard_NNN.tsv), converts into a private BIDS root
+# (bids/shards/shard_NNN) and writes a marker when all its sessions converted.
+# tmp/shards/manifest.json describes the shards and tmp/shards/shards.sbatch
+# runs them as a SLURM array job.
+
+import os
+import json
+import heapq
+import shlex
+
+MANIFEST_VERSION = 1
+
+
+def shard_dir(study_name):
+    return os.path.join(study_name, 'tmp', 'shards')
+
+
+def manifest_path(study_name):
+    return os.path.join(shard_dir(study_name), 'manifest.json')
+
+
+def shard_name(k):
+    return f'shard_{k:03d}'
+
+
+def shard_subjlist(study_name, k):
+    return os.path.join(shard_dir(study_name), f'{shard_name(k)}.tsv')
+
+
+def shard_done_marker(study_name, k):
+    return os.path.join(shard_dir(study_name), f'{shard_name(k)}.done')
+
+
+def shard_output(study_name, k):
+    """Private BIDS root of a shard"""
+    return os.path.join(study_name, 'bids', 'shards', shard_name(k))
+
+
+def partition(items, n_shards):
+    """Split (item, cost) pairs into n_shards lists of balanced total cost
+
+    Items are placed largest first, each into the shard with the lowest total
+    so far (longest processing time first). Empty shards are dropped.
+
+    Returns:
+        list: [(total cost, [item, ...]), ...]
+    """
+    shards = [[] for _ in range(max(1, n_shards))]
+    heap = [(0.0, k) for k in range(len(shards))]
+    totals = [0.0] * len(shards)
+    for item, cost in sorted(items, key=lambda pair: -pair[1]):
+        total, k = heapq.heappop(heap)
+        shards[k].append(item)
+        totals[k] = total + cost
+        heapq.heappush(heap, (totals[k], k))
+    return [(totals[k], shards[k]) for k in range(len(shards)) if shards[k]]
+
+
+def write_manifest(study_name, pattern, shards):
+    """Write tmp/shards/manifest.json
+
+    Args:
+        shards: [{'sessions': [Session, ...], 'cost': ..., 'memory_mb': ...}, ...]
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'study': study_name,
+        'pattern': pattern,
+        'shards': [{
+            'shard': k,
+            'subjlist': os.path.relpath(shard_subjlist(study_name, k), study_name),
+            'output': os.path.relpath(shard_output(study_name, k), study_name),
+            'directories': [s.directory for s in shard['sessions']],
+            'cost': round(shard['cost'], 1),
+            'memory_mb': shard['memory_mb'],
+        } for k, shard in enumerate(shards)],
+    }
+    with open(manifest_path(study_name), 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+    return manifest
+
+
+def read_manifest(study_name):
+    with open(manifest_path(study_name), 'r') as f:
+        return json.load(f)
+
+
+def render_sbatch(study_name, batchpath, n_shards, jobs=1, cpus_per_job=1, memory_mb=None, scratch=None):
+    """SLURM array job running one shard per array task
+
+    scratch is written in double quotes, so that e.g. $TMPDIR expands on the node.
+    """
+    workdir = os.path.dirname(os.path.abspath(study_name))
+    command = [os.path.join(batchpath, 'batch-heudiconv'), 'run-shard', study_name]
+    lines = [
+        '#!/bin/bash',
+        f'#SBATCH --job-name=bh_{study_name}',
+        f'#SBATCH --array=0-{n_shards - 1}',
+        f'#SBATCH --cpus-per-task={jobs * cpus_per_job}',
+    ]
+    if memory_mb:
+        lines.append(f'#SBATCH --mem={memory_mb}M')
+    lines += [
+        f'#SBATCH --output={os.path.join(workdir, shard_dir(study_name), "slurm_%A_%a.log")}',
+        '',
+        f'cd {shlex.quote(workdir)}',
+        f'{" ".join(shlex.quote(c) for c in command)} "${{SLURM_ARRAY_TASK_ID}}" '
+        f'--jobs {jobs} --cpus-per-job {cpus_per_job}' + (f' --scratch "{scratch}"' if scratch else ''),
+        '',
+    ]
+    return '\n'.join(lines)
@@ -0,0 +1,180 @@
+# Shared cache of parsed BIDS sidecar JSON files
+# Used by the post-processing tools (bh_reorganize_fieldmaps.py, bh_fix_intendedfor.py)
+# and by heuristics so that each sidecar is parsed once per dataset.
+#
+# Entries are keyed by absolute path and validated against the file's mtime and size,
+# so a sidecar rewritten by any tool is parsed again on the next access.
+# Set BH_SIDECAR_CACHE=<file> (or pass --sidecar-cache to the tools) to keep the cache
+# on disk and share it between the tools of one post-processing run. The tools
+# (and their worker processes) save it when they finish; saving merges their
+# entries into the file under a lock, so concurrent runs add to it.
+
+import os
+import json
+import atexit
+import collections
+
+# Maximum number of sidecars kept in memory (and on disk)
+DEFAULT_MAX_ENTRIES = 20000
+
+CACHE_FORMAT_VERSION = 1
+
+
+class SidecarCache:
+    """LRU-bounded cache of parsed sidecars, optionally persisted to a JSON file
+
+    The dictionaries returned by load() are shared with the cache;
+    callers must copy them before making changes.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_file=None):
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # Paths stored or discarded since the last save
+        self._changed = set()
+        self._discarded = set()
+        if cache_file:
+            self._read_cache_file()
+
+    def _saved_entries(self):
+        """Entries in cache_file ({} if it is missing or unreadable)"""
+        try:
+            with open(self.cache_file, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if saved.get('version') != CACHE_FORMAT_VERSION:
+            return {}
+        return {path: tuple(entry) for path, entry in saved.get('entries', {}).items()}
+
+    def _read_cache_file(self):
+        self._entries.update(self._saved_entries())
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _put(self, path, mtime_ns, size, data):
+        self._entries[path] = (mtime_ns, size, data)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._changed.add(path)
+        self._discarded.discard(path)
+
+    def load(self, json_file):
+        """Return the parsed content of json_file, parsing it only if it changed
+
+        Raises the same exceptions as open() and json.load().
+        """
+        path = os.path.abspath(json_file)
+        st = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self._put(path, st.st_mtime_ns, st.st_size, data)
+        return data
+
+    def store(self, json_file, data):
+        """Record data just written to json_file so it need not be parsed again"""
+        path = os.path.abspath(json_file)
+        st = os.stat(path)
+        self._put(path, st.st_mtime_ns, st.st_size, data)
+
+    def rename(self, old_file, new_file):
+        """Follow a rename of a sidecar (renaming keeps mtime and size)"""
+        entry = self._entries.pop(os.path.abspath(old_file), None)
+        self._forget(os.path.abspath(old_file))
+        if entry is not None:
+            self._put(os.path.abspath(new_file), *entry)
+
+    def discard(self, json_file):
+        """Forget a sidecar, e.g. after it was deleted"""
+        self._entries.pop(os.path.abspath(json_file), None)
+        self._forget(os.path.abspath(json_file))
+
+    def _forget(self, path):
+        self._changed.discard(path)
+        self._discarded.add(path)
+
+    def save(self):
+        """Merge the changes since the last save into cache_file (if any)
+
+        The file is rewritten under an flock (cache_file + '.lock'): the
+        entries other processes saved in the meantime are kept, those stored
+        here replace them and those discarded here are dropped.
+        """
+        if not self.cache_file or not (self._changed or self._discarded):
+            return
+        # bh_merge is only needed (and imported) for saving
+        from bh_merge import locked
+
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        with locked(f"{self.cache_file}.lock"):
+            entries = collections.OrderedDict(self._saved_entries())
+            for path in self._discarded:
+                entries.pop(path, None)
+            for path in self._changed:
+                if path in self._entries:
+                    entries.pop(path, None)
+                    entries[path] = self._entries[path]
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': CACHE_FORMAT_VERSION,
+                           'entries': {path: list(entry) for path, entry in entries.items()}}, f)
+            os.replace(tmp_file, self.cache_file)
+        self._changed = set()
+        self._discarded = set()
+
+
+# One cache per cache file (None: in memory only), and the one in use
+_caches = {}
+_cache = None
+
+
+def use_cache(cache_file=None):
+    """Make the cache persisted to cache_file (default: $BH_SIDECAR_CACHE) the one in use and return it
+
+    Each cache file gets its own cache, created on first use, so a process
+    serving several runs (see bh_server.py) reads and writes the file each run
+    names. Without a file the cache is kept in memory only.
+    Callers save() it when they finish; as a fallback it is saved when the
+    process exits normally (which worker processes of a pool do not).
+    """
+    global _cache
+    cache_file = cache_file or os.environ.get('BH_SIDECAR_CACHE') or None
+    if cache_file not in _caches:
+        if not _caches:
+            atexit.register(save_all)
+        max_entries = int(os.environ.get('BH_SIDECAR_CACHE_SIZE', DEFAULT_MAX_ENTRIES))
+        _caches[cache_file] = SidecarCache(max_entries=max_entries, cache_file=cache_file)
+    _cache = _caches[cache_file]
+    return _cache
+
+
+def get_cache(cache_file=None):
+    """Return the cache in use (see use_cache()), or the one of cache_file if given"""
+    if cache_file or _cache is None:
+        return use_cache(cache_file)
+    return _cache
+
+
+def save_all():
+    """Save every cache of this process"""
+    for cache in _caches.values():
+        cache.save()
+
+
+def load_sidecar(json_file):
+    """Parse json_file through the cache in use"""
+    return get_cache().load(json_file)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Dry-run a heuristic over a whole study without running heudiconv/dcm2niix
+# seqinfo entries are built from the sort-time series index (series_index.json)
+# or, for series sorted without it, from the header of one DICOM file per series.
+
+import os
+import sys
+import json
+import argparse
+import collections
+import importlib.util
+from bh_series_index import read_index, series_entry
+from bh_study import read_subjlist, sorted_dir
+
+# Same fields, in the same order, as heudiconv's SeqInfo
+SeqInfo = collections.namedtuple('SeqInfo', [
+    'total_files_till_now', 'example_dcm_file', 'series_id', 'dcm_dir_name',
+    'series_files', 'unspecified', 'dim1', 'dim2', 'dim3', 'dim4', 'TR', 'TE',
+    'protocol_name', 'is_motion_corrected', 'is_derived', 'patient_id',
+    'study_description', 'referring_physician_name', 'series_description',
+    'sequence_name', 'image_type', 'accession_number', 'patient_age',
+    'patient_sex', 'date', 'series_uid', 'time',
+])
+
+
+def load_heuristic(path):
+    """Import a heuristic file the way heudiconv does"""
+    spec = importlib.util.spec_from_file_location('heuristic', os.path.abspath(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not hasattr(module, 'infotodict'):
+        raise ValueError(f'{path} does not define infotodict')
+    return module
+
+
+def header_entry(series_path):
+    """Build an index entry for a series directory from one of its DICOM files"""
+    import pydicom
+
+    files = sorted(f for f in os.listdir(series_path)
+                   if os.path.isfile(os.path.join(series_path, f)))
+    for file in files:
+        try:
+            ds = pydicom.dcmread(os.path.join(series_path, file), stop_before_pixels=True)
+        except Exception:
+            continue
+        entry = series_entry(ds)
+        entry['example_file'] = file
+        entry['n_files'] = len(files)
+        return entry
+    return None
+
+
+def seqinfo_from_entry(dicom_dir, dir_name, entry, total_files_till_now, seqinfo_class=SeqInfo):
+    """Create a SeqInfo as heudiconv would for one sorted series directory
+
+    Dimensions follow heudiconv: image shape of one file plus the number of
+    files, i.e. (rows, columns, files, 1) for single-slice files and
+    (rows, columns, slices, files) for mosaics and multi-frame files.
+    seqinfo_class may be heudiconv's own SeqInfo; fields unknown here are None.
+    """
+    n_files = entry['n_files']
+    image_type = tuple(entry.get('image_type', []))
+    rows, columns = entry.get('rows', 0), entry.get('columns', 0)
+    if 'MOSAIC' in image_type and entry.get('mosaic_slices'):
+        tiles = 1
+        while tiles * tiles < entry['mosaic_slices']:
+            tiles += 1
+        dims = (rows // tiles, columns // tiles, entry['mosaic_slices'], n_files)
+    elif entry.get('number_of_frames', 1) > 1:
+        dims = (rows, columns, entry['number_of_frames'], n_files)
+    else:
+        dims = (rows, columns, n_files, 1)
+
+    protocol_name = entry.get('protocol_name') or entry.get('series_description', '')
+    repetition_time = entry.get('repetition_time')
+    if 'seqinfo_date_time' in entry:
+        date, time = entry['seqinfo_date_time']
+    else:
+        acq_time = entry.get('acq_time', 'n/a')
+        date, time = (acq_time.split('T') + [''])[:2] if acq_time != 'n/a' else ('', '')
+        date, time = date.replace('-', ''), time.replace(':', '')
+    example_file = os.path.join(dicom_dir, dir_name, entry.get('example_file', ''))
+    fields = dict(
+        total_files_till_now=total_files_till_now + n_files,
+        example_dcm_file=os.path.basename(example_file),
+        series_id=f"{entry.get('series_number', 0)}-{protocol_name}",
+        dcm_dir_name=dir_name,
+        series_files=n_files,
+        unspecified='',
+        dim1=dims[0], dim2=dims[1], dim3=dims[2], dim4=dims[3],
+        TR=repetition_time / 1000 if repetition_time else -1,
+        TE=entry.get('echo_time') or -1,
+        protocol_name=protocol_name,
+        is_motion_corrected='MOCO' in image_type,
+        is_derived='DERIVED' in [value.upper() for value in image_type],
+        patient_id=entry.get('patient_id', ''),
+        study_description=entry.get('study_description', ''),
+        referring_physician_name=entry.get('referring_physician_name', ''),
+        series_description=entry.get('series_description', ''),
+        sequence_name=entry.get('sequence_name', ''),
+        image_type=image_type,
+        accession_number=entry.get('accession_number', ''),
+        patient_age=entry.get('patient_age', ''),
+        patient_sex=entry.get('patient_sex', ''),
+        date=date,
+        series_uid=entry.get('series_uid', ''),
+        time=time,
+    )
+    return seqinfo_class(**{field: fields.get(field) for field in seqinfo_class._fields})
+
+
+def build_seqinfo(dicom_dir):
+    """Return the seqinfo list of a sorted session directory (ordered by series number)"""
+    index = read_index(dicom_dir)
+    entries = []
+    for dir_name in sorted(os.listdir(dicom_dir)):
+        series_path = os.path.join(dicom_dir, dir_name)
+        if not os.path.isdir(series_path):
+            continue
+        entry = index.get(dir_name) or header_entry(series_path)
+        if entry is not None:
+            entries.append((dir_name, entry))
+    entries.sort(key=lambda item: (item[1].get('series_number', 0), item[0]))
+
+    seqinfo = []
+    total = 0
+    for dir_name, entry in entries:
+        s = seqinfo_from_entry(dicom_dir, dir_name, entry, total)
+        total = s.total_files_till_now
+        seqinfo.append(s)
+    return seqinfo
+
+
+def key_template(key):
+    return key[0] if isinstance(key, tuple) else key
+
+
+def classify_session(heuristic, seqinfo):
+    """Run infotodict on a seqinfo list and summarize the result
+
+    Returns:
+        dict: 'mapping' {template: [series_id]}, 'unmatched' [dcm_dir_name],
+              'collisions' [description]
+    """
+    info = heuristic.infotodict(seqinfo)
+    mapping = collections.OrderedDict()
+    assigned = collections.defaultdict(list)
+    for key, series_ids in info.items():
+        template = key_template(key)
+        ids = [sid if isinstance(sid, str) else sid.get('item', str(sid)) for sid in series_ids]
+        if ids:
+            mapping[template] = ids
+        for sid in ids:
+            assigned[sid].append(template)
+
+    collisions = []
+    for sid, templates in assigned.items():
+        if len(templates) > 1:
+            collisions.append(f"series {sid} is mapped to {len(templates)} keys: {', '.join(templates)}")
+    for template, ids in mapping.items():
+        if len(ids) > 1 and '{item' not in template:
+            collisions.append(f"{len(ids)} series share key without {{item}}: {template}")
+
+    unmatched = [s.dcm_dir_name for s in seqinfo if s.series_id not in assigned]
+    return {'mapping': mapping, 'unmatched': unmatched, 'collisions': collisions}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a heuristic over all sessions of a study without converting any data',
+        epilog='''
+Examples:
+  %(prog)s my_study_2024                       # Uses code/heuristic_my_study_2024.py
+  %(prog)s my_study_2024 -f code/heuristic_HARP.py
+  %(prog)s my_study_2024 --json > tmp/simulation.json
+
+For every session in tmp/subjlist_<study_name>.tsv, heudiconv-style seqinfo
+entries are built from DICOM/sorted/<directory>/series_index.json (written
+by the sorter) or from one DICOM header per series, infotodict is called
+in-process, and the key -> series mapping, unmatched series and collisions
+are reported. Dimensions and series IDs follow heudiconv's conventions but
+are derived from headers only, so check borderline dim4 thresholds.
+        ''',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('study_name', help='Name of your research study')
+    parser.add_argument('-f', '--heuristic', help='Heuristic file (default: <study_name>/code/heuristic_<study_name>.py)')
+    parser.add_argument('--json', action='store_true', help='Print the full result as JSON')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only report sessions with unmatched series or collisions')
+    args = parser.parse_args()
+
+    study_name = args.study_name.rstrip('/')
+    heuristic_file = args.heuristic or os.path.join(study_name, 'code', f'heuristic_{study_name}.py')
+    try:
+        heuristic = load_heuristic(heuristic_file)
+        pattern, sessions = read_subjlist(study_name)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    results = []
+    n_problems = 0
+    for session in sessions:
+        dicom_dir = sorted_dir(study_name, session)
+        if not os.path.isdir(dicom_dir):
+            print(f"Warning: Sorted directory not found: {dicom_dir}", file=sys.stderr)
+            continue
+        seqinfo = build_seqinfo(dicom_dir)
+        result = classify_session(heuristic, seqinfo)
+        result.update({'directory': session.directory, 'subject': session.subject,
+                       'session': session.session, 'n_series': len(seqinfo)})
+        results.append(result)
+        problem = result['unmatched'] or result['collisions']
+        n_problems += bool(problem)
+
+        if args.json or (args.quiet and not problem):
+            continue
+        print(f"{session.subject}/{session.session} ({session.directory}): {len(seqinfo)} series")
+        for template, ids in result['mapping'].items():
+            print(f"  {template}")
+            for sid in ids:
+                print(f"    <- {sid}")
+        for dir_name in result['unmatched']:
+            print(f"  unmatched: {dir_name}")
+        for collision in result['collisions']:
+            print(f"  collision: {collision}")
+        print("")
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
+    else:
+        print(f"Simulated {len(results)} sessions with {heuristic_file}")
+        print(f"Sessions with unmatched series or collisions: {n_problems}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+# Overlapped file I/O for sorting DICOM files on high-latency storage
+# On a network file system each open/read/stat is a round trip, and sorting
+# one file at a time spends most of its time waiting on them. With io_jobs > 1
+# bh_dcm_sort_uid.py runs the work as stages connected by bounded queues:
+#
+#   enumerate (one thread) -> read + parse (io_jobs threads) -> index (caller) -> write (io_jobs threads)
+#
+# so that many requests are in flight at once. Files up to WHOLE_FILE_LIMIT are
+# read once, whole, and written from memory; larger files are parsed from
+# their header only and copied. Results reach the caller in enumeration order,
+# so the sorted tree and its series index do not depend on timing.
+#
+# One file at a time, headers on local file systems are parsed from a memory
+# mapping of the file, which touches only the pages holding the header, and
+# copies are made inside the kernel (copy_file_range, or sendfile). Files on
+# network file systems are not mapped: a file truncated on the server while
+# mapped raises SIGBUS, which would kill the sorter.
+
+import io
+import os
+import mmap
+import errno
+import queue
+import shutil
+import threading
+import collections
+import concurrent.futures
+from bh_file_types import PREFIX_SIZE, classify
+
+# Files up to this size are read in one go and written from memory
+WHOLE_FILE_LIMIT = 4 * 1024 * 1024
+
+# File systems whose files are parsed from a memory mapping (see local_file_system)
+LOCAL_FS_TYPES = ('ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'f2fs', 'jfs', 'reiserfs', 'tmpfs',
+                  'overlay', 'vfat', 'exfat', 'ntfs3', 'hfsplus')
+
+_END = object()
+
+
+def walk_files(src_dir):
+    """Yield the paths of the files under src_dir (in os.walk order)"""
+    for root, _, files in os.walk(src_dir):
+        for file in files:
+            yield os.path.join(root, file)
+
+
+def _put(q, item, stop):
+    """Put item into the bounded queue q unless stop is set first"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _enumerate(paths, q, stop):
+    try:
+        for path in paths:
+            if not _put(q, path, stop):
+                return
+    finally:
+        _put(q, _END, stop)
+
+
+def prefetch(paths, read, jobs, window=None):
+    """Yield (path, result of read(path) or the exception it raised) in the order of paths
+
+    paths is consumed by a thread of its own through a bounded queue, and up
+    to window (default 4 x jobs) reads run ahead of the caller in jobs threads.
+    """
+    window = window or 4 * jobs
+    q = queue.Queue(maxsize=window)
+    stop = threading.Event()
+    enumerator = threading.Thread(target=_enumerate, args=(paths, q, stop), daemon=True)
+    enumerator.start()
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            done = False
+            while True:
+                while not done and len(pending) < window:
+                    path = q.get()
+                    if path is _END:
+                        done = True
+                    else:
+                        pending.append((path, pool.submit(read, path)))
+                if not pending:
+                    break
+                path, future = pending.popleft()
+                try:
+                    yield path, future.result()
+                except Exception as e:
+                    yield path, e
+        finally:
+            stop.set()
+            for _, future in pending:
+                future.cancel()
+    enumerator.join()
+
+
+_fs_types = None
+
+
+def _mount_fs_types():
+    """{device number: file system type} of the mounts of this process (empty if unknown)"""
+    global _fs_types
+    if _fs_types is None:
+        _fs_types = {}
+        try:
+            with open('/proc/self/mountinfo', 'r') as f:
+                for line in f:
+                    fields, _, rest = line.partition(' - ')
+                    major, minor = fields.split()[2].split(':')
+                    _fs_types[os.makedev(int(major), int(minor))] = rest.split()[0]
+        except (OSError, ValueError, IndexError):
+            pass
+    return _fs_types
+
+
+def local_file_system(st):
+    """Whether the file of os.stat_result st is on a local file system (see LOCAL_FS_TYPES)
+
+    Files on any other file system, or whose file system is unknown, are read
+    through buffers.
+    """
+    return _mount_fs_types().get(st.st_dev) in LOCAL_FS_TYPES
+
+
+def _parse_mapped(f, st):
+    """Parse the header of the open file f from a memory mapping
+
+    Returns None if the file cannot be mapped or is not parsed completely from
+    its mapping: a file cut short in its pixel data makes the parser seek
+    past the end of the mapping.
+
+    Raises:
+        NotDicom: the file is not a DICOM dataset
+    """
+    import pydicom
+
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # File systems that cannot map files
+        return None
+    with mapped:
+        kind = classify(mapped[:PREFIX_SIZE], st.st_size)
+        try:
+            ds = pydicom.dcmread(mapped, defer_size='1 KB', force=kind == 'raw')
+        except Exception:
+            return None
+    ds.filename, ds.fileobj_type, ds.buffer, ds.timestamp = f.name, open, None, st.st_mtime
+    return ds
+
+
+def read_header(path):
+    """Classify one file from its first bytes and parse its header: returns (dataset, None, os.stat_result)
+
+    On a local file system the file is parsed from a memory mapping: values
+    over 1 KB (the pixel data, CSA headers, ...) are skipped without their
+    pages being touched, and nothing is copied through read buffers.
+    Elsewhere, and for files that cannot be parsed from their mapping (e.g.
+    with truncated pixel data, which bh_pixel_integrity.py reports), values over
+    1 KB are skipped in a buffered read. Deferred values are read from path if
+    accessed later.
+
+    Raises:
+        NotDicom: the file is not a DICOM dataset (the full parser is not run)
+    """
+    import pydicom
+
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            classify(b'', 0)
+        ds = _parse_mapped(f, st) if local_file_system(st) else None
+        if ds is None:
+            f.seek(0)
+            kind = classify(f.read(PREFIX_SIZE), st.st_size)
+            f.seek(0)
+            ds = pydicom.dcmread(f, defer_size='1 KB', force=kind == 'raw')
+    return ds, None, st
+
+
+def read_instance(path):
+    """Like read_header(), but files up to WHOLE_FILE_LIMIT are read whole: returns
+    (dataset, file contents or None if too large, os.stat_result)
+
+    The pixel data is never decoded.
+    """
+    import pydicom
+
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size > WHOLE_FILE_LIMIT:
+            kind = classify(f.read(PREFIX_SIZE), st.st_size)
+            f.seek(0)
+            return pydicom.dcmread(f, defer_size='1 KB', force=kind == 'raw'), None, st
+        data = f.read()
+    kind = classify(data[:PREFIX_SIZE], st.st_size)
+    return pydicom.dcmread(io.BytesIO(data), force=kind == 'raw'), data, st
+
+
+# copy_file_range errors meaning "not between these files": fall back to sendfile
+_NO_COPY_RANGE = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def copy_contents(src_file, dest_file):
+    """Copy the contents of src_file to dest_file without passing them through user space
+
+    copy_file_range also lets file systems clone the data or copy it on the
+    server (NFS 4.2, SMB); where it is not available shutil.copyfile uses sendfile.
+    """
+    if hasattr(os, 'copy_file_range'):
+        with open(src_file, 'rb') as src, open(dest_file, 'wb') as dest:
+            remaining = os.fstat(src.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dest.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                if e.errno not in _NO_COPY_RANGE:
+                    raise
+    shutil.copyfile(src_file, dest_file)
+
+
+def write_copy(src_file, dest_file, data=None, st=None):
+    """Copy src_file to dest_file like shutil.copy2, from data (its contents) when given"""
+    if data is None:
+        copy_contents(src_file, dest_file)
+        if st is None:
+            shutil.copystat(src_file, dest_file)
+            return
+    else:
+        with open(dest_file, 'wb') as f:
+            f.write(data)
+    os.chmod(dest_file, st.st_mode & 0o7777)
+    os.utime(dest_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+class Writer:
+    """Write files in a pool of threads, with at most max_pending writes queued"""
+
+    def __init__(self, jobs, max_pending=None):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * jobs)
+
+    def submit(self, func, *args):
+        """Run func(*args) in the pool once a slot is free (func handles its own errors)"""
+        self._slots.acquire()
+        self._pool.submit(func, *args).add_done_callback(lambda _: self._slots.release())
+
+    def close(self):
+        """Wait for all writes"""
+        self._pool.shutdown()
@@ -0,0 +1,102 @@
+# Paths and subject list of a batch-heudiconv study workspace
+# (the layout created by bh01_prep_dir.sh)
+
+import os
+import collections
+
+Session = collections.namedtuple('Session', ['directory', 'subject', 'session'])
+
+
+def subjlist_path(study_name):
+    return os.path.join(study_name, 'tmp', f'subjlist_{study_name}.tsv')
+
+
+def read_subjlist(study_name, path=None):
+    """Read tmp/subjlist_<study_name>.tsv written by bh03_make_subjlist.sh (or another file in its format)
+
+    Returns:
+        tuple: (pattern, list of Session)
+    """
+    pattern = None
+    sessions = []
+    with open(path or subjlist_path(study_name), 'r') as f:
+        header_seen = False
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('# pattern:'):
+                pattern = line[len('# pattern:'):].strip()
+                continue
+            if line.startswith('#') or not line.strip():
+                continue
+            if not header_seen:
+                header_seen = True
+                continue
+            fields = line.split('\t')
+            if len(fields) >= 3:
+                sessions.append(Session(*fields[:3]))
+    return pattern or '{subject}', sessions
+
+
+def parse_directory_name(dir_name, pattern):
+    """Return the Session of a sorted directory name under a subject list pattern (None if no match)
+
+    '{subject}_{session}' and '{subject}-{session}' split on the last separator;
+    any other pattern uses the whole name as subject and session '01'.
+    """
+    for separator in ('_', '-'):
+        if f'{{subject}}{separator}{{session}}' in pattern:
+            subject, sep, session = dir_name.rpartition(separator)
+            return Session(dir_name, subject, session) if sep else None
+    return Session(dir_name, dir_name, '01')
+
+
+def session_labels(studies, mode='order'):
+    """Label the studies (StudyInstanceUIDs) of one subject as sessions
+
+    Args:
+        studies: List of (key, StudyDate, StudyTime)
+        mode: 'order' numbers the studies 01, 02, ... by StudyDate and StudyTime;
+              'date' uses the StudyDate, with a letter for further studies on
+              the same day (20250101, 20250101b, ...)
+
+    Returns:
+        dict: {key: session label}
+    """
+    ordered = sorted(studies, key=lambda study: (study[1], study[2], study[0]))
+    if mode == 'order':
+        return {key: f'{i:02d}' for i, (key, _, _) in enumerate(ordered, start=1)}
+    labels = {}
+    seen = collections.Counter()
+    for key, date, _ in ordered:
+        date = date or 'nodate'
+        labels[key] = date if not seen[date] else f"{date}{chr(ord('a') + seen[date])}"
+        seen[date] += 1
+    return labels
+
+
+def write_subjlist(study_name, pattern, sessions, path=None):
+    """Write tmp/subjlist_<study_name>.tsv (or path): pattern comment, header, one row per session"""
+    with open(path or subjlist_path(study_name), 'w') as f:
+        f.write(f'# pattern: {pattern}\n')
+        f.write('directory\tsubject_ID\tsession\n')
+        for session in sessions:
+            f.write('\t'.join(session) + '\n')
+
+
+def uses_session(pattern):
+    """Whether BIDS output of this study has ses-* levels (the heuristics use {session})"""
+    return '{session}' in pattern
+
+
+def bids_session_dir(study_name, session, with_session=True, rawdata=None):
+    """Return (directory, filename prefix) of a subject/session in bids/rawdata (or another BIDS root)"""
+    path = os.path.join(rawdata or os.path.join(study_name, 'bids', 'rawdata'), f'sub-{session.subject}')
+    prefix = f'sub-{session.subject}'
+    if with_session:
+        path = os.path.join(path, f'ses-{session.session}')
+        prefix = f'{prefix}_ses-{session.session}'
+    return path, prefix
+
+
+def sorted_dir(study_name, session):
+    return os.path.join(study_name, 'DICOM', 'sorted', session.directory)
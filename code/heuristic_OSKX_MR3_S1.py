@@ -2,7 +2,32 @@
 # K. Nemoto 03 Jan 2026
 
 import os
+import re
 import json
+import shutil
+
+# The bh_*.py modules are importable when batch-heudiconv runs heudiconv (it puts
+# its directory on PYTHONPATH); plain heudiconv runs fall back to local code
+
+def load_sidecar(json_file):
+    try:
+        from bh_sidecar_cache import load_sidecar as cached_load_sidecar
+    except ImportError:
+        with open(json_file, 'r') as f:
+            return json.load(f)
+    return cached_load_sidecar(json_file)
+
+# GE fieldmap series split by image component at sort time
+# (bh02_sort_dicom.sh --split-fieldmaps) are converted by bh_convert_ge_fieldmaps.py
+SPLIT_COMPONENT_SUFFIXES = ('_magnitude', '_phase', '_real', '_imaginary')
+
+def strip_uid_suffix(dir_name):
+    """Series directory name without the __<hex> suffix of bh02_sort_dicom.sh --series-key uid"""
+    try:
+        from bh_series_index import strip_uid_suffix as strip
+    except ImportError:
+        return re.sub(r'__[0-9a-f]{8,40}$', '', dir_name)
+    return strip(dir_name)
 
 def create_key(template, outtype=('nii.gz',), annotation_classes=None):
     if template is None or not template:
@@ -132,6 +157,11 @@ def infotodict(seqinfo):
         #    info[fmap_AP].append(s.series_id)
 
         # Fieldmap (magnitude and phase: GE)
+        # Series split at sort time already have their final names; leave them
+        # to bh_convert_ge_fieldmaps.py
+        if strip_uid_suffix(s.dcm_dir_name).endswith(SPLIT_COMPONENT_SUFFIXES):
+            continue
+
         # Do not classify anything here - let heudiconv convert everything first
         # The classification will be done in the MetadataExtras
         if '2D-field_map1' in s.dcm_dir_name:
@@ -147,7 +177,6 @@ def infotodict(seqinfo):
 # Add metadata extractor function to handle the post-processing
 def MetadataExtras(outdict):
     """Add additional metadata and reorganize fieldmap files"""
-    import shutil
     import glob
     
     # Find all fmap files
@@ -162,8 +191,7 @@ def MetadataExtras(outdict):
             
             try:
                 # Read JSON to check ImageType
-                with open(json_file, 'r') as f:
-                    metadata = json.load(f)
+                metadata = load_sidecar(json_file)
                     
                 if 'ImageType' in metadata:
                     image_type_list = metadata['ImageType']
@@ -200,6 +228,11 @@ def MetadataExtras(outdict):
                             if os.path.exists(new_json):
                                 os.remove(new_json)
                             shutil.move(json_file, new_json)
+                            try:
+                                from bh_sidecar_cache import get_cache
+                                get_cache().rename(json_file, new_json)
+                            except ImportError:
+                                pass
                             
                         if new_nii != nii_file and os.path.exists(nii_file):
                             if os.path.exists(new_nii):
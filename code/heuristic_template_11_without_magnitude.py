@@ -1,6 +1,8 @@
 # heuristic file for images which have fieldmap with two different TEs in one magnitude image
 # Usage: Use heuristic_*_without_magnitude.py to convert images except for magnitude fieldmap.
 #        Then, use heuristic_*_12_magnitude.py to convert magnitude fieldmap
+#        Or, save them as code/heuristic_<study>.py and code/heuristic_<study>_magnitude.py
+#        and run bh_convert_double_echo.py <study> to do both in a single heudiconv run
 # 30 Mar 2023 K.Nemoto
 
 import os
@@ -0,0 +1,38 @@
+# heuristic file using a rule table instead of if-statements
+# The keys and series matching rules are declared as data below and compiled
+# once by bh_heuristic_rules.py (shipped with the batch-heudiconv scripts,
+# which put their directory on PYTHONPATH when they run heudiconv).
+
+from bh_heuristic_rules import make_infotodict
+
+RULES = {
+    ##### list keys for t1w, t2w, dwi, rs-fMRI, and fieldmaps below ############
+    'keys': {
+        't1w': 'sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T1w',
+        't2w': 'sub-{subject}/{session}/anat/sub-{subject}_{session}_run-{item:02d}_T2w',
+        'func_rest_PA': 'sub-{subject}/{session}/func/sub-{subject}_{session}_task-rest_dir-PA_run-{item:02d}_bold',
+        'func_rest_AP': 'sub-{subject}/{session}/func/sub-{subject}_{session}_task-rest_dir-AP_run-{item:02d}_bold',
+        'dwi_PA': 'sub-{subject}/{session}/dwi/sub-{subject}_{session}_dir-PA_run-{item:02d}_dwi',
+        'dwi_AP': 'sub-{subject}/{session}/dwi/sub-{subject}_{session}_dir-AP_run-{item:02d}_dwi',
+        'fmap_mag': 'sub-{subject}/{session}/fmap/sub-{subject}_{session}_magnitude',
+        'fmap_phase': 'sub-{subject}/{session}/fmap/sub-{subject}_{session}_phasediff',
+    },
+
+    ##### series matching rules ###############################################
+    # contains/excludes: substrings of the sorted DICOM directory name
+    # regex: regular expression searched in the directory name
+    # min_dim4/max_dim4: number of volumes
+    # image_type: element of the DICOM ImageType (e.g. 'M' or 'P')
+    'rules': [
+        {'key': 't1w', 'contains': ['dir_name_for_T1']},
+        {'key': 't2w', 'contains': ['dir_name_for_T2']},
+        {'key': 'func_rest_PA', 'contains': ['BOLD_REST1_PA'], 'excludes': ['SBRef'], 'min_dim4': 200},
+        {'key': 'func_rest_AP', 'contains': ['BOLD_REST1_AP'], 'excludes': ['SBRef'], 'min_dim4': 200},
+        {'key': 'dwi_PA', 'contains': ['DWI_PA'], 'excludes': ['SBRef'], 'min_dim4': 30},
+        {'key': 'dwi_AP', 'contains': ['DWI_AP'], 'excludes': ['SBRef'], 'min_dim4': 30},
+        {'key': 'fmap_mag', 'contains': ['Field_mapping'], 'image_type': 'M'},
+        {'key': 'fmap_phase', 'contains': ['Field_mapping'], 'image_type': 'P'},
+    ],
+}
+
+infotodict = make_infotodict(RULES)
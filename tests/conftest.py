@@ -0,0 +1,5 @@
+# The bh_*.py modules live at the top of the repository, next to batch-heudiconv
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
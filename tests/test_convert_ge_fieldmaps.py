@@ -0,0 +1,51 @@
+import pytest
+
+from bh_convert_ge_fieldmaps import fieldmap_basenames, split_fieldmap_series
+from bh_dcm2niix import ConversionError
+
+PREFIX = 'sub-01_ses-01'
+
+
+def entry(component, series_number):
+    return {'component': component, 'series_number': series_number}
+
+
+def test_split_fieldmap_series():
+    index = {
+        '2D-field_map1_magnitude__0123abcd': entry('magnitude', 5),
+        '2D-field_map1_phase': entry('phase', 5),
+        'T1_MPRAGE': entry(None, 2),
+        'Phase_contrast': entry('phase', 7),
+    }
+    assert [name for name, _ in split_fieldmap_series(index)] == [
+        '2D-field_map1_magnitude__0123abcd', '2D-field_map1_phase']
+
+
+def test_numbered_from_series_description():
+    series = [
+        ('2D-field_map2_magnitude', entry('magnitude', 5)),
+        ('2D-field_map2_phase__0123abcd', entry('phase', 5)),
+        ('2D-field_map1_magnitude', entry('magnitude', 7)),
+        ('2D-field_map1_phase', entry('phase', 7)),
+    ]
+    assert [basename for _, _, basename in fieldmap_basenames(series, PREFIX)] == [
+        f'{PREFIX}_magnitude2', f'{PREFIX}_phase2', f'{PREFIX}_magnitude1', f'{PREFIX}_phase1']
+
+
+def test_numbered_by_series_order_without_number():
+    series = [
+        ('B0map_phase', entry('phase', 9)),
+        ('B0map_magnitude', entry('magnitude', 9)),
+        ('GRE_fmap_magnitude', entry('magnitude', 4)),
+    ]
+    assert [basename for _, _, basename in fieldmap_basenames(series, PREFIX)] == [
+        f'{PREFIX}_phase2', f'{PREFIX}_magnitude2', f'{PREFIX}_magnitude1']
+
+
+def test_same_basename_twice():
+    series = [
+        ('field_map1_magnitude', entry('magnitude', 5)),
+        ('field_map1_magnitude__0123abcd', entry('magnitude', 6)),
+    ]
+    with pytest.raises(ConversionError, match='would both be converted'):
+        fieldmap_basenames(series, PREFIX)
@@ -0,0 +1,66 @@
+import pytest
+
+from bh_dag import Task, run_graph, DONE, FAILED, SKIPPED
+
+
+def succeed(value):
+    print(f"value {value}")
+    return value
+
+
+def fail(message):
+    raise RuntimeError(message)
+
+
+def test_all_tasks_done():
+    results = []
+    tasks = [
+        Task('a', 'sort', succeed, (1,), on_done=results.append),
+        Task('b', 'convert', succeed, (2,), deps=['a'], on_done=results.append),
+    ]
+    assert run_graph(tasks, {}) == {'a': DONE, 'b': DONE}
+    assert results == [1, 2]
+
+
+def test_failure_skips_dependents_only():
+    tasks = [
+        Task('sort_s1', 'sort', fail, ('bad DICOM',)),
+        Task('convert_s1', 'convert', succeed, (1,), deps=['sort_s1']),
+        Task('post_s1', 'post', succeed, (1,), deps=['convert_s1']),
+        Task('sort_s2', 'sort', succeed, (2,)),
+        Task('convert_s2', 'convert', succeed, (2,), deps=['sort_s2']),
+    ]
+    status = run_graph(tasks, {'sort': 2})
+    assert status == {
+        'sort_s1': FAILED,
+        'convert_s1': SKIPPED,
+        'post_s1': SKIPPED,
+        'sort_s2': DONE,
+        'convert_s2': DONE,
+    }
+
+
+def test_failure_output_is_printed(capsys):
+    run_graph([Task('sort_s1', 'sort', fail, ('bad DICOM',))], {})
+    assert 'Error: bad DICOM' in capsys.readouterr().out
+
+
+def test_deferred_arguments_see_finished_dependencies():
+    produced = {}
+    tasks = [
+        Task('a', 'sort', succeed, (3,), on_done=lambda value: produced.update(a=value)),
+        Task('b', 'convert', succeed, lambda: (produced['a'] * 2,), deps=['a'],
+             on_done=lambda value: produced.update(b=value)),
+    ]
+    run_graph(tasks, {})
+    assert produced == {'a': 3, 'b': 6}
+
+
+@pytest.mark.parametrize('deps', [['missing'], ['b']])
+def test_unknown_or_later_dependency(deps):
+    tasks = [
+        Task('a', 'sort', succeed, (1,), deps=deps),
+        Task('b', 'sort', succeed, (2,)),
+    ]
+    with pytest.raises(ValueError, match='unknown or later'):
+        run_graph(tasks, {})
@@ -0,0 +1,92 @@
+import os
+import json
+
+import pytest
+
+import bh_pipeline
+import bh_convert_double_echo
+from bh_pipeline import Study, bids_double_echo
+
+MAGNITUDE_HEURISTIC = '''
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    return template, outtype, annotation_classes
+
+
+def infotodict(seqinfo):
+    magnitude = create_key('sub-{subject}/{session}/fmap/sub-{subject}_{session}_magnitude')
+    info = {magnitude: []}
+    for s in seqinfo:
+        if 'field_map' in s.dcm_dir_name:
+            info[magnitude].append(s.series_id)
+    return info
+'''
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    """Study with two sorted sessions, each with an indexed fieldmap series"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('S', 'code'))
+    os.makedirs(os.path.join('S', 'tmp'))
+    open(os.path.join('S', 'code', 'heuristic_S.py'), 'w').close()
+    with open(os.path.join('S', 'code', 'heuristic_S_magnitude.py'), 'w') as f:
+        f.write(MAGNITUDE_HEURISTIC)
+    with open(os.path.join('S', 'tmp', 'subjlist_S.tsv'), 'w') as f:
+        f.write('# pattern: {subject}_{session}\ndirectory\tsubject\tsession\n')
+        for subject in ('sub01', 'sub02'):
+            f.write(f'{subject}_ses01\t{subject}\tses01\n')
+            series_dir = os.path.join('S', 'DICOM', 'sorted', f'{subject}_ses01', '05_field_map')
+            os.makedirs(series_dir)
+            open(os.path.join(series_dir, 'a.dcm'), 'w').close()
+            with open(os.path.join(os.path.dirname(series_dir), 'series_index.json'), 'w') as f_index:
+                json.dump({'version': 1, 'series': {'05_field_map': {
+                    'series_uid': '1.2', 'series_number': 5, 'series_description': 'field_map',
+                    'image_type': ['ORIGINAL', 'PRIMARY', 'M'], 'n_files': 1, 'dim3': 1, 'dim4': 1,
+                    'example_file': 'a.dcm', 'acq_time': 'n/a'}}}, f_index)
+    return Study('S')
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    """Record the heudiconv runs and magnitude conversions instead of running them"""
+    calls = []
+
+    def convert_session(study, session, pattern, capture_output=False, heudiconv_args=()):
+        calls.append(('heudiconv', session.subject))
+        return True
+
+    def convert_series(series_dir, out_dir, name, merge=False):
+        calls.append(('dcm2niix', os.path.basename(series_dir), name, merge))
+
+    monkeypatch.setattr(bh_pipeline, 'convert_session', convert_session)
+    monkeypatch.setattr(bh_pipeline, 'backup_dicom', lambda study: calls.append(('backup',)))
+    monkeypatch.setattr(bh_convert_double_echo, 'convert_series', convert_series)
+    monkeypatch.setattr(bh_convert_double_echo, 'update_scans_rows', lambda scans_file, rows: None)
+    return calls
+
+
+def test_magnitude_heuristic_is_used_when_present(study, conversions):
+    assert bids_double_echo(study) == 0
+    assert conversions == [
+        ('heudiconv', 'sub01'), ('dcm2niix', '05_field_map', 'sub-sub01_ses-ses01_magnitude', True),
+        ('heudiconv', 'sub02'), ('dcm2niix', '05_field_map', 'sub-sub02_ses-ses01_magnitude', True),
+        ('backup',),
+    ]
+
+
+def test_series_index_is_required(study, conversions, capsys):
+    os.remove(os.path.join('S', 'DICOM', 'sorted', 'sub02_ses01', 'series_index.json'))
+    assert bids_double_echo(study) == 1
+    assert conversions == []
+    assert 'Series index not found in DICOM/sorted/sub02_ses01' in capsys.readouterr().out
+
+
+def test_failed_magnitude_conversion_fails_the_run(study, conversions, monkeypatch):
+    from bh_dcm2niix import ConversionError
+
+    def convert_series(series_dir, out_dir, name, merge=False):
+        raise ConversionError('dcm2niix failed')
+
+    monkeypatch.setattr(bh_convert_double_echo, 'convert_series', convert_series)
+    assert bids_double_echo(study) == 1
+    assert ('backup',) not in conversions
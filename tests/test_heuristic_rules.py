@@ -0,0 +1,101 @@
+import collections
+
+import pytest
+
+from bh_heuristic_rules import RuleMatcher, SubstringAutomaton, make_infotodict
+
+SeqInfo = collections.namedtuple('SeqInfo', 'series_id dcm_dir_name dim4 image_type')
+
+
+def seq(series_id, dcm_dir_name, dim4=1, image_type=('ORIGINAL', 'PRIMARY', 'M')):
+    return SeqInfo(series_id, dcm_dir_name, dim4, image_type)
+
+
+def test_automaton_finds_overlapping_words():
+    automaton = SubstringAutomaton(['he', 'she', 'his', 'hers'])
+    assert automaton.find('ushers') == {0, 1, 3}
+    assert automaton.find('ahis') == {2}
+    assert automaton.find('xyz') == set()
+
+
+def test_contains_and_excludes():
+    matcher = RuleMatcher([
+        {'key': 'dwi', 'contains': ['DTI'], 'excludes': ['ADC', 'FA']},
+        {'key': 'rest_pa', 'contains': ['BOLD_REST', 'PA']},
+        {'key': 'rest_ap', 'contains': ['BOLD_REST', 'AP']},
+    ])
+    assert matcher.match(seq('1', 'DTI_64dir')) == ['dwi']
+    assert matcher.match(seq('2', 'DTI_64dir_ADC')) == []
+    assert matcher.match(seq('3', 'BOLD_REST_PA')) == ['rest_pa']
+    assert matcher.match(seq('4', 'BOLD_REST')) == []
+
+
+def test_string_conditions_and_unconditional_rules():
+    matcher = RuleMatcher([
+        {'key': 't1w', 'contains': 'T1_MPR'},
+        {'key': 'fmap', 'regex': r'^field_?map\d*$'},
+        {'key': 'any'},
+    ])
+    assert matcher.match(seq('1', 'T1_MPR')) == ['t1w', 'any']
+    assert matcher.match(seq('2', 'fieldmap2')) == ['fmap', 'any']
+    assert matcher.match(seq('3', 'x_fieldmap2')) == ['any']
+
+
+def test_volume_and_image_type_conditions():
+    matcher = RuleMatcher([
+        {'key': 'bold', 'contains': ['BOLD'], 'min_dim4': 100},
+        {'key': 'sbref', 'contains': ['BOLD'], 'max_dim4': 1},
+        {'key': 'phase', 'contains': ['BOLD'], 'image_type': 'P'},
+    ])
+    assert matcher.match(seq('1', 'BOLD', dim4=200)) == ['bold']
+    assert matcher.match(seq('2', 'BOLD', dim4=1)) == ['sbref']
+    assert matcher.match(seq('3', 'BOLD', dim4=50, image_type=('ORIGINAL', 'P'))) == ['phase']
+
+
+def test_rule_without_key():
+    with pytest.raises(ValueError, match='has no key'):
+        RuleMatcher([{'contains': ['T1']}])
+
+
+def test_make_infotodict():
+    table = {
+        'keys': {
+            't1w': 'sub-{subject}/anat/sub-{subject}_run-{item:02d}_T1w',
+            'bold': 'sub-{subject}/func/sub-{subject}_task-rest_run-{item:02d}_bold',
+        },
+        'rules': [
+            {'key': 't1w', 'contains': ['T1']},
+            {'key': 't1w', 'contains': ['MPRAGE']},
+            {'key': 'bold', 'contains': ['BOLD'], 'min_dim4': 10},
+        ],
+    }
+    infotodict = make_infotodict(table)
+    info = infotodict([seq('1', 'T1_MPRAGE'), seq('2', 'BOLD', dim4=300), seq('3', 'BOLD_SBRef')])
+
+    t1w_key = ('sub-{subject}/anat/sub-{subject}_run-{item:02d}_T1w', ('nii.gz',), None)
+    bold_key = ('sub-{subject}/func/sub-{subject}_task-rest_run-{item:02d}_bold', ('nii.gz',), None)
+    assert info == {t1w_key: ['1'], bold_key: ['2']}
+
+
+def test_make_infotodict_undefined_key():
+    with pytest.raises(ValueError, match='undefined key'):
+        make_infotodict({'keys': {}, 'rules': [{'key': 't1w', 'contains': ['T1']}]})
+
+
+def test_generated_loader_imports_with_heudiconv_env(tmp_path):
+    import json
+    import subprocess
+    import sys
+    from bh_make_heuristic import RULES_LOADER
+    from bh_pipeline import heudiconv_env
+
+    (tmp_path / 'heuristic_S.py').write_text(RULES_LOADER.format(study_name='S', date='2026-01-01'))
+    (tmp_path / 'heuristic_S_rules.json').write_text(json.dumps({
+        'keys': {'t1w': 'sub-{subject}/anat/sub-{subject}_T1w'},
+        'rules': [{'key': 't1w', 'contains': ['T1']}]}))
+    # heudiconv loads the heuristic by path, from the study directory
+    code = ('import importlib.util; spec = importlib.util.spec_from_file_location("h", "heuristic_S.py"); '
+            'h = importlib.util.module_from_spec(spec); spec.loader.exec_module(h); print(h.infotodict)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=heudiconv_env(),
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
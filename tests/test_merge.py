@@ -0,0 +1,66 @@
+import os
+
+from bh_merge import merge_table, merge_tree, read_table
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_merge_tree_moves_drops_and_keeps_conflicts(tmp_path):
+    src, dest = str(tmp_path / 'shard'), str(tmp_path / 'rawdata')
+    write(f'{src}/sub-01/anat/sub-01_T1w.json', '{"new": 1}')
+    write(f'{src}/dataset_description.json', '{"Name": "study"}')
+    write(f'{dest}/dataset_description.json', '{"Name": "study"}')
+    write(f'{src}/README', 'shard copy')
+    write(f'{dest}/README', 'rawdata copy')
+    write(f'{src}/.heudiconv/01/info/heuristic.py', 'shard')
+    write(f'{dest}/.heudiconv/01/info/heuristic.py', 'rawdata')
+
+    moved, identical, conflicts = merge_tree(src, dest)
+
+    assert (moved, identical, conflicts) == (2, 1, ['README'])
+    assert read(f'{dest}/sub-01/anat/sub-01_T1w.json') == '{"new": 1}'
+    assert read(f'{dest}/README') == 'rawdata copy'
+    assert read(f'{dest}/.heudiconv/01/info/heuristic.py') == 'shard'
+    # Only the conflicting file is left in the private tree
+    assert sorted(os.listdir(src)) == ['README']
+
+
+def test_merge_tree_merges_participants(tmp_path):
+    src, dest = str(tmp_path / 'shard'), str(tmp_path / 'rawdata')
+    write(f'{src}/participants.tsv', 'participant_id\tage\nsub-02\t30\n')
+    write(f'{dest}/participants.tsv', 'participant_id\tage\nsub-01\t25\n')
+
+    assert merge_tree(src, dest) == (1, 0, [])
+    assert read(f'{dest}/participants.tsv') == 'participant_id\tage\nsub-01\t25\nsub-02\t30\n'
+    assert not os.path.exists(src)
+
+
+def test_merge_tree_reports_conflicting_participants(tmp_path):
+    src, dest = str(tmp_path / 'shard'), str(tmp_path / 'rawdata')
+    write(f'{src}/participants.tsv', 'participant_id\tage\nsub-01\t31\n')
+    write(f'{dest}/participants.tsv', 'participant_id\tage\nsub-01\t25\n')
+
+    assert merge_tree(src, dest) == (0, 0, ['participants.tsv (sub-01)'])
+    assert read(f'{dest}/participants.tsv') == 'participant_id\tage\nsub-01\t25\n'
+    assert os.path.exists(f'{src}/participants.tsv')
+
+
+def test_merge_table_fills_missing_values_and_columns(tmp_path):
+    src, dest = str(tmp_path / 'src.tsv'), str(tmp_path / 'dest.tsv')
+    write(src, 'participant_id\tage\tsex\nsub-01\t25\tF\n')
+    write(dest, 'participant_id\tage\nsub-01\tn/a\nsub-02\t40\n')
+
+    assert merge_table(src, dest) == []
+    columns, rows = read_table(dest)
+    assert columns == ['participant_id', 'age', 'sex']
+    assert rows['sub-01'] == {'participant_id': 'sub-01', 'age': '25', 'sex': 'F'}
+    assert rows['sub-02'] == {'participant_id': 'sub-02', 'age': '40', 'sex': 'n/a'}
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import bh_shard
+from bh_pipeline import Study, merge_shards
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    """Study with two shards: shard 0 finished, shard 1 still writing"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(bh_shard.shard_dir('S'))
+    bh_shard.write_manifest('S', '{subject}', [{'sessions': [], 'cost': 1, 'memory_mb': 100}] * 2)
+    for k in (0, 1):
+        anat = os.path.join(bh_shard.shard_output('S', k), f'sub-0{k}', 'anat')
+        os.makedirs(anat)
+        with open(os.path.join(anat, f'sub-0{k}_T1w.json'), 'w') as f:
+            f.write('{}')
+    open(bh_shard.shard_done_marker('S', 0), 'w').close()
+    return Study('S')
+
+
+def test_unfinished_shard_blocks_merge(study, capsys):
+    assert merge_shards(study) == 1
+    assert not os.path.exists(study.path('bids', 'rawdata', 'sub-00'))
+    assert os.path.exists(os.path.join(bh_shard.shard_output('S', 0), 'sub-00', 'anat', 'sub-00_T1w.json'))
+    assert 'Shards did not finish: shard_001' in capsys.readouterr().out
+
+
+def test_force_merges_finished_shards_only(study):
+    assert merge_shards(study, force=True) == 1
+    assert os.path.exists(study.path('bids', 'rawdata', 'sub-00', 'anat', 'sub-00_T1w.json'))
+    assert not os.path.exists(study.path('bids', 'rawdata', 'sub-01'))
+    assert os.path.exists(os.path.join(bh_shard.shard_output('S', 1), 'sub-01', 'anat', 'sub-01_T1w.json'))
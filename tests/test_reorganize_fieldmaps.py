@@ -0,0 +1,146 @@
+import os
+
+import pytest
+
+from bh_reorganize_fieldmaps import (JOURNAL_NAME, apply_journal, plan_fieldmap_reorganization,
+                                     validate_plan, write_journal)
+
+PREFIX = 'sub-01_ses-01'
+
+
+@pytest.fixture(autouse=True)
+def memory_only_sidecar_cache(monkeypatch):
+    monkeypatch.delenv('BH_SIDECAR_CACHE', raising=False)
+
+
+def fieldmap_files(*names):
+    return [f'{PREFIX}_{name}{ext}' for name in names for ext in ('.nii.gz', '.json')]
+
+
+def image_types(mapping):
+    return lambda basename: mapping.get(basename, 'unknown')
+
+
+def test_plan_renames_by_image_type_and_removes_the_rest():
+    files = fieldmap_files('magnitude11', 'magnitude12', 'magnitude21', 'magnitude22', 'real', 'imaginary')
+    types = image_types({
+        f'{PREFIX}_magnitude11.json': 'magnitude',
+        f'{PREFIX}_magnitude12.json': 'phase',
+        f'{PREFIX}_magnitude21.json': 'magnitude',
+        f'{PREFIX}_magnitude22.json': 'phase',
+    })
+
+    plan = plan_fieldmap_reorganization(files, types)
+
+    assert plan['rename_mapping'] == {
+        f'{PREFIX}_magnitude11.nii.gz': f'{PREFIX}_magnitude1.nii.gz',
+        f'{PREFIX}_magnitude12.nii.gz': f'{PREFIX}_phase1.nii.gz',
+        f'{PREFIX}_magnitude21.nii.gz': f'{PREFIX}_magnitude2.nii.gz',
+        f'{PREFIX}_magnitude22.nii.gz': f'{PREFIX}_phase2.nii.gz',
+    }
+    assert plan['final_files'] == sorted(fieldmap_files('magnitude1', 'phase1', 'magnitude2', 'phase2'))
+    assert sorted(plan['files_deleted']) == sorted(fieldmap_files('real', 'imaginary'))
+    assert validate_plan(plan, files) == []
+
+
+def test_plan_keeps_extra_files_on_request():
+    files = fieldmap_files('magnitude11', 'real')
+    types = image_types({f'{PREFIX}_magnitude11.json': 'magnitude'})
+
+    plan = plan_fieldmap_reorganization(files, types, keep_extra=True)
+
+    assert plan['final_files'] == sorted(fieldmap_files('magnitude1', 'real'))
+    assert plan['files_deleted'] == []
+
+
+def test_plan_later_series_supersedes_earlier_one():
+    files = fieldmap_files('magnitude11', 'magnitude13')
+    types = image_types({f'{PREFIX}_magnitude11.json': 'magnitude', f'{PREFIX}_magnitude13.json': 'magnitude'})
+
+    plan = plan_fieldmap_reorganization(files, types)
+
+    assert plan['rename_mapping'] == {f'{PREFIX}_magnitude13.nii.gz': f'{PREFIX}_magnitude1.nii.gz'}
+    assert f'{PREFIX}_magnitude11.nii.gz' in plan['files_deleted']
+    assert plan['final_files'] == sorted(fieldmap_files('magnitude1'))
+
+
+def test_plan_removes_numbered_files_of_unknown_type():
+    files = fieldmap_files('magnitude11')
+
+    plan = plan_fieldmap_reorganization(files, image_types({}))
+
+    assert plan['rename_mapping'] == {}
+    assert sorted(plan['files_deleted']) == sorted(files)
+    assert plan['final_files'] == []
+
+
+def test_validate_plan_reports_missing_files():
+    files = fieldmap_files('magnitude11')
+    plan = plan_fieldmap_reorganization(files, image_types({f'{PREFIX}_magnitude11.json': 'phase'}))
+
+    assert validate_plan(plan, files[:1]) == [f'rename source missing: {PREFIX}_magnitude11.json']
+    assert validate_plan(plan, files + [f'{PREFIX}_phasediff.nii.gz']) == [
+        f'no sidecar after reorganization: {PREFIX}_phasediff.nii.gz']
+
+
+def make_session(tmp_path, names):
+    session_dir = tmp_path / 'sub-01' / 'ses-01'
+    fmap_dir = session_dir / 'fmap'
+    fmap_dir.mkdir(parents=True)
+    files = fieldmap_files(*names)
+    for basename in files:
+        (fmap_dir / basename).write_text(basename)
+    scans_file = session_dir / f'{PREFIX}_scans.tsv'
+    rows = ''.join(f'fmap/{basename}\t2024-01-01T00:00:00\n' for basename in files if basename.endswith('.nii.gz'))
+    scans_file.write_text('filename\tacq_time\n' + rows)
+    return str(session_dir), str(fmap_dir), str(scans_file), files
+
+
+def journal_for(fmap_dir, scans_file, plan):
+    journal_file = os.path.join(os.path.dirname(fmap_dir), JOURNAL_NAME)
+    write_journal(journal_file, {
+        'fmap_dir': fmap_dir,
+        'scans_file': scans_file,
+        'ops': plan['ops'],
+        'rename_mapping': plan['rename_mapping'],
+        'files_deleted': plan['files_deleted'],
+    })
+    return journal_file
+
+
+def scans_filenames(scans_file):
+    with open(scans_file) as f:
+        return [line.split('\t')[0] for line in f.read().splitlines()[1:]]
+
+
+def test_apply_journal(tmp_path):
+    _, fmap_dir, scans_file, files = make_session(tmp_path, ['magnitude11', 'magnitude12', 'real'])
+    types = image_types({f'{PREFIX}_magnitude11.json': 'magnitude', f'{PREFIX}_magnitude12.json': 'phase'})
+    plan = plan_fieldmap_reorganization(files, types)
+    journal_file = journal_for(fmap_dir, scans_file, plan)
+
+    apply_journal(journal_file)
+
+    assert sorted(os.listdir(fmap_dir)) == plan['final_files']
+    # Contents travel with the renames
+    with open(os.path.join(fmap_dir, f'{PREFIX}_phase1.json')) as f:
+        assert f.read() == f'{PREFIX}_magnitude12.json'
+    assert scans_filenames(scans_file) == [f'fmap/{PREFIX}_magnitude1.nii.gz', f'fmap/{PREFIX}_phase1.nii.gz']
+    assert not os.path.exists(journal_file)
+
+
+def test_apply_journal_rolls_forward_after_interruption(tmp_path):
+    _, fmap_dir, scans_file, files = make_session(tmp_path, ['magnitude11', 'magnitude12'])
+    types = image_types({f'{PREFIX}_magnitude11.json': 'magnitude', f'{PREFIX}_magnitude12.json': 'phase'})
+    plan = plan_fieldmap_reorganization(files, types)
+    journal_file = journal_for(fmap_dir, scans_file, plan)
+
+    # Interrupted after the first two operations
+    for op in plan['ops'][:2]:
+        os.replace(os.path.join(fmap_dir, op['src']), os.path.join(fmap_dir, op['dst']))
+
+    apply_journal(journal_file)
+
+    assert sorted(os.listdir(fmap_dir)) == plan['final_files']
+    assert scans_filenames(scans_file) == [f'fmap/{PREFIX}_magnitude1.nii.gz', f'fmap/{PREFIX}_phase1.nii.gz']
+    assert not os.path.exists(journal_file)
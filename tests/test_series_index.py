@@ -0,0 +1,45 @@
+import hashlib
+
+from bh_series_index import series_by_uid, strip_uid_suffix, uid_dir_name
+
+UID = '1.2.840.113619.2.55.3.1'
+
+
+def test_uid_dir_name_round_trip():
+    owners = {}
+    dir_name = uid_dir_name('Field_map2', UID, owners)
+    assert dir_name == f'Field_map2__{hashlib.sha1(UID.encode()).hexdigest()[:8]}'
+    assert strip_uid_suffix(dir_name) == 'Field_map2'
+    assert owners == {dir_name: UID}
+
+
+def test_uid_dir_name_is_stable():
+    owners = {}
+    assert uid_dir_name('T1', UID, owners) == uid_dir_name('T1', UID, owners)
+    assert len(owners) == 1
+
+
+def test_uid_dir_name_collision_takes_longer_digest():
+    digest = hashlib.sha1(UID.encode()).hexdigest()
+    owners = {f'T1__{digest[:8]}': 'another series'}
+    dir_name = uid_dir_name('T1', UID, owners)
+    assert dir_name == f'T1__{digest[:12]}'
+    assert strip_uid_suffix(dir_name) == 'T1'
+
+
+def test_strip_uid_suffix_leaves_other_names_alone():
+    assert strip_uid_suffix('Field_map2') == 'Field_map2'
+    assert strip_uid_suffix('T1__mprage') == 'T1__mprage'
+    assert strip_uid_suffix('T1__0123abc') == 'T1__0123abc'
+
+
+def test_series_by_uid():
+    index = {
+        'Field_map1__aaaaaaaa': {'series_uid': '1.2.3'},
+        'Field_map1__bbbbbbbb': {'series_uid': '1.2.3'},
+        'T1__cccccccc': {'series_uid': '1.2.4'},
+    }
+    assert series_by_uid(index) == {
+        '1.2.3': ['Field_map1__aaaaaaaa', 'Field_map1__bbbbbbbb'],
+        '1.2.4': ['T1__cccccccc'],
+    }
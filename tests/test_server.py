@@ -0,0 +1,104 @@
+import os
+import json
+import threading
+
+import pytest
+
+import bh_server
+from bh_server import READY, ServerError, _listen, _receive, _socket_dir, forward, socket_path
+
+
+@pytest.fixture
+def server_socket(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run' / 'server.sock')
+    monkeypatch.setenv('BH_SERVER_SOCKET', path)
+    monkeypatch.delenv('BH_NO_SERVER', raising=False)
+    monkeypatch.setenv('BH_SIDECAR_CACHE', '/tmp/cache.json')
+    monkeypatch.setenv('OTHER_VARIABLE', 'x')
+    return path
+
+
+def test_socket_path(tmp_path, monkeypatch):
+    monkeypatch.setenv('BH_SERVER_SOCKET', '/somewhere/server.sock')
+    assert socket_path() == '/somewhere/server.sock'
+    monkeypatch.delenv('BH_SERVER_SOCKET')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    assert socket_path() == str(tmp_path / 'batch-heudiconv' / 'server.sock')
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert socket_path() == f'/tmp/batch-heudiconv-{os.getuid()}/server.sock'
+
+
+def test_socket_dir_must_be_private(tmp_path):
+    _socket_dir(str(tmp_path / 'new' / 'server.sock'))
+    assert os.stat(tmp_path / 'new').st_mode & 0o777 == 0o700
+
+    (tmp_path / 'shared').mkdir(mode=0o755)
+    os.chmod(tmp_path / 'shared', 0o755)
+    with pytest.raises(ServerError):
+        _socket_dir(str(tmp_path / 'shared' / 'server.sock'))
+
+
+def test_no_server(server_socket):
+    assert forward('bh_dcm_sort_uid', []) is None
+
+
+def serve_one(listener, reply):
+    """Take one request on listener like the server does; returns it"""
+    received = {}
+
+    def run():
+        conn, _ = listener.accept()
+        with conn:
+            conn.sendall(READY)
+            request, fds = _receive(conn)
+            for fd in fds:
+                os.close(fd)
+            received.update(request)
+            conn.sendall(json.dumps(reply).encode() + b'\n')
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, received
+
+
+def test_forward(server_socket, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    listener = _listen(server_socket)
+    assert os.stat(server_socket).st_mode & 0o777 == 0o600
+    thread, request = serve_one(listener, {'exit': 3})
+
+    assert forward('bh_dcm_sort_uid', ['--help']) == 3
+    thread.join()
+    listener.close()
+    assert request['program'] == 'bh_dcm_sort_uid'
+    assert request['argv'] == ['--help']
+    assert request['cwd'] == str(tmp_path)
+    # Only the environment the tools need is sent
+    assert request['env'] == {'BH_SIDECAR_CACHE': '/tmp/cache.json'}
+
+
+def test_busy_server_runs_locally(server_socket, monkeypatch):
+    monkeypatch.setattr(bh_server, 'BUSY_TIMEOUT', 0.05)
+    listener = _listen(server_socket)
+    # Never accepted: the server is busy with another request
+    assert forward('bh_dcm_sort_uid', []) is None
+    listener.close()
+
+
+def test_untrusted_socket_is_not_used(server_socket, capsys):
+    listener = _listen(server_socket)
+    os.chmod(server_socket, 0o666)
+    assert forward('bh_dcm_sort_uid', []) is None
+    listener.close()
+    assert 'Warning: Not using the batch-heudiconv server' in capsys.readouterr().err
+
+
+def test_stale_socket_is_replaced(server_socket):
+    listener = _listen(server_socket)
+    assert _listen(server_socket) is None
+    listener.close()
+    # Left behind, nobody listening
+    assert os.path.exists(server_socket)
+    listener = _listen(server_socket)
+    assert listener is not None
+    listener.close()
@@ -0,0 +1,25 @@
+from bh_shard import partition
+
+
+def test_largest_first_into_lightest_shard():
+    items = [('a', 5), ('b', 4), ('c', 3), ('d', 3), ('e', 3)]
+    assert partition(items, 2) == [(8, ['a', 'd']), (10, ['b', 'c', 'e'])]
+
+
+def test_every_item_placed_once():
+    items = [(f'sub-{i:02d}', (i * 7) % 11 + 1) for i in range(20)]
+    shards = partition(items, 3)
+    placed = [item for _, shard in shards for item in shard]
+    assert sorted(placed) == sorted(item for item, _ in items)
+    assert sum(total for total, _ in shards) == sum(cost for _, cost in items)
+    totals = [total for total, _ in shards]
+    assert max(totals) - min(totals) <= max(cost for _, cost in items)
+
+
+def test_empty_shards_are_dropped():
+    assert partition([('a', 1), ('b', 2)], 4) == [(2, ['b']), (1, ['a'])]
+    assert partition([], 3) == []
+
+
+def test_at_least_one_shard():
+    assert partition([('a', 1), ('b', 2)], 0) == [(3, ['b', 'a'])]
@@ -0,0 +1,68 @@
+import json
+
+from bh_sidecar_cache import SidecarCache
+
+
+def write_sidecar(path, data):
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+def test_load_parses_changed_files_only(tmp_path):
+    sidecar = write_sidecar(tmp_path / 'a.json', {'EchoTime': 0.01})
+    cache = SidecarCache()
+    assert cache.load(sidecar) == {'EchoTime': 0.01}
+    assert cache.load(sidecar) == {'EchoTime': 0.01}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    write_sidecar(tmp_path / 'a.json', {'EchoTime': 0.025})
+    assert cache.load(sidecar) == {'EchoTime': 0.025}
+    assert cache.misses == 2
+
+
+def test_saves_of_two_caches_are_merged(tmp_path):
+    cache_file = str(tmp_path / 'cache.json')
+    a = write_sidecar(tmp_path / 'a.json', {'a': 1})
+    b = write_sidecar(tmp_path / 'b.json', {'b': 2})
+    first, second = SidecarCache(cache_file=cache_file), SidecarCache(cache_file=cache_file)
+    first.load(a)
+    second.load(b)
+    first.save()
+    second.save()
+
+    reloaded = SidecarCache(cache_file=cache_file)
+    assert reloaded.load(a) == {'a': 1}
+    assert reloaded.load(b) == {'b': 2}
+    assert (reloaded.hits, reloaded.misses) == (2, 0)
+
+
+def test_discarded_and_renamed_entries_are_saved(tmp_path):
+    cache_file = str(tmp_path / 'cache.json')
+    a = write_sidecar(tmp_path / 'a.json', {'a': 1})
+    b = write_sidecar(tmp_path / 'b.json', {'b': 2})
+    cache = SidecarCache(cache_file=cache_file)
+    cache.load(a)
+    cache.load(b)
+    cache.save()
+
+    renamed = str(tmp_path / 'c.json')
+    (tmp_path / 'a.json').rename(renamed)
+    cache = SidecarCache(cache_file=cache_file)
+    cache.rename(a, renamed)
+    cache.discard(b)
+    cache.save()
+
+    with open(cache_file) as f:
+        assert sorted(json.load(f)['entries']) == [renamed]
+
+
+def test_max_entries(tmp_path):
+    cache_file = str(tmp_path / 'cache.json')
+    sidecars = [write_sidecar(tmp_path / f'{i}.json', {'i': i}) for i in range(3)]
+    cache = SidecarCache(max_entries=2, cache_file=cache_file)
+    for sidecar in sidecars:
+        cache.load(sidecar)
+    cache.save()
+
+    with open(cache_file) as f:
+        assert sorted(json.load(f)['entries']) == sorted(sidecars[1:])
@@ -0,0 +1,114 @@
+import os
+import mmap
+
+import pytest
+
+pydicom = pytest.importorskip('pydicom')
+
+import bh_sort_io
+import bh_dcm_sort_uid
+from bh_dcm_sort_uid import copy_dicom_files
+from bh_pixel_integrity import write_report
+from bh_sort_io import read_header
+
+
+def write_instance(path, series_uid, number, missing_bytes=0):
+    """Write a 64 x 64 16-bit MR instance, cut short by missing_bytes"""
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = 3
+    ds.SeriesDescription = 'T1 MPR'
+    ds.InstanceNumber = number
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M']
+    ds.Rows = ds.Columns = 64
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.SamplesPerPixel = 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = bytes(64 * 64 * 2)
+    ds.save_as(path, enforce_file_format=True)
+    if missing_bytes:
+        os.truncate(path, os.path.getsize(path) - missing_bytes)
+
+
+@pytest.fixture
+def subject_dir(tmp_path):
+    path = tmp_path / 'original' / 'subj01'
+    path.mkdir(parents=True)
+    for number in (1, 2, 3):
+        write_instance(str(path / f'IM{number}'), '1.2.3.4', number, missing_bytes=100 if number == 2 else 0)
+    return str(path)
+
+
+def test_truncated_file_is_sorted_and_reported(subject_dir, tmp_path):
+    sorted_dir = str(tmp_path / 'sorted')
+    skipped = []
+
+    index = copy_dicom_files(subject_dir, sorted_dir, verify='length', skipped=skipped)
+
+    assert skipped == []
+    (name, entry), = index.items()
+    assert entry['integrity']['checked'] == 3
+    (_, problem), = entry['integrity']['problems']
+    assert problem == 'truncated pixel data (8092 of 8192 bytes)'
+    assert len(os.listdir(os.path.join(sorted_dir, 'subj01', name))) == 3
+    assert write_report(str(tmp_path / 'report.tsv'), {'subj01': index}) == 1
+
+
+def test_no_mapping_off_local_file_systems(subject_dir, monkeypatch):
+    def no_mmap(*args, **kwargs):
+        raise AssertionError('mapped a file on a network file system')
+
+    monkeypatch.setattr(bh_sort_io, 'LOCAL_FS_TYPES', ())
+    monkeypatch.setattr(mmap, 'mmap', no_mmap)
+    ds, _, _ = read_header(os.path.join(subject_dir, 'IM1'))
+    assert ds.InstanceNumber == 1
+
+
+@pytest.mark.parametrize('io_jobs', [1, 4])
+def test_failed_write_is_not_indexed(subject_dir, tmp_path, monkeypatch, io_jobs):
+    write_copy = bh_dcm_sort_uid.write_copy
+
+    def failing_write_copy(src_file, dest_file, data=None, st=None):
+        if src_file.endswith('IM3'):
+            raise OSError(28, 'No space left on device')
+        write_copy(src_file, dest_file, data, st)
+
+    monkeypatch.setattr(bh_dcm_sort_uid, 'write_copy', failing_write_copy)
+    sorted_dir = str(tmp_path / 'sorted')
+    skipped = []
+
+    index = copy_dicom_files(subject_dir, sorted_dir, io_jobs=io_jobs, skipped=skipped)
+
+    assert skipped == [(os.path.join(subject_dir, 'IM3'), 'write failed: [Errno 28] No space left on device')]
+    (name, entry), = index.items()
+    files = sorted(os.listdir(os.path.join(sorted_dir, 'subj01', name)))
+    assert entry['n_files'] == 2
+    assert sorted(filename for _, filename in entry['instances']) == files
+    assert entry['example_file'] in files
+
+
+def test_series_without_written_instances_is_dropped(subject_dir, tmp_path, monkeypatch):
+    def failing_write_copy(src_file, dest_file, data=None, st=None):
+        raise OSError(13, 'Permission denied')
+
+    monkeypatch.setattr(bh_dcm_sort_uid, 'write_copy', failing_write_copy)
+    sorted_dir = str(tmp_path / 'sorted')
+    skipped = []
+
+    assert copy_dicom_files(subject_dir, sorted_dir, skipped=skipped) == {}
+    assert len(skipped) == 3
+    assert os.listdir(os.path.join(sorted_dir, 'subj01')) == []
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import bh_pipeline
+from bh_pipeline import Study, bids, convert_session_staged
+from bh_study import Session
+
+SESSION = Session('1', 'subj01', '01')
+
+
+def partial_conversion(ok):
+    """Stand-in for convert_session: writes part of a session, then returns ok"""
+    def convert_session(study, session, pattern, capture_output=False):
+        anat = os.path.join(study.rawdata, f'sub-{session.subject}', f'ses-{session.session}', 'anat')
+        os.makedirs(anat)
+        with open(os.path.join(anat, f'sub-{session.subject}_ses-{session.session}_T1w.json'), 'w') as f:
+            f.write('{}')
+        return ok
+    return convert_session
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('BH_SIDECAR_CACHE', raising=False)
+    for d in ('code', 'tmp', os.path.join('DICOM', 'sorted', SESSION.directory)):
+        os.makedirs(os.path.join('S', d))
+    open(os.path.join('S', 'code', 'heuristic_S.py'), 'w').close()
+    with open(os.path.join('S', 'tmp', 'subjlist_S.tsv'), 'w') as f:
+        f.write('# pattern: {subject}_{session}\ndirectory\tsubject\tsession\n1\tsubj01\t01\n')
+    study = Study('S')
+    study.set_index(SESSION.directory, {})
+    return study
+
+
+def test_failed_session_is_not_published(study, tmp_path, monkeypatch):
+    monkeypatch.setattr(bh_pipeline, 'convert_session', partial_conversion(False))
+    scratch = str(tmp_path / 'scratch')
+
+    assert convert_session_staged(study, SESSION, '{subject}_{session}', scratch) is False
+    assert not os.path.exists(study.path('bids', 'rawdata', 'sub-subj01'))
+    assert os.listdir(scratch) == []
+
+
+def test_converted_session_is_published(study, tmp_path, monkeypatch):
+    monkeypatch.setattr(bh_pipeline, 'convert_session', partial_conversion(True))
+
+    assert convert_session_staged(study, SESSION, '{subject}_{session}', str(tmp_path / 'scratch')) is True
+    assert os.path.exists(study.path('bids', 'rawdata', 'sub-subj01', 'ses-01', 'anat',
+                                     'sub-subj01_ses-01_T1w.json'))
+
+
+def test_failed_staged_session_is_not_backed_up(study, tmp_path, monkeypatch):
+    backups = []
+    monkeypatch.setattr(bh_pipeline, 'convert_session', partial_conversion(False))
+    monkeypatch.setattr(bh_pipeline, 'backup_dicom', backups.append)
+
+    assert bids(study, scratch=str(tmp_path / 'scratch')) == 1
+    assert backups == []